@@ -0,0 +1,702 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for download_figma_assets.py against a local mock of the Figma API.
+
+Starts an in-process stand-in for /v1/files, /v1/images and the image CDN
+(with configurable latency, bandwidth and error injection), generates
+synthetic documents of the requested sizes, and runs each benchmark case in
+its own subprocess so peak memory is measured per case. Results are written
+as JSON for tracking regressions.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+import download_figma_assets as figma
+
+
+BENCHMARKS = ("parse", "parse_stream", "traverse", "resolve", "download", "download_page",
+              "download_icons", "download_atlas", "download_s3")
+# Run against a variant of the document whose icons carry export settings
+ICON_BENCHMARKS = ("download_icons", "download_atlas")
+
+
+def generate_document(nodes: int, seed: int = 0, base_url: str = "http://127.0.0.1/cdn",
+                      image_fill_ratio: float = 0.03, instance_ratio: float = 0.2,
+                      unique_image_ratio: float = 0.5, frame_size: int = 100,
+                      icon_export_ratio: float = 0.0) -> Dict:
+    """Build a synthetic /v1/files response with roughly the given number of nodes.
+    
+    The mix follows a typical design file: pages of top-level frames (some of
+    them components and instances), each holding groups of rectangles, text
+    and vectors. About image_fill_ratio of the leaves carry IMAGE fills, drawn
+    from a pool of unique_image_ratio * fills distinct imageRefs, and
+    icon_export_ratio of the 24px vector icons have export settings.
+    """
+    rng = random.Random(seed)
+    pages_count = max(1, nodes // (frame_size * 50))
+    frames_count = max(1, nodes // frame_size)
+    fills_count = max(1, int(nodes * image_fill_ratio))
+    refs = [hashlib.sha1(f"{seed}:{i}".encode()).hexdigest() for i in range(max(1, int(fills_count * unique_image_ratio)))]
+    
+    counter = [0]
+    
+    def next_id() -> str:
+        counter[0] += 1
+        return f"{counter[0] // 1000}:{counter[0] % 1000}"
+    
+    def box(width: float, height: float) -> Dict:
+        return {"x": rng.uniform(0, 5000), "y": rng.uniform(0, 5000), "width": width, "height": height}
+    
+    def leaf() -> Dict:
+        roll = rng.random()
+        if roll < image_fill_ratio * 3:
+            # Leaves are about a third of all nodes, so this hits image_fill_ratio overall
+            return {"id": next_id(), "name": f"Photo {counter[0]}", "type": "RECTANGLE",
+                    "fills": [{"type": "IMAGE", "scaleMode": "FILL", "imageRef": rng.choice(refs)}],
+                    "absoluteBoundingBox": box(rng.choice((320, 640, 1200)), rng.choice((240, 480, 800)))}
+        if roll < 0.5:
+            return {"id": next_id(), "name": f"Label {counter[0]}", "type": "TEXT",
+                    "characters": "Lorem ipsum dolor sit amet",
+                    "fills": [{"type": "SOLID", "color": {"r": 0, "g": 0, "b": 0, "a": 1}}],
+                    "absoluteBoundingBox": box(200, 24)}
+        if roll < 0.75:
+            icon = {"id": next_id(), "name": f"Icon {counter[0]}", "type": "VECTOR",
+                    "fills": [{"type": "SOLID", "color": {"r": 0.2, "g": 0.2, "b": 0.2, "a": 1}}],
+                    "absoluteBoundingBox": box(24, 24)}
+            if icon_export_ratio and rng.random() < icon_export_ratio:
+                icon["exportSettings"] = [{"format": "PNG", "suffix": "",
+                                           "constraint": {"type": "SCALE", "value": 2}}]
+            return icon
+        return {"id": next_id(), "name": f"Shape {counter[0]}", "type": "RECTANGLE",
+                "fills": [{"type": "SOLID", "color": {"r": 1, "g": 1, "b": 1, "a": 1}}],
+                "absoluteBoundingBox": box(rng.uniform(10, 400), rng.uniform(10, 400))}
+    
+    component_ids: List[str] = []
+    pages = []
+    remaining = nodes - 1 - pages_count
+    per_page = max(1, frames_count // pages_count)
+    for page_number in range(pages_count):
+        frames = []
+        for _ in range(per_page):
+            if remaining <= 0:
+                break
+            frame_nodes = min(frame_size, remaining)
+            remaining -= frame_nodes
+            children = []
+            budget = frame_nodes - 1
+            while budget > 0:
+                group_size = min(budget, rng.randint(3, 12))
+                budget -= group_size
+                group = {"id": next_id(), "name": f"Group {counter[0]}", "type": "GROUP",
+                         "absoluteBoundingBox": box(400, 300),
+                         "children": [leaf() for _ in range(group_size - 1)]}
+                children.append(group)
+            
+            frame_id = next_id()
+            roll = rng.random()
+            if component_ids and roll < instance_ratio:
+                frame = {"id": frame_id, "name": f"Card {counter[0]}", "type": "INSTANCE",
+                         "componentId": rng.choice(component_ids), "overrides": []}
+            elif roll < instance_ratio + 0.05:
+                frame = {"id": frame_id, "name": f"Component {counter[0]}", "type": "COMPONENT"}
+                component_ids.append(frame_id)
+            else:
+                frame = {"id": frame_id, "name": f"Screen {counter[0]}", "type": "FRAME"}
+            frame["absoluteBoundingBox"] = box(1440, 900)
+            frame["children"] = children
+            frames.append(frame)
+        pages.append({"id": f"page:{page_number}", "name": f"Page {page_number}", "type": "CANVAS",
+                      "children": frames})
+    
+    return {
+        "name": f"Synthetic {nodes} nodes",
+        "version": str(seed + 1),
+        "lastModified": "2024-01-01T00:00:00Z",
+        "document": {"id": "0:0", "name": "Document", "type": "DOCUMENT", "children": pages},
+        "images": {ref: f"{base_url}/fills/{ref}.png" for ref in refs},
+    }
+
+
+class MockFigmaServer:
+    """Local stand-in for the Figma REST API and its image CDN, run on a background thread.
+    
+    Files are registered by id (see add_file) and served from pre-serialised
+    JSON. Every request waits `latency` seconds; response bodies are sent at
+    `bandwidth` bytes/s per connection (0 = unthrottled); a fraction
+    `error_rate` of requests fails with 429 (API, with a Retry-After of
+    `retry_after` seconds) or 503 (CDN). CDN images are `asset_bytes` long
+    and unique per URL.
+    
+    PUT /<bucket>/<key> stands in for an S3-compatible object store (see
+    figma.S3Sink): uploads must carry a valid SigV4 signature for
+    S3_ACCESS_KEY/S3_SECRET_KEY and exactly Content-Length bytes of body,
+    and `x-amz-copy-source` copies an existing object. Only the size and
+    SHA-256 of each object are kept, in `objects`.
+    """
+    
+    S3_ACCESS_KEY = "benchmark-access-key"
+    S3_SECRET_KEY = "benchmark-secret-key"
+    
+    def __init__(self, latency: float = 0.0, bandwidth: float = 0.0, error_rate: float = 0.0,
+                 asset_bytes: int = 50_000, port: int = 0, retry_after: float = 0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.asset_bytes = asset_bytes
+        self.files: Dict[str, bytes] = {}
+        self.documents: Dict[str, Dict] = {}
+        self.fill_maps: Dict[str, bytes] = {}
+        self.projects: Dict[str, List[Dict]] = {}
+        # Object store key -> (size, SHA-256), and the uploads turned away
+        self.objects: Dict[str, Tuple[int, str]] = {}
+        self.s3_rejected = 0
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+    
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+    
+    def add_file(self, file_id: str, document: Dict, project_id: str = "bench") -> None:
+        """Serve document as /v1/files/<file_id>, listed in /v1/projects/<project_id>/files."""
+        self.files[file_id] = json.dumps(document).encode()
+        self.documents[file_id] = document
+        self.fill_maps[file_id] = json.dumps({"error": False, "status": 200,
+                                              "meta": {"images": document.get("images", {})}}).encode()
+        self.projects.setdefault(project_id, []).append({"key": file_id, "name": document.get("name", file_id)})
+    
+    def asset_body(self, path: str) -> bytes:
+        """Deterministic, per-URL unique image bytes (a small SVG document for .svg renders)."""
+        seed = hashlib.sha256(path.encode()).digest()
+        if path.endswith(".svg"):
+            return (f'<svg width="24" height="24" viewBox="0 0 24 24" fill="none" xmlns="http://www.w3.org/2000/svg">'
+                    f'<path d="M{seed[0] % 24} {seed[1] % 24}L{seed[2] % 24} {seed[3] % 24}Z" fill="#333"/>'
+                    f'</svg>').encode()
+        header = b"\x89PNG\r\n\x1a\n" + seed
+        return (header + seed * (self.asset_bytes // len(seed) + 1))[:max(self.asset_bytes, len(header))]
+    
+    def s3_signature_valid(self, method: str, path: str, headers) -> bool:
+        """Check an AWS Signature V4 Authorization header against S3_ACCESS_KEY/S3_SECRET_KEY."""
+        match = re.fullmatch(r"AWS4-HMAC-SHA256 Credential=([^/]+)/(\d{8})/([^/]+)/s3/aws4_request, "
+                             r"SignedHeaders=([a-z0-9;-]+), Signature=([0-9a-f]{64})",
+                             headers.get("Authorization", ""))
+        if match is None:
+            return False
+        access_key, day, region, names, signature = match.groups()
+        names = names.split(";")
+        amz_date = headers.get("x-amz-date", "")
+        payload_hash = headers.get("x-amz-content-sha256")
+        if (access_key != self.S3_ACCESS_KEY or not amz_date.startswith(day) or payload_hash is None
+                or not {"host", "x-amz-date", "x-amz-content-sha256"} <= set(names)):
+            return False
+        parsed = urlparse(path)
+        canonical = "\n".join([method, parsed.path, parsed.query,
+                               "".join(f"{name}:{(headers.get(name) or '').strip()}\n" for name in names),
+                               ";".join(names), payload_hash])
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, f"{day}/{region}/s3/aws4_request",
+                                    hashlib.sha256(canonical.encode()).hexdigest()])
+        key = f"AWS4{self.S3_SECRET_KEY}".encode()
+        for part in (day, region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        expected = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+    
+    def _handler_class(self):
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; with Nagle on, a
+            # keep-alive client waits on delayed ACKs for every response
+            disable_nagle_algorithm = True
+            
+            def log_message(self, *args) -> None:
+                pass
+            
+            def _send(self, status: int, body: bytes, content_type: str = "application/json",
+                      headers: Optional[Dict[str, str]] = None) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if not server.bandwidth:
+                    self.wfile.write(body)
+                    return
+                chunk_size = 64 * 1024
+                for start in range(0, len(body), chunk_size):
+                    chunk = body[start:start + chunk_size]
+                    self.wfile.write(chunk)
+                    time.sleep(len(chunk) / server.bandwidth)
+            
+            def do_GET(self) -> None:
+                parsed = urlparse(self.path)
+                parts = parsed.path.strip("/").split("/")
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                
+                is_cdn = parts[0] == "cdn"
+                if server.error_rate and random.random() < server.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    if is_cdn:
+                        return self._send(503, b"{}")
+                    return self._send(429, b'{"status": 429, "err": "Rate limited"}',
+                                      headers={"Retry-After": f"{server.retry_after:g}"})
+                
+                if is_cdn:
+                    return self._send(200, server.asset_body(parsed.path), "image/png",
+                                      {"ETag": f'"{hashlib.md5(parsed.path.encode()).hexdigest()}"'})
+                if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "images":
+                    body = server.fill_maps.get(parts[2])
+                    return self._send(200, body) if body else self._send(404, b'{"status": 404}')
+                if parts[:2] == ["v1", "projects"] and len(parts) == 4 and parts[3] == "files":
+                    files = server.projects.get(parts[2])
+                    if files is None:
+                        return self._send(404, b'{"status": 404}')
+                    return self._send(200, json.dumps({"name": parts[2], "files": files}).encode())
+                if parts[:2] == ["v1", "teams"] and len(parts) == 4 and parts[3] == "projects":
+                    projects = [{"id": project_id, "name": project_id} for project_id in server.projects]
+                    return self._send(200, json.dumps({"name": parts[2], "projects": projects}).encode())
+                if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "nodes":
+                    document = server.documents.get(parts[2])
+                    if document is None:
+                        return self._send(404, b'{"status": 404}')
+                    wanted = set(parse_qs(parsed.query).get("ids", [""])[0].split(","))
+                    nodes = {}
+                    stack = [document["document"]]
+                    while stack and len(nodes) < len(wanted):
+                        node = stack.pop()
+                        if node["id"] in wanted:
+                            nodes[node["id"]] = {"document": node}
+                        else:
+                            stack.extend(node.get("children", ()))
+                    meta = {key: document[key] for key in ("name", "version", "lastModified")}
+                    return self._send(200, json.dumps(dict(meta, nodes=nodes)).encode())
+                if parts[:2] == ["v1", "files"] and len(parts) == 3:
+                    document = server.documents.get(parts[2])
+                    if document is None:
+                        return self._send(404, b'{"status": 404}')
+                    if parse_qs(parsed.query).get("depth") == ["1"]:
+                        root = document["document"]
+                        pages = [{key: value for key, value in page.items() if key != "children"}
+                                 for page in root.get("children", ())]
+                        shallow = dict(document, document=dict(root, children=pages))
+                        shallow.pop("images", None)
+                        return self._send(200, json.dumps(shallow).encode())
+                    return self._send(200, server.files[parts[2]])
+                if parts[:2] == ["v1", "images"] and len(parts) == 3:
+                    query = parse_qs(parsed.query)
+                    ids = query.get("ids", [""])[0].split(",")
+                    fmt = query.get("format", ["png"])[0]
+                    images = {node_id: f"{server.url}/cdn/render/{parts[2]}/{node_id.replace(':', '-')}.{fmt}"
+                              for node_id in ids if node_id}
+                    return self._send(200, json.dumps({"err": None, "images": images}).encode())
+                return self._send(404, b'{"status": 404}')
+            
+            def do_PUT(self) -> None:
+                with server._lock:
+                    server.requests += 1
+                length = self.headers.get("Content-Length")
+                if length is None or self.headers.get("Transfer-Encoding"):
+                    # S3 refuses chunked uploads without a declared length
+                    self.close_connection = True
+                    return self._s3_reject(411, "MissingContentLength")
+                body = self.rfile.read(int(length))
+                if len(body) != int(length):
+                    self.close_connection = True
+                    return self._s3_reject(400, "IncompleteBody")
+                if not server.s3_signature_valid("PUT", self.path, self.headers):
+                    return self._s3_reject(403, "SignatureDoesNotMatch")
+                payload_hash = self.headers["x-amz-content-sha256"]
+                digest = hashlib.sha256(body).hexdigest()
+                if payload_hash != "UNSIGNED-PAYLOAD" and payload_hash != digest:
+                    return self._s3_reject(400, "XAmzContentSHA256Mismatch")
+                key = unquote(urlparse(self.path).path)
+                source = self.headers.get("x-amz-copy-source")
+                with server._lock:
+                    stored = (len(body), digest) if source is None else server.objects.get(unquote(source))
+                    if stored is not None:
+                        server.objects[key] = stored
+                if stored is None:
+                    return self._s3_reject(404, "NoSuchKey")
+                return self._send(200, b"", "application/xml")
+            
+            def _s3_reject(self, status: int, code: str) -> None:
+                with server._lock:
+                    server.s3_rejected += 1
+                return self._send(status, f"<Error><Code>{code}</Code></Error>".encode(), "application/xml")
+        
+        return Handler
+    
+    def start(self) -> "MockFigmaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB.
+    
+    On Linux this is VmHWM, which starts afresh at exec. ru_maxrss also
+    counts the parent's peak from before the fork, so every case would
+    report at least the memory of the process that launched it.
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(benchmark: str, file_id: str, api_url: str, concurrency: int,
+             rate_limited: bool = False) -> Dict:
+    """Run one benchmark in this process and return its measurements.
+    
+    Unless rate_limited, the client-side Figma API rate limits are lifted so
+    the numbers reflect the downloader rather than the token buckets.
+    """
+    rate_limits = None if rate_limited else {endpoint: None for endpoint in figma.HTTPTransport.RATE_LIMITS}
+    downloader = figma.FigmaAssetDownloader("benchmark-token", concurrency=concurrency,
+                                            base_url=f"{api_url}/v1", rate_limits=rate_limits)
+    result: Dict = {"baseline_rss_mb": round(_peak_rss_mb(), 1)}
+    devnull = open(os.devnull, "w")
+    
+    try:
+        if benchmark == "parse":
+            start = time.perf_counter()
+            file_data = downloader.get_file_data(file_id)
+            result["seconds"] = time.perf_counter() - start
+            index = downloader.build_node_index(file_data["document"])
+            result["nodes"] = len(index)
+        
+        elif benchmark == "parse_stream":
+            if figma.ijson is None:
+                return {"skipped": "ijson is not installed"}
+            start = time.perf_counter()
+            index = downloader.stream_node_index(file_id, {})
+            result["seconds"] = time.perf_counter() - start
+            result["nodes"] = len(index)
+        
+        elif benchmark == "traverse":
+            document = downloader.get_file_data(file_id)["document"]
+            start = time.perf_counter()
+            index = downloader.build_node_index(document)
+            exportable = downloader.exportable_nodes(index)
+            result["seconds"] = time.perf_counter() - start
+            result["nodes"] = len(index)
+            result["image_fills"] = len(index.image_assets)
+            result["exportable"] = len(exportable)
+        
+        elif benchmark == "resolve":
+            file_data = downloader.get_file_data(file_id)
+            index = downloader.build_node_index(file_data.pop("document"))
+            node_ids = [node["id"] for node in downloader.exportable_nodes(index)]
+            refs = list(index.by_image_ref)
+            start = time.perf_counter()
+            with redirect_stdout(devnull):
+                fill_urls = downloader.get_image_fill_urls(file_data, refs, file_id)
+                render_urls = downloader.get_image_urls(file_id, node_ids, downloader.render_costs(index, node_ids))
+            result["seconds"] = time.perf_counter() - start
+            result["nodes"] = len(index)
+            result["fill_urls"] = sum(1 for url in fill_urls.values() if url)
+            result["render_urls"] = sum(1 for url in render_urls.values() if url)
+        
+        elif benchmark in ("download", "download_page"):
+            # download_page exports only the first page, fetched with /files/:id/nodes
+            selector = figma.NodeSelector(pages=["Page 0"]) if benchmark == "download_page" else None
+            with tempfile.TemporaryDirectory(prefix="figma-bench-") as output_dir:
+                start = time.perf_counter()
+                with redirect_stdout(devnull):
+                    downloader.download_assets(file_id, output_dir, use_cache=False, resume=False,
+                                               selector=selector)
+                result["seconds"] = time.perf_counter() - start
+                files = [path for path in Path(output_dir).rglob("*") if path.is_file()
+                         and path.name != figma.DuplicateIndex.FILE_NAME]
+                total_bytes = sum(path.stat().st_size for path in files)
+            result["assets"] = len(files)
+            result["bytes"] = total_bytes
+            result["assets_per_second"] = len(files) / result["seconds"] if result["seconds"] else None
+            result["mb_per_second"] = total_bytes / (1 << 20) / result["seconds"] if result["seconds"] else None
+            result["phases"] = downloader.metrics.report()["phases"]
+        
+        elif benchmark in ICON_BENCHMARKS:
+            # The same icons rendered one by one, or packed into an SVG sprite
+            atlas = figma.IconAtlas("svg") if benchmark == "download_atlas" else None
+            with tempfile.TemporaryDirectory(prefix="figma-bench-") as output_dir:
+                start = time.perf_counter()
+                with redirect_stdout(devnull):
+                    downloader.download_assets(file_id, output_dir, use_cache=False, resume=False, atlas=atlas)
+                result["seconds"] = time.perf_counter() - start
+                files = [path for path in Path(output_dir).rglob("*") if path.is_file()
+                         and path.parent.name in ("frames", "images", "icons")]
+            result["assets"] = len(files)
+            result["downloads"] = downloader.metrics.report()["counters"].get("assets_downloaded")
+            result["phases"] = downloader.metrics.report()["phases"]
+        
+        elif benchmark == "download_s3":
+            # The download benchmark streamed into the mock's object store instead of a directory
+            os.environ.update(AWS_ACCESS_KEY_ID=MockFigmaServer.S3_ACCESS_KEY,
+                              AWS_SECRET_ACCESS_KEY=MockFigmaServer.S3_SECRET_KEY)
+            os.environ.pop("AWS_SESSION_TOKEN", None)
+            with tempfile.TemporaryDirectory(prefix="figma-bench-") as output_dir:
+                sink = figma.S3Sink(Path(output_dir), "bench", file_id, endpoint=api_url)
+                try:
+                    start = time.perf_counter()
+                    with redirect_stdout(devnull):
+                        result["failed"] = downloader.download_assets(file_id, output_dir, use_cache=False,
+                                                                      resume=False, sink=sink)
+                    result["seconds"] = time.perf_counter() - start
+                finally:
+                    sink.close()
+                result["local_files"] = sum(1 for path in Path(output_dir).rglob("*") if path.is_file())
+            report = downloader.metrics.report()
+            result["downloads"] = report["counters"].get("assets_downloaded")
+            total_bytes = report["counters"].get("bytes_downloaded", 0)
+            result["mb_per_second"] = total_bytes / (1 << 20) / result["seconds"] if result["seconds"] else None
+            result["phases"] = report["phases"]
+        
+        else:
+            raise ValueError(f"Unknown benchmark: {benchmark}")
+    finally:
+        devnull.close()
+        downloader.transport.close()
+    
+    result["retries"] = downloader.transport.retries
+    if "nodes" in result and result.get("seconds"):
+        result["nodes_per_second"] = result["nodes"] / result["seconds"]
+    result["peak_rss_mb"] = round(_peak_rss_mb(), 1)
+    return result
+
+
+def _run_case_subprocess(benchmark: str, file_id: str, api_url: str, concurrency: int,
+                         rate_limited: bool = False) -> Dict:
+    """Run one case in a fresh interpreter so its peak memory is measured alone."""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as handle:
+        result_path = handle.name
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--run-case", benchmark,
+                   "--file-id", file_id, "--api-url", api_url,
+                   "--concurrency", str(concurrency), "--result-file", result_path]
+        if rate_limited:
+            command.append("--rate-limited")
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else
+                    f"exit status {completed.returncode}"}
+        with open(result_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark download_figma_assets.py against a local mock Figma API",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python benchmark_figma_assets.py
+  python benchmark_figma_assets.py --sizes 1000,100000,1000000 --benchmarks parse,parse_stream,traverse
+  python benchmark_figma_assets.py --benchmarks download --latency 0.05 --bandwidth 5000000 --error-rate 0.02
+        """
+    )
+    
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000",
+        help="Comma-separated synthetic document sizes in nodes (default: 1000,10000)"
+    )
+    
+    parser.add_argument(
+        "--benchmarks",
+        default=",".join(BENCHMARKS),
+        help=f"Comma-separated benchmarks to run (default: {','.join(BENCHMARKS)})"
+    )
+    
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="Mock server latency per request in seconds (default: 0.02)"
+    )
+    
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.0,
+        help="Mock server bandwidth per connection in bytes/s (default: unthrottled)"
+    )
+    
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of mock requests answered with 429/503 (default: 0)"
+    )
+    
+    parser.add_argument(
+        "--asset-bytes",
+        type=int,
+        default=50_000,
+        help="Size of each mock CDN image in bytes (default: 50000)"
+    )
+    
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Downloader worker pool size (default: 8)"
+    )
+    
+    parser.add_argument(
+        "--rate-limited",
+        action="store_true",
+        help="Keep the downloader's default Figma API rate limits (default: lifted)"
+    )
+    
+    parser.add_argument(
+        "--icon-export-ratio",
+        type=float,
+        default=0.5,
+        help="Fraction of icons with export settings in the download_icons/download_atlas document (default: 0.5)"
+    )
+    
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the synthetic documents (default: 0)"
+    )
+    
+    parser.add_argument(
+        "--output",
+        help="Write the JSON results to this file instead of stdout"
+    )
+    
+    # Internal: run a single case in this process (used by the subprocess runner)
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--file-id", help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    
+    args = parser.parse_args()
+    
+    if args.run_case:
+        result = run_case(args.run_case, args.file_id, args.api_url, args.concurrency, args.rate_limited)
+        with open(args.result_file, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+    
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    benchmarks = [name.strip() for name in args.benchmarks.split(",") if name.strip()]
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    
+    server = MockFigmaServer(latency=args.latency, bandwidth=args.bandwidth,
+                             error_rate=args.error_rate, asset_bytes=args.asset_bytes).start()
+    results = []
+    try:
+        for size in sizes:
+            file_id = f"bench{size}"
+            start = time.perf_counter()
+            server.add_file(file_id, generate_document(size, seed=args.seed, base_url=f"{server.url}/cdn"))
+            print(f"📄 Generated {size}-node document ({len(server.files[file_id]) / (1 << 20):.1f} MB JSON) "
+                  f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            
+            if set(benchmarks) & set(ICON_BENCHMARKS):
+                server.add_file(f"{file_id}-icons",
+                                generate_document(size, seed=args.seed, base_url=f"{server.url}/cdn",
+                                                  icon_export_ratio=args.icon_export_ratio))
+            
+            for benchmark in benchmarks:
+                requests_before = server.requests
+                case_file_id = f"{file_id}-icons" if benchmark in ICON_BENCHMARKS else file_id
+                result = _run_case_subprocess(benchmark, case_file_id, server.url, args.concurrency,
+                                              args.rate_limited)
+                result.update({"benchmark": benchmark, "size": size,
+                               "server_requests": server.requests - requests_before})
+                if benchmark == "download_s3":
+                    result.update({"s3_objects": len(server.objects), "s3_rejected": server.s3_rejected})
+                    server.objects.clear()
+                    server.s3_rejected = 0
+                results.append(result)
+                summary = f"{result['seconds']:.3f}s" if "seconds" in result else result.get("error") or result.get("skipped")
+                print(f"  ⏱️  {benchmark:<13} {summary}  (peak RSS {result.get('peak_rss_mb', '?')} MB)",
+                      file=sys.stderr)
+            
+            for case_file_id in (file_id, f"{file_id}-icons"):
+                if case_file_id in server.files:
+                    del server.files[case_file_id], server.fill_maps[case_file_id]
+                    del server.documents[case_file_id]
+            server.projects.clear()
+    finally:
+        server.stop()
+    
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: getattr(args, key) for key in ("latency", "bandwidth", "error_rate",
+                                                           "asset_bytes", "concurrency", "rate_limited", "seed")},
+        },
+        "results": results,
+    }
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+        print(f"📊 Results written to {args.output}", file=sys.stderr)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
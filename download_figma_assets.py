@@ -8,26 +8,2512 @@ Usage:
 """
 
 import argparse
+import base64
+import bisect
+import copy
+import fnmatch
+import hashlib
+import hmac
+import io
+import ipaddress
+import marshal
+import math
 import os
+import random
 import re
+import shutil
+import tarfile
+import tempfile
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+import zipfile
 import requests
 import json
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import List, Dict, Optional
-from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Iterator, List, Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs, quote
+
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx  # Optional: only needed for --http2
+except ImportError:
+    httpx = None
+
+try:
+    import ijson  # Optional: only needed for --stream
+except ImportError:
+    ijson = None
+
+try:
+    from PIL import Image, features as pil_features  # Optional: only needed for --optimize
+except ImportError:
+    Image = None
+    pil_features = None
+
+
+_read_buffers = threading.local()
+
+
+def _read_buffer() -> bytearray:
+    """This thread's reusable 1 MB buffer for reading files."""
+    buffer = getattr(_read_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _read_buffers.buffer = bytearray(1 << 20)
+    return buffer
+
+
+def _iter_file(filepath: Path) -> Iterator[memoryview]:
+    """The contents of filepath in 1 MB slices of one reused buffer.
+    
+    Each slice is only valid until the next one is read.
+    """
+    buffer = _read_buffer()
+    view = memoryview(buffer)
+    with open(filepath, "rb", buffering=0) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                return
+            yield view[:count]
+
+
+class _ChunkReader:
+    """File-like read() over an iterator of byte chunks, for incremental parsers."""
+    
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        # Start of the unread part of _buffer, so reads don't copy the rest
+        self._offset = 0
+    
+    def read(self, size: int = -1) -> bytes:
+        available = len(self._buffer) - self._offset
+        if size < 0 or available < size:
+            parts = [self._buffer[self._offset:]] if available else []
+            while size < 0 or available < size:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                parts.append(chunk)
+                available += len(chunk)
+            self._buffer = parts[0] if len(parts) == 1 else b"".join(parts)
+            self._offset = 0
+        end = len(self._buffer) if size < 0 else self._offset + size
+        data = self._buffer[self._offset:end]
+        self._offset = end
+        return data
+
+
+class _HTTP2Response:
+    """Adapts a streamed httpx response to the parts of requests.Response we use."""
+    
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+    
+    @property
+    def content(self) -> bytes:
+        return self._response.read()
+    
+    @property
+    def text(self) -> str:
+        self._response.read()
+        return self._response.text
+    
+    def json(self) -> Any:
+        self._response.read()
+        return self._response.json()
+    
+    def iter_content(self, chunk_size: int = 8192) -> Iterator[bytes]:
+        return self._response.iter_bytes(chunk_size)
+    
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} Error for url: {self.url}", response=self
+            )
+    
+    def close(self) -> None:
+        self._response.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second in bursts of up to `capacity`.
+    
+    A server-imposed pause (e.g. from Retry-After) can be applied with
+    pause(), which holds back every thread sharing the bucket.
+    """
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+    
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for the given number of seconds."""
+        with self._lock:
+            resume_at = time.monotonic() + seconds
+            if resume_at > self._paused_until:
+                self._paused_until = resume_at
+                self._updated = resume_at
+                self._tokens = 0.0
+
+
+class HTTPTransport:
+    """Pooled keep-alive HTTP transport shared by API calls and image downloads.
+    
+    Connections are kept alive in per-host pools sized for the download worker
+    pool, so thousands of small assets reuse a handful of TLS connections
+    instead of paying a fresh handshake each. With ``http2=True`` (requires
+    ``httpx[http2]``) requests are multiplexed over HTTP/2 connections instead.
+    
+    Requests tagged with an endpoint name draw from that endpoint's token
+    bucket (see RATE_LIMITS), and 429/5xx responses and connection errors are
+    retried with jittered exponential backoff, honouring Retry-After.
+    Throttling (429, or 503 with Retry-After) also pauses the endpoint's bucket.
+    """
+    
+    # Default per-endpoint budgets: (requests per second, burst size).
+    # None means unlimited.
+    RATE_LIMITS = {
+        "files": (0.5, 2),
+        "images": (1.0, 3),
+        "fills": (1.0, 3),
+        "cdn": None,
+    }
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    
+    def __init__(self, pool_maxsize: int = 10, pool_connections: int = 10,
+                 connect_timeout: float = 10.0, read_timeout: float = 60.0,
+                 http2: bool = False, max_retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, rate_limits: Optional[Dict[str, Optional[Tuple[float, float]]]] = None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self._retries_lock = threading.Lock()
+        # Called as observer(endpoint, seconds, status) after every attempt;
+        # seconds is the time to response headers, status 0 a connection error
+        self.observer: Optional[Callable[[Optional[str], float, int], None]] = None
+        
+        self.buckets: Dict[str, TokenBucket] = {}
+        limits = dict(self.RATE_LIMITS)
+        limits.update(rate_limits or {})
+        for endpoint, limit in limits.items():
+            if limit:
+                self.buckets[endpoint] = TokenBucket(*limit)
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        self._http2_client = None
+        if http2:
+            if httpx is None:
+                print("⚠️  --http2 requires 'httpx[http2]'; falling back to HTTP/1.1 keep-alive")
+            else:
+                self._http2_client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=pool_connections * pool_maxsize,
+                                        max_keepalive_connections=pool_maxsize),
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    follow_redirects=True,
+                )
+    
+    def _send(self, url: str, params: Optional[Dict], headers: Optional[Dict], stream: bool):
+        if self._http2_client is not None:
+            request = self._http2_client.build_request("GET", url, params=params, headers=headers)
+            return _HTTP2Response(self._http2_client.send(request, stream=True))
+        return self.session.get(url, params=params, headers=headers, stream=stream,
+                                timeout=self.timeout)
+    
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before retry number `attempt` (0-based)."""
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                # Small jitter so waiting workers don't all return at once
+                return max(0.0, delay) + random.uniform(0, self.backoff_base)
+        # Full jitter: uniform over [0, base * 2^attempt], capped
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    @staticmethod
+    def is_throttled(response) -> bool:
+        """Whether response asks the client to slow down rather than reporting a failure."""
+        return response.status_code == 429 or (response.status_code == 503
+                                                and response.headers.get("Retry-After") is not None)
+    
+    def _connection_errors(self) -> Tuple[type, ...]:
+        errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        if self._http2_client is not None:
+            errors += (httpx.TransportError,)
+        return errors
+    
+    def get(self, url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None,
+            stream: bool = False, endpoint: Optional[str] = None,
+            retry_statuses: Optional[Tuple[int, ...]] = None):
+        """Issue a GET through the pool, rate limited and retried per endpoint.
+        
+        Use as a context manager when streaming. Once retries are exhausted
+        the last response is returned for the caller's raise_for_status().
+        Throttled responses (see is_throttled) are always retried;
+        retry_statuses replaces RETRY_STATUSES for the other failures, for
+        callers that handle some of them better themselves.
+        """
+        if retry_statuses is None:
+            retry_statuses = self.RETRY_STATUSES
+        bucket = self.buckets.get(endpoint) if endpoint else None
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = self._send(url, params, headers, stream)
+            except self._connection_errors():
+                if self.observer is not None:
+                    self.observer(endpoint, time.perf_counter() - started, 0)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                if self.observer is not None:
+                    self.observer(endpoint, time.perf_counter() - started, response.status_code)
+                throttled = self.is_throttled(response)
+                if (response.status_code not in retry_statuses and not throttled) or attempt >= self.max_retries:
+                    return response
+                delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                response.close()
+                if throttled and bucket is not None:
+                    # Rate limited: hold back every worker using this endpoint
+                    bucket.pause(delay)
+            
+            with self._retries_lock:
+                self.retries += 1
+            attempt += 1
+            time.sleep(delay)
+    
+    def close(self) -> None:
+        """Close all pooled connections."""
+        self.session.close()
+        if self._http2_client is not None:
+            self._http2_client.close()
+
+
+class NodeIndex:
+    """Index over a Figma document, built in a single pass without recursion.
+    
+    The walk runs the image-fill detector and an export filter on each node,
+    and only the nodes they match (plus the root) become records: id, type,
+    name, parent, depth, visible, exportSettings, absoluteBoundingBox and
+    the instance fields componentId, componentProperties, overrides. Every
+    other node just adds its id to node_ids and its type to type_totals, so
+    detectors, breakdown counts and the check for removed nodes all query
+    the index instead of walking the tree again. A record's subtree_hash and
+    subtree_size are worked out on demand from the in-memory subtree
+    (from_document) or folded in while streaming (from_stream), and kept on
+    the record once known.
+    """
+    
+    RECORD_KEYS = ("type", "name", "visible", "exportSettings", "absoluteBoundingBox", "componentId",
+                   "componentProperties", "overrides")
+    # Properties that don't change how a node renders. Position enters the
+    # hash only relative to the parent (see subtree_hash), so moving a frame
+    # around the canvas keeps its hash.
+    HASH_EXCLUDED_KEYS = frozenset(("id", "name", "children", "absoluteBoundingBox", "absoluteRenderBounds",
+                                    "relativeTransform", "pluginData", "sharedPluginData", "exportSettings"))
+    
+    def __init__(self):
+        self.records: Dict[str, Dict] = {}
+        self.order: List[str] = []
+        self.top_level: List[str] = []
+        self.by_type: Dict[str, List[str]] = {}
+        self.by_image_ref: Dict[str, List[str]] = {}
+        self.image_assets: List[Dict] = []
+        self.root_id: Optional[str] = None
+        # Nodes indexed only as ancestors of what a NodeSelector picked
+        self.unselected: set = set()
+        # Every indexed node, record or not
+        self.node_ids: set = set()
+        self.type_totals: Dict[str, int] = {}
+        # In-memory node behind each record (from_document), and the roots
+        # of subtrees a selector pruned, for subtree hashes and sizes
+        self._nodes: Dict[str, Dict] = {}
+        self._pruned: set = set()
+    
+    @classmethod
+    def own_hash(cls, node: Dict) -> str:
+        """Hash of a node's own properties (not its children, position or name)."""
+        properties = {key: value for key, value in node.items() if key not in cls.HASH_EXCLUDED_KEYS}
+        box = node.get("absoluteBoundingBox")
+        if box:
+            properties["size"] = (round(box.get("width", 0), 2), round(box.get("height", 0), 2))
+        canonical = json.dumps(properties, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+    
+    @classmethod
+    def _record(cls, node: Dict, node_id: str, parent_id: Optional[str], depth: int) -> Dict:
+        record = {key: node[key] for key in cls.RECORD_KEYS if key in node}
+        record["id"] = node_id
+        record["parent"] = parent_id
+        record["depth"] = depth
+        return record
+    
+    def _add_assets(self, node_id: str, image_assets: List[Dict]) -> None:
+        for asset in image_assets:
+            self.image_assets.append(asset)
+            refs = self.by_image_ref.setdefault(asset["imageRef"], [])
+            if not refs or refs[-1] != node_id:
+                refs.append(node_id)
+    
+    @classmethod
+    def from_document(cls, document: Dict, image_detector=None,
+                      keep: Optional[Callable[[Dict], bool]] = None,
+                      selector: Optional["NodeSelector"] = None) -> "NodeIndex":
+        """Build the index from an in-memory tree using an explicit stack (pre-order).
+        
+        Nodes with image fills and the selected nodes keep accepts get
+        records. With a selector, subtrees it rules out are skipped without
+        being walked.
+        """
+        index = cls()
+        records, order, nodes, by_type = index.records, index.order, index._nodes, index.by_type
+        node_ids, totals, unselected, top_level = index.node_ids, index.type_totals, index.unselected, index.top_level
+        detect = image_detector or (lambda node: None)
+        keep = keep or (lambda node: False)
+        root_scope = NodeSelector.ROOT
+        # Open levels, outermost first: (remaining siblings, parent id, depth, parent scope)
+        stack: List[Tuple[Iterator[Dict], Optional[str], int, Any]] = [(iter((document,)), None, 0, root_scope)]
+        while stack:
+            siblings, parent_id, depth, parent_scope = stack[-1]
+            for node in siblings:
+                node_id = node.get("id", "no-id")
+                if selector is None:
+                    scope = root_scope
+                    selected = True
+                else:
+                    scope = selector.scope(node.get("name", ""), depth, parent_scope)
+                    if scope is None:
+                        index._pruned.add(node_id)
+                        continue
+                    selected = scope[1]
+                    if not selected:
+                        unselected.add(node_id)
+                node_ids.add(node_id)
+                node_type = node.get("type", "UNKNOWN")
+                totals[node_type] = totals.get(node_type, 0) + 1
+                if depth == 1:
+                    top_level.append(node_id)
+                image_assets = detect(node) if selected else None
+                if image_assets or (selected and keep(node)) or parent_id is None:
+                    records[node_id] = cls._record(node, node_id, parent_id, depth)
+                    order.append(node_id)
+                    nodes[node_id] = node
+                    by_type.setdefault(node_type, []).append(node_id)
+                    if parent_id is None:
+                        index.root_id = node_id
+                    if image_assets:
+                        index._add_assets(node_id, image_assets)
+                children = node.get("children")
+                if children:
+                    # Descend; the rest of the siblings follow once the children are done
+                    stack.append((iter(children), node_id, depth + 1, scope))
+                    break
+            else:
+                stack.pop()
+        return index
+    
+    @classmethod
+    def from_stream(cls, nodes: Iterator[Tuple[Dict, Optional[str], int, List[Dict]]], image_detector=None,
+                    keep: Optional[Callable[[Dict], bool]] = None,
+                    selector: Optional["NodeSelector"] = None, hashed: bool = True) -> "NodeIndex":
+        """Build the index from (node, parent_id, depth, ancestors) in post-order.
+        
+        Each node is run through image_detector as it completes and then
+        dropped. Its subtree hash and size are folded from those of its
+        children, which have all completed by then, into its record if it
+        gets one. The tree is gone afterwards, so hashes can't be worked
+        out later: without hashed, records get sizes only. Memory grows with
+        the records and the open ancestors, not with the file. Records are
+        put back in document (pre-)order, as from_document would list them.
+        """
+        index = cls()
+        totals = index.type_totals
+        # Completed children of the open node at each depth:
+        # (x, y, subtree hash, subtree size or 0 when pruned, streamed size)
+        completed: Dict[int, List[Tuple[float, float, Optional[str], int, int]]] = {}
+        # Scope of each open ancestor by depth, as (ancestor, scope)
+        scopes: Dict[int, Tuple[Dict, Any]] = {}
+        positions: Dict[str, int] = {}
+        assets_by_node: Dict[str, List[Dict]] = {}
+        top_level: List[Tuple[int, str]] = []
+        streamed = 0
+        
+        for node, parent_id, depth, ancestors in nodes:
+            children = completed.pop(depth + 1, ())
+            box = node.get("absoluteBoundingBox") or {}
+            streamed_size = 1 + sum(child[4] for child in children)
+            position = streamed - streamed_size + 1 + depth  # Nodes started before this one
+            streamed += 1
+            
+            scope = NodeSelector.ROOT
+            if selector is not None:
+                for level, ancestor in enumerate(ancestors):
+                    cached = scopes.get(level)
+                    if cached is not None and cached[0] is ancestor:
+                        scope = cached[1]
+                        continue
+                    if scope is not None:
+                        scope = selector.scope(ancestor.get("name", ""), level, scope)
+                    scopes[level] = (ancestor, scope)
+                if scope is not None:
+                    scope = selector.scope(node.get("name", ""), depth, scope)
+            if scope is None:
+                if parent_id is not None:
+                    completed.setdefault(depth, []).append((0, 0, None, 0, streamed_size))
+                continue
+            
+            digest = hashlib.blake2b(cls.own_hash(node).encode(), digest_size=16) if hashed else None
+            size = 1
+            for x, y, child_hash, child_size, _ in children:
+                if not child_size:
+                    continue
+                if digest is not None:
+                    offset = (round(x - box.get("x", 0), 2), round(y - box.get("y", 0), 2))
+                    digest.update(f"|{offset[0]},{offset[1]}:{child_hash}".encode())
+                size += child_size
+            subtree_hash = digest.hexdigest() if digest is not None else None
+            if parent_id is not None:
+                completed.setdefault(depth, []).append(
+                    (box.get("x", 0), box.get("y", 0), subtree_hash, size, streamed_size))
+            
+            node_id = node.get("id", "no-id")
+            node_type = node.get("type", "UNKNOWN")
+            index.node_ids.add(node_id)
+            totals[node_type] = totals.get(node_type, 0) + 1
+            if depth == 1:
+                top_level.append((position, node_id))
+            selected = selector is None or scope[1]
+            if not selected:
+                index.unselected.add(node_id)
+            image_assets = image_detector(node) if image_detector is not None and selected else None
+            if not (image_assets or parent_id is None or (selected and keep is not None and keep(node))):
+                continue
+            
+            record = cls._record(node, node_id, parent_id, depth)
+            if subtree_hash is not None:
+                record["subtree_hash"] = subtree_hash
+            record["subtree_size"] = size
+            index.records[node_id] = record
+            positions[node_id] = position
+            if parent_id is None:
+                index.root_id = node_id
+            if image_assets:
+                assets_by_node[node_id] = image_assets
+        
+        index.order = sorted(positions, key=positions.get)
+        for node_id in index.order:
+            index.by_type.setdefault(index.records[node_id].get("type", "UNKNOWN"), []).append(node_id)
+            if node_id in assets_by_node:
+                index._add_assets(node_id, assets_by_node[node_id])
+        index.top_level = [node_id for _, node_id in sorted(top_level)]
+        return index
+    
+    def node(self, node_id: str) -> Optional[Dict]:
+        """The in-memory node behind a record, if the index was built from a document."""
+        return self._nodes.get(node_id)
+    
+    def find(self, predicate) -> List[Dict]:
+        """Return the records matching predicate, in index order."""
+        records = self.records
+        return [records[node_id] for node_id in self.order if predicate(records[node_id])]
+    
+    def _fold(self, node_id: str, hashed: bool) -> Dict:
+        """Work out a record's subtree size (and hash, if hashed) from its in-memory subtree.
+        
+        Walks the subtree without recursion, reusing what is already known
+        for records below it, and keeps the result on every record it passes.
+        """
+        records = self.records
+        record = records[node_id]
+        wanted = "subtree_hash" if hashed else "subtree_size"
+        if wanted in record:
+            return record
+        if node_id not in self._nodes:
+            raise KeyError(f"no subtree available for node {node_id}")
+        
+        def open_frame(node: Dict) -> List:
+            digest = hashlib.blake2b(self.own_hash(node).encode(), digest_size=16) if hashed else None
+            return [node, 0, digest, 1]
+        
+        def fold(frame: List, child: Dict, child_hash: Optional[str], child_size: int) -> None:
+            frame[3] += child_size
+            if frame[2] is not None:
+                box = frame[0].get("absoluteBoundingBox") or {}
+                child_box = child.get("absoluteBoundingBox") or {}
+                offset = (round(child_box.get("x", 0) - box.get("x", 0), 2),
+                          round(child_box.get("y", 0) - box.get("y", 0), 2))
+                frame[2].update(f"|{offset[0]},{offset[1]}:{child_hash}".encode())
+        
+        # Open nodes, outermost first: [node, next child, digest, size]
+        frames = [open_frame(self._nodes[node_id])]
+        while frames:
+            frame = frames[-1]
+            children = frame[0].get("children") or ()
+            if frame[1] < len(children):
+                child = children[frame[1]]
+                frame[1] += 1
+                child_id = child.get("id", "no-id")
+                if child_id in self._pruned:
+                    continue
+                known = records.get(child_id)
+                if known is not None and wanted in known:
+                    fold(frame, child, known.get("subtree_hash"), known["subtree_size"])
+                else:
+                    frames.append(open_frame(child))
+                continue
+            frames.pop()
+            node, _, digest, size = frame
+            subtree_hash = digest.hexdigest() if digest is not None else None
+            known = records.get(node.get("id", "no-id"))
+            if known is not None:
+                known["subtree_size"] = size
+                if subtree_hash is not None:
+                    known["subtree_hash"] = subtree_hash
+            if frames:
+                fold(frames[-1], node, subtree_hash, size)
+        return record
+    
+    def subtree_size(self, node_id: str) -> int:
+        """Number of nodes in the subtree rooted at node_id (including itself)."""
+        if node_id not in self.records:
+            return 1
+        return self._fold(node_id, hashed=False)["subtree_size"]
+    
+    def subtree_hash(self, node_id: str) -> str:
+        """Merkle hash of the subtree rooted at node_id.
+        
+        Combines the node's own hash with each child's offset from the node
+        and the child's subtree hash, so it changes exactly when something
+        inside the subtree changes, and identical subtrees anywhere in the
+        file hash the same.
+        """
+        return self._fold(node_id, hashed=True)["subtree_hash"]
+    
+    STATE_KEYS = ("records", "order", "top_level", "by_type", "by_image_ref", "image_assets", "root_id",
+                  "unselected", "node_ids", "type_totals")
+    
+    def to_state(self) -> Dict:
+        """The index as plain containers (see DocumentCache).
+        
+        The tree isn't saved, so every record's subtree hash is worked out first.
+        """
+        for node_id in self.order:
+            self._fold(node_id, hashed=True)
+        return {key: getattr(self, key) for key in self.STATE_KEYS}
+    
+    @classmethod
+    def from_state(cls, state: Dict) -> "NodeIndex":
+        """Rebuild an index saved with to_state."""
+        index = cls()
+        for key in cls.STATE_KEYS:
+            setattr(index, key, state[key])
+        return index
+    
+    def type_counts(self) -> Dict[str, int]:
+        """Number of indexed nodes per node type."""
+        return dict(self.type_totals)
+    
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+
+class NodeSelector:
+    """Which part of a document to export.
+    
+    Patterns are shell globs, or regular expressions when prefixed with
+    "re:". Pages and paths ("Page/Frame/Child", one pattern per segment)
+    choose subtrees: a node is selected when its path matches one of them
+    or it lies below one that does, and a node whose path cannot lead to a
+    match is pruned along with its subtree. exclude prunes matching nodes
+    and everything under them, max_depth prunes below that many levels
+    under the page (top-level frames are depth 1). include, types and
+    min_size then filter which of the selected nodes are exported. Node
+    ids, pages and (the first segment of) paths let the file be fetched
+    with /files/:id/nodes instead of as a whole.
+    """
+    
+    # Scope of the document node: (path, selected)
+    ROOT: Tuple[Tuple[str, ...], bool] = ((), False)
+    
+    def __init__(self, pages: Optional[List[str]] = None, paths: Optional[List[str]] = None,
+                 include: Optional[List[str]] = None, exclude: Optional[List[str]] = None,
+                 types: Optional[List[str]] = None, max_depth: Optional[int] = None,
+                 min_size: Optional[Tuple[float, float]] = None, node_ids: Optional[List[str]] = None):
+        self.pages = list(pages or [])
+        self.paths = list(paths or [])
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.types = {node_type.upper() for node_type in types or ()}
+        self.max_depth = max_depth
+        self.min_size = min_size
+        self.node_ids = list(node_ids or [])
+        
+        self._path_patterns = [[self._compile(page)] for page in self.pages]
+        self._path_patterns += [[self._compile(part) for part in path.strip("/").split("/")]
+                                for path in self.paths]
+        self._include = [self._compile(pattern) for pattern in self.include]
+        self._exclude = [self._compile(pattern) for pattern in self.exclude]
+    
+    @staticmethod
+    def _compile(pattern: str) -> Callable[[str], bool]:
+        if pattern.startswith("re:"):
+            regex = re.compile(pattern[3:])
+            return lambda name: regex.search(name) is not None
+        return lambda name: fnmatch.fnmatchcase(name, pattern)
+    
+    @property
+    def active(self) -> bool:
+        return bool(self.pages or self.paths or self.include or self.exclude or self.types
+                    or self.max_depth is not None or self.min_size or self.node_ids)
+    
+    def fingerprint(self) -> str:
+        """Short stable hash of the selection (keys cached documents)."""
+        spec = [self.pages, self.paths, self.include, self.exclude, sorted(self.types),
+                self.max_depth, self.min_size, self.node_ids]
+        return hashlib.sha1(json.dumps(spec).encode()).hexdigest()[:12]
+    
+    def without_paths(self) -> "NodeSelector":
+        """The same filters with the page and path patterns dropped."""
+        return NodeSelector(include=self.include, exclude=self.exclude, types=list(self.types),
+                            max_depth=self.max_depth, min_size=self.min_size, node_ids=self.node_ids)
+    
+    def matches_page(self, name: str) -> bool:
+        """Whether a page may hold selected nodes (always True without page/path patterns)."""
+        return not self._path_patterns or any(pattern[0](name) for pattern in self._path_patterns)
+    
+    @property
+    def narrows_pages(self) -> bool:
+        return bool(self._path_patterns)
+    
+    def scope(self, name: str, depth: int, parent_scope: Tuple[Tuple[str, ...], bool]
+              ) -> Optional[Tuple[Tuple[str, ...], bool]]:
+        """Scope of a node given its parent's, or None to prune its subtree.
+        
+        depth is the node's depth in the document (pages are 1).
+        """
+        if depth == 0:
+            return self.ROOT
+        if self._exclude and any(pattern(name) for pattern in self._exclude):
+            return None
+        if self.max_depth is not None and depth - 1 > self.max_depth:
+            return None
+        parent_path, parent_selected = parent_scope
+        if parent_selected or not self._path_patterns:
+            return (), True
+        path = parent_path + (name,)
+        on_the_way = False
+        for pattern in self._path_patterns:
+            if len(pattern) < len(path) or not all(part(segment) for part, segment in zip(pattern, path)):
+                continue
+            if len(pattern) == len(path):
+                return (), True
+            on_the_way = True
+        return (path, False) if on_the_way else None
+    
+    def matches(self, record: Dict) -> bool:
+        """Whether a selected node passes the include, type and size filters."""
+        if self.types and record.get("type", "") not in self.types:
+            return False
+        if self._include and not any(pattern(record.get("name", "")) for pattern in self._include):
+            return False
+        if self.min_size:
+            box = record.get("absoluteBoundingBox") or {}
+            if (box.get("width") or 0) < self.min_size[0] or (box.get("height") or 0) < self.min_size[1]:
+                return False
+        return True
+
+
+class ExportPlan:
+    """Formats and scales each exported node is rendered at.
+    
+    A node's own exportSettings (format, suffix and a SCALE, WIDTH or HEIGHT
+    constraint) are used when it has any, unless use_export_settings is
+    False; every other node is rendered in each default format at each
+    default scale. Vector formats ignore the scale. A variant is
+    (format, scale, suffix), and each (format, scale) pair is rendered once
+    per node.
+    """
+    
+    FORMATS = ("png", "jpg", "svg", "pdf")
+    VECTOR_FORMATS = ("svg", "pdf")
+    MIN_SCALE, MAX_SCALE = 0.01, 4.0     # Accepted by /v1/images
+    # What every node was rendered at before export plans; these outputs
+    # keep their original names and cache slots
+    LEGACY_VARIANT = ("png", 2.0, "")
+    
+    def __init__(self, formats: Tuple[str, ...] = ("png",), scales: Tuple[float, ...] = (2.0,),
+                 use_export_settings: bool = True):
+        unknown = [fmt for fmt in formats if fmt not in self.FORMATS]
+        if unknown or not formats:
+            raise ValueError(f"Unsupported export format(s): {', '.join(unknown) or 'none given'} "
+                             f"(expected {', '.join(self.FORMATS)})")
+        if not scales:
+            raise ValueError("At least one export scale is required")
+        self.formats = tuple(formats)
+        self.scales = tuple(self._clamp(scale) for scale in scales)
+        self.use_export_settings = use_export_settings
+        # Several default scales are told apart by an @<scale>x suffix
+        tag_scales = len(set(self.scales)) > 1
+        self.defaults = self._unique([
+            (fmt, scale, f"@{scale:g}x" if tag_scales and fmt not in self.VECTOR_FORMATS else "")
+            for fmt in self.formats for scale in self.scales
+        ])
+    
+    @classmethod
+    def _clamp(cls, scale: float) -> float:
+        return round(min(cls.MAX_SCALE, max(cls.MIN_SCALE, float(scale))), 3)
+    
+    def _unique(self, variants: List[Tuple[str, float, str]]) -> List[Tuple[str, float, str]]:
+        """Drop repeated (format, scale) pairs and give clashing file names a scale suffix."""
+        result = []
+        seen = set()
+        names = set()
+        for fmt, scale, suffix in variants:
+            if fmt in self.VECTOR_FORMATS:
+                scale = 1.0
+            if (fmt, scale) in seen:
+                continue
+            seen.add((fmt, scale))
+            if (suffix, fmt) in names:
+                suffix = f"{suffix}@{scale:g}x"
+            names.add((suffix, fmt))
+            result.append((fmt, scale, suffix))
+        return result
+    
+    def variants(self, record: Dict) -> List[Tuple[str, float, str]]:
+        """The (format, scale, suffix) variants to render a node at."""
+        settings = record.get("exportSettings") if self.use_export_settings else None
+        if not settings:
+            return self.defaults
+        box = record.get("absoluteBoundingBox") or {}
+        variants = []
+        for setting in settings:
+            fmt = str(setting.get("format", "PNG")).lower()
+            if fmt not in self.FORMATS:
+                continue
+            constraint = setting.get("constraint") or {}
+            value = constraint.get("value") or 1
+            if constraint.get("type") == "WIDTH" and box.get("width"):
+                value = value / box["width"]
+            elif constraint.get("type") == "HEIGHT" and box.get("height"):
+                value = value / box["height"]
+            variants.append((fmt, self._clamp(value), setting.get("suffix") or ""))
+        return self._unique(variants) or self.defaults
+    
+    @classmethod
+    def variant_slot(cls, slot: str, variant: Tuple[str, float, str]) -> str:
+        """Cache slot of one variant of the output in slot."""
+        fmt, scale, suffix = variant
+        if (fmt, scale, suffix) == cls.LEGACY_VARIANT:
+            return slot
+        return f"{slot}:{fmt}@{scale:g}x"
+    
+    @staticmethod
+    def base_slot(slot: str) -> str:
+        """The slot a variant_slot was made from."""
+        return re.sub(r":[a-z]+@[0-9.e+-]+x$", "", slot)
+    
+    def describe(self) -> str:
+        return ", ".join(fmt if fmt in self.VECTOR_FORMATS else f"{fmt}@{scale:g}x"
+                         for fmt, scale, _suffix in self.defaults)
+
+
+class IconAtlas:
+    """Packs small vector icons into one SVG symbol sprite and/or one PNG atlas.
+    
+    An icon is a visible shape node (VECTOR, BOOLEAN_OPERATION, STAR, ...)
+    with export settings that fits in max_size x max_size. Icons are fetched
+    as SVG (for the sprite) and as PNG at scale (for the atlas) in bulk
+    instead of one render per node, and written as icons/sprite.svg,
+    icons/atlas.png and an icons/icons.json lookup of symbol ids, atlas
+    coordinates and node ids. Icons with identical SVG share one symbol.
+    """
+    
+    MODES = ("svg", "png", "both")
+    ICON_TYPES = ("VECTOR", "BOOLEAN_OPERATION", "STAR", "LINE", "ELLIPSE", "REGULAR_POLYGON", "RECTANGLE")
+    SPRITE_NAME = "sprite.svg"
+    ATLAS_NAME = "atlas.png"
+    LOOKUP_NAME = "icons.json"
+    
+    def __init__(self, mode: str = "both", max_size: float = 64, scale: float = 2.0, padding: int = 2):
+        if mode not in self.MODES:
+            raise ValueError(f"Unsupported atlas mode: {mode} (expected {', '.join(self.MODES)})")
+        self.mode = mode
+        self.max_size = max_size
+        self.scale = ExportPlan._clamp(scale)
+        self.padding = padding
+    
+    def wants(self, record: Dict) -> bool:
+        """Whether a node goes into the atlas instead of being rendered on its own."""
+        box = record.get("absoluteBoundingBox") or {}
+        return (record.get("type") in self.ICON_TYPES and bool(record.get("exportSettings"))
+                and record.get("visible", True)
+                and 0 < box.get("width", 0) <= self.max_size and 0 < box.get("height", 0) <= self.max_size)
+    
+    def variants(self) -> List[Tuple[str, float]]:
+        """The (format, scale) renders each icon needs."""
+        variants = []
+        if self.mode in ("svg", "both"):
+            variants.append(("svg", 1.0))
+        if self.mode in ("png", "both") and Image is not None:
+            variants.append(("png", self.scale))
+        return variants
+    
+    @staticmethod
+    def _symbol(svg: bytes, symbol_id: str) -> Tuple[str, str]:
+        """(<symbol> element, viewBox) for one icon's SVG, with its ids made unique."""
+        text = svg.decode("utf-8", "replace")
+        match = re.search(r"<svg\b([^>]*)>(.*)</svg>", text, re.S)
+        if match is None:
+            raise ValueError("not an SVG document")
+        attributes = dict(re.findall(r'([\w:-]+)="([^"]*)"', match.group(1)))
+        view_box = attributes.get("viewBox") or f"0 0 {attributes.get('width', 0)} {attributes.get('height', 0)}"
+        kept = "".join(f' {name}="{value}"' for name, value in attributes.items()
+                       if name not in ("width", "height", "viewBox", "xmlns", "xmlns:xlink", "version", "x", "y"))
+        # Figma names gradients and clip paths paint0_linear_..., clip0_...
+        # in every file, so prefix them with the symbol id
+        inner = match.group(2)
+        ids = set(re.findall(r'\bid="([^"]+)"', inner))
+        inner = re.sub(r'(\bid="|url\(#|href="#)([^")]+)',
+                       lambda m: f"{m.group(1)}{symbol_id}-{m.group(2)}" if m.group(2) in ids else m.group(0),
+                       inner)
+        return f'<symbol id="{symbol_id}" viewBox="{view_box}"{kept}>{inner.strip()}</symbol>', view_box
+    
+    def _pack(self, sizes: List[Tuple[str, int, int]]) -> Tuple[Dict[str, Tuple[int, int]], int, int]:
+        """Shelf-pack (id, width, height) boxes; returns (positions, atlas width, atlas height)."""
+        padding = self.padding
+        area = sum((width + padding) * (height + padding) for _id, width, height in sizes)
+        atlas_width = max(max(width for _id, width, _height in sizes),
+                          math.ceil(math.sqrt(area)))
+        positions = {}
+        x = y = shelf_height = 0
+        for symbol_id, width, height in sorted(sizes, key=lambda item: (-item[2], -item[1], item[0])):
+            if x and x + width > atlas_width:
+                x, y = 0, y + shelf_height + padding
+                shelf_height = 0
+            positions[symbol_id] = (x, y)
+            x += width + padding
+            shelf_height = max(shelf_height, height)
+        return positions, atlas_width, y + shelf_height
+    
+    def build(self, icons: List[Tuple[Dict, Dict[str, bytes]]]
+              ) -> Tuple[Dict[str, bytes], List[Tuple[str, Optional[str]]]]:
+        """Contents of the sprite, atlas and lookup for icons, by file name.
+        
+        icons holds (node record, {format: render}) pairs in document order;
+        the order decides which icon gets a plain symbol id when names repeat.
+        Returns (files, skipped) where skipped lists (node id, file name) for
+        renders that didn't decode. The file name is None when the icon was
+        left out altogether, or the atlas PNG when only that render was
+        unreadable and the icon kept its symbol and lookup entry.
+        """
+        symbols: Dict[str, Dict] = {}
+        nodes: Dict[str, str] = {}
+        by_content: Dict[str, str] = {}
+        elements = []
+        images = {}
+        skipped = []
+        for record, renders in icons:
+            content = hashlib.sha256(renders.get("svg") or renders.get("png", b"")).hexdigest()
+            symbol_id = by_content.get(content)
+            if symbol_id is None:
+                base = re.sub(r"[^a-z0-9]+", "-", record.get("name", "").lower()).strip("-") or "icon"
+                symbol_id = base
+                counter = 2
+                while symbol_id in symbols:
+                    symbol_id = f"{base}-{counter}"
+                    counter += 1
+                box = record.get("absoluteBoundingBox") or {}
+                entry = {"name": record.get("name"), "width": round(box.get("width", 0), 2),
+                         "height": round(box.get("height", 0), 2), "nodeIds": []}
+                element = image = None
+                try:
+                    if "svg" in renders:
+                        element, entry["viewBox"] = self._symbol(renders["svg"], symbol_id)
+                        entry["svg"] = f"{self.SPRITE_NAME}#{symbol_id}"
+                except Exception:
+                    skipped.append((record["id"], None))
+                    continue
+                try:
+                    if "png" in renders:
+                        image = Image.open(io.BytesIO(renders["png"]))
+                        image.load()
+                except Exception:
+                    image = None
+                    if element is None:
+                        skipped.append((record["id"], None))
+                        continue
+                    # The SVG symbol still works; only the atlas goes without
+                    skipped.append((record["id"], self.ATLAS_NAME))
+                if element is not None:
+                    elements.append(element)
+                if image is not None:
+                    images[symbol_id] = image
+                symbols[symbol_id] = entry
+                by_content[content] = symbol_id
+            symbols[symbol_id]["nodeIds"].append(record["id"])
+            nodes[record["id"]] = symbol_id
+        
+        files = {}
+        lookup = {"version": 1, "sprite": None, "atlas": None, "icons": symbols, "nodes": nodes}
+        if elements:
+            files[self.SPRITE_NAME] = ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+                                       + "\n".join(elements) + "\n</svg>\n").encode("utf-8")
+            lookup["sprite"] = self.SPRITE_NAME
+        if images:
+            positions, width, height = self._pack([(symbol_id, image.width, image.height)
+                                                   for symbol_id, image in images.items()])
+            atlas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+            for symbol_id, image in images.items():
+                x, y = positions[symbol_id]
+                atlas.paste(image.convert("RGBA"), (x, y))
+                symbols[symbol_id].update({"x": x, "y": y, "w": image.width, "h": image.height})
+            buffer = io.BytesIO()
+            atlas.save(buffer, "PNG", optimize=True)
+            files[self.ATLAS_NAME] = buffer.getvalue()
+            lookup["atlas"] = {"path": self.ATLAS_NAME, "width": width, "height": height, "scale": self.scale}
+        files[self.LOOKUP_NAME] = json.dumps(lookup, indent=1, ensure_ascii=False).encode("utf-8")
+        return files, skipped
+
+
+class ImageRefIndex:
+    """Hash and prefix index over an imageRef -> URL map.
+    
+    Exact refs resolve with one dict lookup. Refs that only partially match
+    (a ref that is a prefix of a stored key, or a stored key that is a
+    prefix of the ref) resolve with a binary search over the sorted keys and
+    a set lookup per ref prefix, instead of scanning every key.
+    """
+    
+    def __init__(self, images: Dict[str, str]):
+        self.images = images
+        self._sorted_keys = sorted(images)
+    
+    def lookup(self, image_ref: str) -> Optional[str]:
+        """Return the URL for image_ref, or None if nothing matches."""
+        url = self.images.get(image_ref)
+        if url is not None:
+            return url
+        
+        # A stored key that extends this ref
+        position = bisect.bisect_left(self._sorted_keys, image_ref)
+        if position < len(self._sorted_keys) and self._sorted_keys[position].startswith(image_ref):
+            return self.images[self._sorted_keys[position]]
+        
+        # A stored key that this ref extends (longest first)
+        for end in range(len(image_ref) - 1, 0, -1):
+            url = self.images.get(image_ref[:end])
+            if url is not None:
+                return url
+        return None
+
+
+class AssetCache:
+    """Content-addressed store of downloaded assets with a persistent manifest.
+    
+    Each downloaded file is stored once under objects/<sha256[:2]>/<sha256>,
+    and manifest.json maps a cache key to that blob. Keys identify what was
+    downloaded: "fill:<imageRef>" for image fills (an imageRef is itself a
+    content hash) and "render:<subtreeHash>:<format>@<scale>x" for node
+    renders (see NodeIndex.subtree_hash). A re-run restores any known key from the store instead of
+    fetching it. The manifest also remembers which output path each asset
+    slot (e.g. a node's render in frames/) was written to, so a changed
+    asset replaces its old file instead of landing next to it as "_1".
+    """
+    
+    MANIFEST_NAME = "manifest.json"
+    
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.manifest_path = self.cache_dir / self.MANIFEST_NAME
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict] = {}
+        self.outputs: Dict[str, str] = {}
+        if self.manifest_path.exists():
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                self.entries = manifest.get("entries", {})
+                self.outputs = manifest.get("outputs", {})
+            except (OSError, ValueError) as e:
+                print(f"⚠️  Ignoring unreadable cache manifest {self.manifest_path}: {e}")
+    
+    def _blob_path(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / digest
+    
+    @staticmethod
+    def _hash_file(filepath: Path) -> str:
+        digest = hashlib.sha256()
+        for chunk in _iter_file(filepath):
+            digest.update(chunk)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _link_or_copy(source: Path, destination: Path) -> None:
+        """Hard-link source to destination (copying across filesystems), replacing it atomically."""
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        # Per-thread temp name: several files may store the same blob at once
+        temp_path = destination.with_name(f".{destination.name}.{threading.get_ident()}.tmp")
+        if temp_path.exists():
+            temp_path.unlink()
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copy2(source, temp_path)
+        os.replace(temp_path, destination)
+    
+    def previous_path(self, slot: str) -> Optional[Path]:
+        """Output path the asset in slot was written to last time, if any."""
+        with self._lock:
+            path = self.outputs.get(slot)
+        return Path(path) if path else None
+    
+    def _matches(self, filepath: Path, entry: Dict, blob: Path) -> bool:
+        """Whether filepath already holds the blob for entry."""
+        if not filepath.exists():
+            return False
+        if os.path.samefile(filepath, blob):
+            return True
+        return filepath.stat().st_size == entry["size"] and self._hash_file(filepath) == entry["sha256"]
+    
+    def restore(self, key: str, filepath: Path, slot: Optional[str] = None) -> bool:
+        """Make filepath hold the cached asset for key. Returns False on a cache miss."""
+        with self._lock:
+            entry = self.entries.get(key)
+        if not entry:
+            return False
+        blob = self._blob_path(entry["sha256"])
+        if not blob.exists():
+            return False
+        
+        try:
+            if not self._matches(filepath, entry, blob):
+                self._link_or_copy(blob, filepath)
+        except OSError:
+            return False
+        
+        if slot:
+            with self._lock:
+                self.outputs[slot] = str(filepath)
+        return True
+    
+    def store(self, key: str, filepath: Path, slot: Optional[str] = None,
+              content: Optional["ContentDigest"] = None) -> Dict:
+        """Add a freshly downloaded file to the store under key.
+        
+        content, if the file was hashed as it was written, saves reading it again.
+        """
+        if content is not None:
+            digest, size = content.hexdigest(), content.size
+        else:
+            digest, size = self._hash_file(filepath), filepath.stat().st_size
+        blob = self._blob_path(digest)
+        if not blob.exists():
+            self._link_or_copy(filepath, blob)
+        entry = {"sha256": digest, "size": size}
+        with self._lock:
+            self.entries[key] = entry
+            if slot:
+                self.outputs[slot] = str(filepath)
+        return entry
+    
+    def blob_for(self, key: str) -> Optional[Path]:
+        """Stored blob for key, or None on a cache miss."""
+        with self._lock:
+            entry = self.entries.get(key)
+        blob = self._blob_path(entry["sha256"]) if entry else None
+        return blob if blob is not None and blob.exists() else None
+    
+    def remember_output(self, slot: str, filepath: Path) -> None:
+        """Record where the asset in slot was written this run."""
+        with self._lock:
+            self.outputs[slot] = str(filepath)
+    
+    @contextmanager
+    def storing(self, key: str, slot: Optional[str] = None, filepath: Optional[Path] = None,
+                content: Optional["ContentDigest"] = None):
+        """Yield a tee for a chunk iterator; what passes through is stored under key.
+        
+        The chunks are hashed (into content, if given) and written to the
+        store as they go by, and the entry is added only if the block completes.
+        """
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = self.objects_dir / f".incoming.{threading.get_ident()}.tmp"
+        content = content if content is not None else ContentDigest()
+        f = open(temp_path, "wb")
+        
+        def tee(chunks: Iterator[bytes]) -> Iterator[bytes]:
+            for chunk in chunks:
+                content.update(chunk)
+                f.write(chunk)
+                yield chunk
+        
+        try:
+            yield tee
+            f.close()
+            blob = self._blob_path(content.hexdigest())
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temp_path, blob)
+            with self._lock:
+                self.entries[key] = {"sha256": content.hexdigest(), "size": content.size}
+                if slot and filepath is not None:
+                    self.outputs[slot] = str(filepath)
+        finally:
+            f.close()
+            temp_path.unlink(missing_ok=True)
+    
+    def prune_outputs(self, prefix: str, active_slots: set, root: Path,
+                      in_file: Callable[[str], bool]) -> int:
+        """Delete the outputs of slots under prefix whose node or fill is gone from the file.
+        
+        in_file tells from a slot name (without prefix) whether what it was
+        made for is still in the file; outputs this run merely didn't
+        produce (left out by flags) stay. Slots recorded before slots were
+        namespaced ("frames/node:..." with no file prefix) are forgotten if
+        they point under root, but their files are only deleted if no active
+        slot uses them. Returns the number of files deleted.
+        """
+        root = Path(root).resolve()
+        removed = 0
+        with self._lock:
+            active_paths = {self.outputs[slot] for slot in active_slots if slot in self.outputs}
+            for slot, path in list(self.outputs.items()):
+                legacy = slot.startswith(("images/", "frames/"))
+                if not (slot.startswith(prefix) or legacy) or slot in active_slots:
+                    continue
+                filepath = Path(path)
+                try:
+                    filepath.resolve().relative_to(root)
+                except ValueError:
+                    continue
+                if in_file(slot if legacy else slot[len(prefix):]):
+                    if legacy:
+                        del self.outputs[slot]
+                    continue
+                del self.outputs[slot]
+                if path not in active_paths and filepath.exists():
+                    filepath.unlink()
+                    removed += 1
+        return removed
+    
+    def save(self) -> None:
+        """Write the manifest atomically."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Held throughout, since several files syncing at once share one cache
+        with self._lock:
+            payload = json.dumps({"version": 1, "entries": self.entries, "outputs": self.outputs},
+                                 indent=1, sort_keys=True)
+            temp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(temp_path, self.manifest_path)
+
+
+class DocumentCache:
+    """Compressed per-file cache of the parsed document, keyed by file version.
+    
+    Stores the file's top-level metadata and its NodeIndex (not the raw
+    JSON) as zlib-compressed marshal data under <cache>/documents/, which
+    loads several times faster than parsing and indexing the JSON again. The
+    header records the format, the index schema and the interpreter's
+    marshal tag; an entry that does not match is treated as a miss. The
+    latest entry per file is also kept in memory, so a long-running process
+    (see FigmaWatcher) reuses the parsed index without touching the disk.
+    """
+    
+    FORMAT = 5
+    DIR_NAME = "documents"
+    
+    def __init__(self, cache_dir: Path):
+        self.directory = Path(cache_dir) / self.DIR_NAME
+        schema = f"{self.FORMAT}:{sys.implementation.cache_tag}:{','.join(NodeIndex.RECORD_KEYS)}"
+        self._header = b"FIGDOC " + hashlib.sha1(schema.encode()).hexdigest().encode() + b"\n"
+        self._memory: Dict[str, Tuple[Dict, NodeIndex]] = {}
+    
+    def _path(self, file_id: str) -> Path:
+        return self.directory / f"{re.sub(r'[^A-Za-z0-9_-]', '_', file_id)}.bin"
+    
+    def load(self, file_id: str, version: Optional[str]) -> Optional[Tuple[Dict, NodeIndex]]:
+        """Return (file metadata, index) if the cached copy is at version, else None."""
+        if not version:
+            return None
+        in_memory = self._memory.get(file_id)
+        if in_memory is not None and in_memory[0].get("version") == version:
+            return dict(in_memory[0]), in_memory[1]
+        path = self._path(file_id)
+        if not path.exists():
+            return None
+        try:
+            with open(path, "rb") as f:
+                if f.readline() != self._header:
+                    return None
+                payload = marshal.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, EOFError, TypeError, zlib.error):
+            return None
+        if payload.get("meta", {}).get("version") != version:
+            return None
+        meta, index = payload["meta"], NodeIndex.from_state(payload["index"])
+        self._memory[file_id] = (meta, index)
+        return dict(meta), index
+    
+    def store(self, file_id: str, meta: Dict, index: NodeIndex) -> None:
+        """Save the metadata (without "document") and index for the next run."""
+        if not meta.get("version") or not len(index):
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta = {key: value for key, value in meta.items() if key != "document"}
+        state = index.to_state()
+        # A copy without the document tree the index may still hold
+        self._memory[file_id] = (meta, NodeIndex.from_state(state))
+        try:
+            data = zlib.compress(marshal.dumps({"meta": meta, "index": state}), 6)
+        except ValueError:
+            return  # Something marshal can't represent; just skip caching
+        path = self._path(file_id)
+        temp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(self._header)
+            f.write(data)
+        os.replace(temp_path, path)
+
+
+class DownloadJournal:
+    """Crash-safe, append-only record of the downloads in a run.
+    
+    Every asset slot gets "planned", "started" (with the response ETag),
+    "completed" (with its size) or "failed" lines in a JSON-lines file,
+    flushed as they happen. If the process dies, the next run reads the
+    journal back to skip completed assets, reuse their output paths, and
+    resume partial downloads with an HTTP Range request guarded by If-Range.
+    A run that finishes without failures deletes the journal.
+    """
+    
+    FILE_NAME = ".figma_journal.jsonl"
+    
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.state: Dict[str, Dict] = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line from a crash
+                    self.state.setdefault(entry["slot"], {}).update(entry)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+    
+    def __len__(self) -> int:
+        return len(self.state)
+    
+    def record(self, event: str, slot: str, **fields) -> None:
+        """Append an event for an asset slot and flush it to disk."""
+        entry = {"event": event, "slot": slot}
+        entry.update(fields)
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self.state.setdefault(slot, {}).update(entry)
+            self._file.write(line)
+            self._file.flush()
+    
+    def path_for(self, slot: str) -> Optional[Path]:
+        """Output path the slot was assigned in the interrupted run, if any."""
+        entry = self.state.get(slot)
+        return Path(entry["path"]) if entry and entry.get("path") else None
+    
+    def is_completed(self, slot: str, key: Optional[str], filepath: Path) -> bool:
+        """Whether the slot finished downloading the same asset to filepath."""
+        entry = self.state.get(slot)
+        if not entry or entry.get("event") != "completed" or entry.get("key") != key:
+            return False
+        if entry.get("path") != str(filepath) or not filepath.exists():
+            return False
+        return filepath.stat().st_size == entry.get("size")
+    
+    def resume_etag(self, slot: str, key: Optional[str]) -> Optional[str]:
+        """ETag of a partially downloaded slot, used to validate a Range resume."""
+        entry = self.state.get(slot)
+        if entry and entry.get("event") in ("started", "failed") and entry.get("key") == key:
+            return entry.get("etag")
+        return None
+    
+    def close(self, clean: bool = False) -> None:
+        """Close the journal, deleting it when the run completed cleanly."""
+        with self._lock:
+            self._file.close()
+        if clean:
+            self.path.unlink(missing_ok=True)
+
+
+class DuplicateIndex:
+    """Byte-level (and optionally perceptual) deduplication of a run's output files.
+    
+    Every finished asset is registered with its SHA-256. The first file with a
+    given digest is canonical; later byte-identical files are replaced by hard
+    links to it (copies across filesystems), so each unique blob is stored once
+    in the output tree. With perceptual=True (requires Pillow) a 64-bit
+    difference hash of each raster image is also kept, and visually
+    near-identical files are reported, but never linked. The groups are written
+    to duplicates.json in the output directory.
+    """
+    
+    FILE_NAME = "duplicates.json"
+    PERCEPTUAL_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp")
+    
+    def __init__(self, output_dir: Path, perceptual: bool = False, max_distance: int = 4):
+        self.path = Path(output_dir) / self.FILE_NAME
+        self.perceptual = perceptual and Image is not None
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self.paths_by_digest: Dict[str, List[str]] = {}
+        self.dhashes: List[Tuple[int, str]] = []
+        self.similar: Dict[str, List[Tuple[str, int]]] = {}
+        self.linked = 0
+        self.bytes_saved = 0
+    
+    @staticmethod
+    def difference_hash(filepath: Path) -> Optional[int]:
+        """64-bit dHash: brightness gradients of a 9x8 grayscale thumbnail."""
+        try:
+            with Image.open(filepath) as image:
+                pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+        except Exception:
+            return None
+        value = 0
+        for row in range(8):
+            for column in range(8):
+                value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+        return value
+    
+    def add(self, filepath: Path, digest: Optional[str] = None) -> Optional[Path]:
+        """Register a finished file; returns the canonical path it was linked to, if any."""
+        if digest is None:
+            digest = AssetCache._hash_file(filepath)
+        path = str(filepath)
+        with self._lock:
+            paths = self.paths_by_digest.setdefault(digest, [])
+            if path in paths:
+                return None
+            paths.append(path)
+            canonical = Path(paths[0]) if len(paths) > 1 else None
+        
+        if canonical is not None:
+            try:
+                if not os.path.samefile(canonical, filepath):
+                    size = filepath.stat().st_size
+                    AssetCache._link_or_copy(canonical, filepath)
+                    with self._lock:
+                        self.linked += 1
+                        self.bytes_saved += size
+            except OSError:
+                pass
+            return canonical
+        
+        if self.perceptual and filepath.suffix.lower() in self.PERCEPTUAL_SUFFIXES:
+            dhash = self.difference_hash(filepath)
+            if dhash is not None:
+                with self._lock:
+                    for other_hash, other_path in self.dhashes:
+                        distance = bin(dhash ^ other_hash).count("1")
+                        if distance <= self.max_distance:
+                            self.similar.setdefault(other_path, []).append((path, distance))
+                            break
+                    else:
+                        self.dhashes.append((dhash, path))
+        return None
+    
+    def save(self) -> None:
+        """Write the duplicate groups atomically (removing a stale file if there are none)."""
+        with self._lock:
+            identical = {digest: paths for digest, paths in self.paths_by_digest.items() if len(paths) > 1}
+            similar = {path: [{"path": other, "distance": distance} for other, distance in matches]
+                       for path, matches in self.similar.items()}
+        if not identical and not similar:
+            self.path.unlink(missing_ok=True)
+            return
+        payload = json.dumps({"version": 1, "identical": identical, "similar": similar},
+                             indent=1, sort_keys=True)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(temp_path, self.path)
+
+
+def read_image_size(header: bytes) -> Optional[Dict]:
+    """Format and pixel size from the first bytes of a PNG, JPEG, GIF, WebP or SVG file.
+    
+    Returns None if the format is unknown or header is too short to tell.
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24:
+        return {"format": "png", "width": int.from_bytes(header[16:20], "big"),
+                "height": int.from_bytes(header[20:24], "big")}
+    if header[:6] in (b"GIF87a", b"GIF89a") and len(header) >= 10:
+        return {"format": "gif", "width": int.from_bytes(header[6:8], "little"),
+                "height": int.from_bytes(header[8:10], "little")}
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP" and len(header) >= 30:
+        chunk = header[12:16]
+        if chunk == b"VP8 ":
+            width, height = int.from_bytes(header[26:28], "little") & 0x3FFF, int.from_bytes(header[28:30], "little") & 0x3FFF
+        elif chunk == b"VP8L":
+            bits = int.from_bytes(header[21:25], "little")
+            width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        elif chunk == b"VP8X":
+            width, height = int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+        else:
+            return None
+        return {"format": "webp", "width": width, "height": height}
+    if header[:2] == b"\xff\xd8":
+        # Walk the segments up to the first start-of-frame marker
+        position = 2
+        while position + 9 <= len(header):
+            if header[position] != 0xFF:
+                position += 1
+                continue
+            marker = header[position + 1]
+            if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                position += 1 if marker == 0xFF else 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return {"format": "jpg", "width": int.from_bytes(header[position + 7:position + 9], "big"),
+                        "height": int.from_bytes(header[position + 5:position + 7], "big")}
+            position += 2 + int.from_bytes(header[position + 2:position + 4], "big")
+        return None
+    text = header.lstrip()[:4096]
+    if text.startswith((b"<svg", b"<?xml")) and b"<svg" in text:
+        tag = text[text.index(b"<svg"):].split(b">", 1)[0].decode("utf-8", "replace")
+        width = re.search(r'\swidth="([\d.]+)(?:px)?"', tag)
+        height = re.search(r'\sheight="([\d.]+)(?:px)?"', tag)
+        if width and height:
+            return {"format": "svg", "width": round(float(width.group(1))), "height": round(float(height.group(1)))}
+        view_box = re.search(r'viewBox="[\d.+-]+[ ,]+[\d.+-]+[ ,]+([\d.]+)[ ,]+([\d.]+)"', tag)
+        if view_box:
+            return {"format": "svg", "width": round(float(view_box.group(1))), "height": round(float(view_box.group(2)))}
+        return {"format": "svg", "width": None, "height": None}
+    return None
+
+
+def image_placeholder(filepath: Path, size: int = 16) -> Optional[str]:
+    """Tiny blurred-up preview (LQIP) of a raster image as a PNG data URI, or None."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(filepath) as image:
+            image.draft("RGB", (size * 4, size * 4))  # JPEG decodes at reduced size
+            image.thumbnail((size, size))
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG", optimize=True)
+    except Exception:
+        return None
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class ContentDigest:
+    """SHA-256, size and leading bytes of a body, built up chunk by chunk as it is written.
+    
+    The asset cache, duplicate index and manifest take a download's digest
+    from here instead of reading the file back.
+    """
+    
+    HEADER_BYTES = 256 << 10    # Enough to reach the size of any JPEG with sane metadata
+    
+    def __init__(self):
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+        self.header = bytearray()
+    
+    @classmethod
+    def of_file(cls, filepath: Path) -> "ContentDigest":
+        """Digest of what is already in filepath (e.g. a partial download being resumed)."""
+        content = cls()
+        for chunk in _iter_file(filepath):
+            content.update(chunk)
+        return content
+    
+    def update(self, chunk: bytes) -> None:
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+        if len(self.header) < self.HEADER_BYTES:
+            self.header += chunk[:self.HEADER_BYTES - len(self.header)]
+    
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+
+class NameRegistry:
+    """Output names claimed in one run, compared case-insensitively.
+    
+    A name already claimed in this run gets the next free "_<n>" suffix.
+    Files left on disk by earlier runs are not probed, so names depend only
+    on the order assets are planned in (the document order) and stay the
+    same from run to run.
+    """
+    
+    def __init__(self):
+        self._taken: set = set()
+        self._lock = threading.Lock()
+    
+    def claim(self, filepath: Path) -> Path:
+        """Claim filepath, or the first free numbered variant of it."""
+        with self._lock:
+            candidate = filepath
+            counter = 1
+            while str(candidate).casefold() in self._taken:
+                candidate = filepath.with_name(f"{filepath.stem}_{counter}{filepath.suffix}")
+                counter += 1
+            self._taken.add(str(candidate).casefold())
+            return candidate
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._taken.clear()
+
+
+class AssetManifest:
+    """asset-manifest.json and a typed asset-manifest.ts describing every output of a run.
+    
+    Entries are keyed by asset slot ("frames/node:1:23", "frames/node:1:23:svg@1x"
+    for an extra export variant, "images/node:..." or "images/fill:<imageRef>"),
+    which stays the same between runs even if the file is renamed. Each
+    entry has the file's path (and src under public_path), pixel size, byte
+    size, sha256 and, with Pillow, a tiny data-URI placeholder (LQIP). The
+    download worker that wrote a file describes it; assets restored from the
+    cache reuse the previous manifest's description of the same content, or
+    are described in parallel when the manifest is saved.
+    """
+    
+    FILE_NAME = "asset-manifest.json"
+    TS_NAME = "asset-manifest.ts"
+    INFO_KEYS = ("format", "width", "height", "placeholder")
+    RASTER_FORMATS = ("png", "jpg", "gif", "webp")
+    
+    def __init__(self, output_dir: Path, public_path: str = "", placeholders: bool = True,
+                 keep_previous: bool = False):
+        self.output_dir = Path(output_dir)
+        self.path = self.output_dir / self.FILE_NAME
+        self.public_path = public_path.rstrip("/")
+        self.placeholders = placeholders and Image is not None
+        self.assets: Dict[str, Dict] = {}
+        self._known: Dict[str, Dict] = {}
+        self._pending: Dict[str, Path] = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    previous = json.load(f).get("assets", {})
+            except (OSError, ValueError):
+                previous = {}
+            for entry in previous.values():
+                if entry.get("sha256") and (entry.get("placeholder") or not self.placeholders
+                                            or entry.get("format") not in self.RASTER_FORMATS):
+                    self._known[entry["sha256"]] = {key: entry.get(key) for key in self.INFO_KEYS}
+            if keep_previous:
+                # A partial run leaves the other outputs in place, so keep their entries
+                self.assets = previous
+    
+    def describe(self, filepath: Path, header: Optional[bytes] = None) -> Dict:
+        """Format, pixel size and placeholder of a local image file.
+        
+        header, the file's first bytes if already at hand, saves reading them.
+        """
+        if header is None:
+            with open(filepath, "rb") as f:
+                header = f.read(ContentDigest.HEADER_BYTES)
+        info = read_image_size(header) or {}
+        info.setdefault("format", filepath.suffix.lstrip(".").lower() or None)
+        if self.placeholders and info.get("format") in self.RASTER_FORMATS:
+            info["placeholder"] = image_placeholder(filepath)
+        return {key: info.get(key) for key in self.INFO_KEYS}
+    
+    def add(self, key: str, path: str, source: Optional[Path], digest: Optional[str], size: Optional[int],
+            meta: Optional[Dict] = None, compute: bool = True, header: Optional[bytes] = None) -> None:
+        """Record an output at path (relative to the manifest), read from source if needed.
+        
+        With compute=False an unknown file is described later, in save().
+        header is the body's first bytes, if known (see ContentDigest); without
+        a source the pixel size is read from it and there is no placeholder.
+        """
+        info = self._known.get(digest) if digest else None
+        if info is None and source is None and header is not None:
+            size_info = read_image_size(header) or {}
+            info = {key: size_info.get(key) for key in self.INFO_KEYS}
+        if info is None and compute and source is not None:
+            try:
+                info = self.describe(source, header)
+            except OSError:
+                info = None
+            if info is not None and digest:
+                with self._lock:
+                    self._known[digest] = info
+        entry = {"path": path, "src": f"{self.public_path}/{path}" if self.public_path else path}
+        entry.update(info or {key: None for key in self.INFO_KEYS})
+        entry.update({"bytes": size, "sha256": digest})
+        entry.update(meta or {})
+        with self._lock:
+            self.assets[key] = entry
+            if info is None and source is not None:
+                self._pending[key] = source
+            else:
+                self._pending.pop(key, None)
+    
+    def add_alias(self, key: str, path: str, source_path: str, meta: Optional[Dict] = None) -> None:
+        """Record an output with the same content as the one already recorded at source_path."""
+        with self._lock:
+            source = next((entry for entry in self.assets.values() if entry["path"] == source_path), None)
+        entry = {"path": path, "src": f"{self.public_path}/{path}" if self.public_path else path}
+        for field in self.INFO_KEYS + ("bytes", "sha256"):
+            entry[field] = source.get(field) if source else None
+        entry.update(meta or {})
+        with self._lock:
+            self.assets[key] = entry
+    
+    def _typescript(self, assets: Dict[str, Dict]) -> str:
+        return (
+            "// Generated by download_figma_assets.py; do not edit.\n"
+            "export interface FigmaAsset {\n"
+            "  path: string;\n  src: string;\n  format: string | null;\n"
+            "  width: number | null;\n  height: number | null;\n  placeholder: string | null;\n"
+            "  bytes: number | null;\n  sha256: string | null;\n  nodeId?: string | null;\n"
+            "  name?: string | null;\n  type?: string | null;\n  scale?: number;\n  imageRef?: string;\n"
+            "}\n\n"
+            f"export const figmaAssets = {json.dumps(assets, indent=2, ensure_ascii=False)} as const "
+            "satisfies Record<string, FigmaAsset>;\n\n"
+            "export type FigmaAssetKey = keyof typeof figmaAssets;\n"
+        )
+    
+    def save(self, sink: Optional["OutputSink"] = None) -> None:
+        """Describe any files still pending, then write the JSON and TypeScript manifests."""
+        if self._pending:
+            pending = list(self._pending.items())
+            with ThreadPoolExecutor(max_workers=min(len(pending), os.cpu_count() or 4)) as executor:
+                described = executor.map(lambda item: self.describe(item[1]) if item[1].exists() else None, pending)
+                for (key, _source), info in zip(pending, described):
+                    if info is not None:
+                        self.assets[key].update(info)
+            self._pending.clear()
+        assets = dict(sorted(self.assets.items()))
+        documents = {self.FILE_NAME: json.dumps({"version": 1, "assets": assets}, indent=1, ensure_ascii=False),
+                     self.TS_NAME: self._typescript(assets)}
+        for name, text in documents.items():
+            target = self.output_dir / name
+            if sink is not None:
+                sink.write_stream(sink.name_for(target), iter([text.encode("utf-8")]))
+                continue
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            temp_path = target.with_name(target.name + ".tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(temp_path, target)
+
+
+class OutputSink:
+    """Where finished output files go, addressed by POSIX names relative to root.
+    
+    LocalDirectorySink (the default) is a marker for the usual behaviour:
+    files are written in place under root, with resumable .part files, hard
+    links and pruning. The other sinks take each response body as it
+    streams in (write_stream) and never create the output tree locally.
+    Identical renders are added with link() instead of a second copy where
+    the sink allows it. Sinks are shared by all download workers and must be
+    closed when the run (or sync) is over.
+    """
+    
+    local = False
+    CHUNK_SIZE = 1 << 16
+    # Per-worker body buffer before spilling to a temporary file
+    SPOOL_BYTES = 8 << 20
+    
+    def __init__(self, root: Path):
+        self.root = Path(root)
+    
+    @classmethod
+    def from_spec(cls, spec: str, root: Path, s3_endpoint: Optional[str] = None) -> "OutputSink":
+        """Sink for a --sink value: dir, tar:PATH (.tar.gz/.tgz compress), zip:PATH or s3://BUCKET/PREFIX."""
+        if spec in ("", "dir"):
+            return LocalDirectorySink(root)
+        if spec.startswith("tar:"):
+            return TarSink(root, spec[4:])
+        if spec.startswith("zip:"):
+            return ZipSink(root, spec[4:])
+        if spec.startswith("s3://"):
+            bucket, _, prefix = spec[5:].partition("/")
+            return S3Sink(root, bucket, prefix, endpoint=s3_endpoint)
+        raise ValueError(f"Unknown sink '{spec}' (expected dir, tar:PATH, zip:PATH or s3://BUCKET/PREFIX)")
+    
+    def name_for(self, filepath: Path) -> str:
+        """Sink name of an output path under root."""
+        try:
+            return Path(filepath).relative_to(self.root).as_posix()
+        except ValueError:
+            return Path(filepath).as_posix().lstrip("/")
+    
+    def _spool(self, chunks: Iterator[bytes]) -> Tuple[Any, int]:
+        """Buffer a body (in memory up to SPOOL_BYTES) and return (file, size), rewound."""
+        spool = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_BYTES)
+        for chunk in chunks:
+            spool.write(chunk)
+        size = spool.tell()
+        spool.seek(0)
+        return spool, size
+    
+    def write_stream(self, name: str, chunks: Iterator[bytes], size: Optional[int] = None) -> int:
+        """Write a body arriving as chunks (size from Content-Length if known). Returns bytes written."""
+        raise NotImplementedError
+    
+    def write_file(self, name: str, source: Path) -> int:
+        """Write a local file, e.g. an asset restored from the cache."""
+        with open(source, "rb") as f:
+            return self.write_stream(name, iter(lambda: f.read(self.CHUNK_SIZE), b""), Path(source).stat().st_size)
+    
+    def link(self, name: str, source_name: str) -> None:
+        """Make name hold the same content as the already written source_name."""
+        raise NotImplementedError
+    
+    def close(self) -> None:
+        pass
+    
+    def describe(self) -> str:
+        return str(self.root)
+
+
+class LocalDirectorySink(OutputSink):
+    """Files written in place under root (the downloader handles the details)."""
+    
+    local = True
+    
+    def write_stream(self, name: str, chunks: Iterator[bytes], size: Optional[int] = None) -> int:
+        destination = self.root / name
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        written = 0
+        with open(destination, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+        return written
+    
+    def link(self, name: str, source_name: str) -> None:
+        AssetCache._link_or_copy(self.root / source_name, self.root / name)
+
+
+class TarSink(OutputSink):
+    """Streams outputs into one tar archive (gzip-compressed for .tar.gz/.tgz).
+    
+    Members are appended one at a time, so each body is buffered per worker
+    and added whole; a dropped connection can't leave a truncated member.
+    Identical renders become hard-link members.
+    """
+    
+    def __init__(self, root: Path, path: str):
+        super().__init__(root)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        compression = "gz" if self.path.name.endswith((".tar.gz", ".tgz")) else ""
+        # Stream mode: written strictly sequentially, never seeked
+        self._tar = tarfile.open(str(self.path), f"w|{compression}")
+        self._lock = threading.Lock()
+    
+    def _member(self, name: str, size: int = 0) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        return info
+    
+    def write_stream(self, name: str, chunks: Iterator[bytes], size: Optional[int] = None) -> int:
+        spool, size = self._spool(chunks)
+        with spool, self._lock:
+            self._tar.addfile(self._member(name, size), spool)
+        return size
+    
+    def link(self, name: str, source_name: str) -> None:
+        info = self._member(name)
+        info.type = tarfile.LNKTYPE
+        info.linkname = source_name
+        with self._lock:
+            self._tar.addfile(info)
+    
+    def close(self) -> None:
+        with self._lock:
+            self._tar.close()
+    
+    def describe(self) -> str:
+        return f"tar archive {self.path}"
+
+
+class ZipSink(OutputSink):
+    """Streams outputs into one zip archive (stored, since images are already compressed).
+    
+    Bodies are buffered per worker like TarSink. Zip has no links, so
+    identical renders are copied from their source member when the archive
+    is closed.
+    """
+    
+    def __init__(self, root: Path, path: str):
+        super().__init__(root)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._zip = zipfile.ZipFile(self.path, "w", zipfile.ZIP_STORED)
+        self._lock = threading.Lock()
+        self._links: List[Tuple[str, str]] = []
+    
+    def _add(self, archive: zipfile.ZipFile, name: str, source, size: int) -> None:
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        with archive.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+            shutil.copyfileobj(source, member, self.CHUNK_SIZE)
+    
+    def write_stream(self, name: str, chunks: Iterator[bytes], size: Optional[int] = None) -> int:
+        spool, size = self._spool(chunks)
+        with spool, self._lock:
+            self._add(self._zip, name, spool, size)
+        return size
+    
+    def link(self, name: str, source_name: str) -> None:
+        with self._lock:
+            self._links.append((name, source_name))
+    
+    def close(self) -> None:
+        with self._lock:
+            self._zip.close()
+            if not self._links:
+                return
+            with zipfile.ZipFile(self.path, "a", zipfile.ZIP_STORED) as archive:
+                for name, source_name in self._links:
+                    with archive.open(source_name) as source:
+                        spool, size = self._spool(iter(lambda: source.read(self.CHUNK_SIZE), b""))
+                    with spool:
+                        self._add(archive, name, spool, size)
+            self._links = []
+    
+    def describe(self) -> str:
+        return f"zip archive {self.path}"
+
+
+class _SizedChunkReader(_ChunkReader):
+    """_ChunkReader with a known length, so requests sends it with Content-Length."""
+    
+    def __init__(self, chunks: Iterator[bytes], size: int):
+        super().__init__(chunks)
+        self._size = size
+    
+    def __len__(self) -> int:
+        return self._size
+
+
+class S3Sink(OutputSink):
+    """Uploads outputs to an S3-compatible object store under s3://bucket/prefix.
+    
+    Requests are signed with AWS Signature V4 using the AWS_ACCESS_KEY_ID,
+    AWS_SECRET_ACCESS_KEY and (optional) AWS_SESSION_TOKEN environment
+    variables, and use path-style URLs, so MinIO or any local stand-in works
+    via endpoint (default: AWS_ENDPOINT_URL, else AWS for AWS_REGION). A
+    body with a known length is streamed straight into the PUT; others are
+    buffered per worker first. Identical renders are server-side copies.
+    """
+    
+    def __init__(self, root: Path, bucket: str, prefix: str = "", endpoint: Optional[str] = None,
+                 region: Optional[str] = None):
+        super().__init__(root)
+        if not bucket:
+            raise ValueError("s3:// sink needs a bucket name")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.region = region or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+        self.endpoint = (endpoint or os.environ.get("AWS_ENDPOINT_URL")
+                         or f"https://s3.{self.region}.amazonaws.com").rstrip("/")
+        self.access_key = os.environ.get("AWS_ACCESS_KEY_ID", "")
+        self.secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY", "")
+        self.session_token = os.environ.get("AWS_SESSION_TOKEN")
+        self.session = requests.Session()
+    
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}/{name}" if self.prefix else name
+    
+    def _path(self, name: str) -> str:
+        return "/" + quote(f"{self.bucket}/{self._key(name)}", safe="/-_.~")
+    
+    def _signed_headers(self, method: str, path: str, headers: Dict[str, str]) -> Dict[str, str]:
+        """headers plus the SigV4 Authorization for an unsigned payload."""
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+        headers = dict(headers, **{"x-amz-date": amz_date, "x-amz-content-sha256": "UNSIGNED-PAYLOAD"})
+        if self.session_token:
+            headers["x-amz-security-token"] = self.session_token
+        signed = dict({"host": urlparse(self.endpoint).netloc},
+                      **{key.lower(): value for key, value in headers.items() if key.lower().startswith("x-amz-")})
+        names = sorted(signed)
+        canonical = "\n".join([method, path, "", "".join(f"{key}:{signed[key].strip()}\n" for key in names),
+                               ";".join(names), "UNSIGNED-PAYLOAD"])
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                    hashlib.sha256(canonical.encode()).hexdigest()])
+        key = f"AWS4{self.secret_key}".encode()
+        for part in (f"{now:%Y%m%d}", self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["Authorization"] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                                    f"SignedHeaders={';'.join(names)}, Signature={signature}")
+        return headers
+    
+    def _put(self, name: str, body, headers: Dict[str, str]) -> None:
+        path = self._path(name)
+        response = self.session.put(self.endpoint + path, data=body,
+                                    headers=self._signed_headers("PUT", path, headers), timeout=(10, 300))
+        with response:
+            response.raise_for_status()
+    
+    def write_stream(self, name: str, chunks: Iterator[bytes], size: Optional[int] = None) -> int:
+        if size is not None:
+            self._put(name, _SizedChunkReader(chunks, size), {"Content-Length": str(size)})
+            return size
+        spool, size = self._spool(chunks)
+        with spool:
+            self._put(name, spool, {"Content-Length": str(size)})
+        return size
+    
+    def link(self, name: str, source_name: str) -> None:
+        self._put(name, b"", {"x-amz-copy-source": quote(f"/{self.bucket}/{self._key(source_name)}", safe="/-_.~")})
+    
+    def close(self) -> None:
+        self.session.close()
+    
+    def describe(self) -> str:
+        return f"s3://{self.bucket}/{self.prefix}"
+
+
+class RunMetrics:
+    """Phase timings, throughput, request latencies and memory for one download run.
+    
+    Phases are timed with phase(name) (wall and process CPU time, summed over
+    repeated entries; a phase may run inside another, e.g. queue_wait inside
+    resolve_renders). The transport reports every request attempt to
+    observe_request, which keeps a latency histogram and status counts per
+    endpoint. report() returns everything as a JSON-ready dict; the same data
+    can be written in Prometheus text exposition format.
+    """
+    
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.requests: Dict[str, Dict] = {}
+        self.counters: Dict[str, float] = {}
+        self.retries = 0
+        self.peak_memory: Optional[int] = None
+        self.wall_seconds: Optional[float] = None
+        self.cpu_seconds: Optional[float] = None
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+    
+    @contextmanager
+    def phase(self, name: str):
+        """Time the enclosed block as (part of) phase name."""
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                stats = self.phases.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+                stats["wall_seconds"] += time.perf_counter() - wall
+                stats["cpu_seconds"] += time.process_time() - cpu
+                stats["calls"] += 1
+    
+    def count(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def observe_request(self, endpoint: Optional[str], seconds: float, status: int) -> None:
+        """Record one HTTP attempt (used as the transport observer)."""
+        with self._lock:
+            stats = self.requests.get(endpoint or "other")
+            if stats is None:
+                stats = {"count": 0, "sum_seconds": 0.0, "max_seconds": 0.0,
+                         "buckets": [0] * (len(self.LATENCY_BUCKETS) + 1), "statuses": {}}
+                self.requests[endpoint or "other"] = stats
+            stats["count"] += 1
+            stats["sum_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["buckets"][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+            status_key = str(status) if status else "error"
+            stats["statuses"][status_key] = stats["statuses"].get(status_key, 0) + 1
+    
+    def finish(self, retries: int = 0) -> None:
+        """Stop the run clock (and memory tracing)."""
+        self.wall_seconds = time.perf_counter() - self.started
+        self.cpu_seconds = time.process_time() - self.started_cpu
+        self.retries = retries
+        if self.trace_memory and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    
+    def report(self) -> Dict:
+        """The run's metrics as a JSON-ready dict."""
+        with self._lock:
+            wall = self.wall_seconds if self.wall_seconds is not None else time.perf_counter() - self.started
+            downloaded = self.counters.get("assets_downloaded", 0)
+            download_bytes = self.counters.get("bytes_downloaded", 0)
+            requests_report = {}
+            for endpoint, stats in self.requests.items():
+                cumulative = 0
+                histogram = {}
+                for bound, bucket_count in zip(self.LATENCY_BUCKETS + (float("inf"),), stats["buckets"]):
+                    cumulative += bucket_count
+                    histogram["+Inf" if bound == float("inf") else str(bound)] = cumulative
+                requests_report[endpoint] = {
+                    "count": stats["count"],
+                    "mean_seconds": stats["sum_seconds"] / stats["count"],
+                    "max_seconds": stats["max_seconds"],
+                    "sum_seconds": stats["sum_seconds"],
+                    "histogram": histogram,
+                    "statuses": dict(stats["statuses"]),
+                }
+            return {
+                "wall_seconds": wall,
+                "cpu_seconds": self.cpu_seconds,
+                "phases": {name: dict(stats) for name, stats in self.phases.items()},
+                "counters": dict(self.counters),
+                "throughput": {
+                    "assets_per_second": downloaded / wall if wall else 0.0,
+                    "bytes_per_second": download_bytes / wall if wall else 0.0,
+                },
+                "requests": requests_report,
+                "retries": self.retries,
+                "peak_memory_bytes": self.peak_memory,
+            }
+    
+    def write_json(self, path: Path) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+    
+    def write_prometheus(self, path: Path) -> None:
+        """Write the report in Prometheus text exposition format (e.g. for node_exporter's textfile collector)."""
+        report = self.report()
+        lines = [
+            "# TYPE figma_run_wall_seconds gauge",
+            f"figma_run_wall_seconds {report['wall_seconds']}",
+            "# TYPE figma_phase_wall_seconds gauge",
+        ]
+        lines += [f'figma_phase_wall_seconds{{phase="{name}"}} {stats["wall_seconds"]}'
+                  for name, stats in sorted(report["phases"].items())]
+        lines.append("# TYPE figma_phase_cpu_seconds gauge")
+        lines += [f'figma_phase_cpu_seconds{{phase="{name}"}} {stats["cpu_seconds"]}'
+                  for name, stats in sorted(report["phases"].items())]
+        lines.append("# TYPE figma_counter_total counter")
+        lines += [f'figma_counter_total{{name="{name}"}} {value}'
+                  for name, value in sorted(report["counters"].items())]
+        lines += ["# TYPE figma_retries_total counter", f"figma_retries_total {report['retries']}"]
+        lines.append("# TYPE figma_request_duration_seconds histogram")
+        for endpoint, stats in sorted(report["requests"].items()):
+            lines += [f'figma_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}'
+                      for bound, count in stats["histogram"].items()]
+            lines.append(f'figma_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats["sum_seconds"]}')
+            lines.append(f'figma_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats["count"]}')
+        if report["peak_memory_bytes"] is not None:
+            lines += ["# TYPE figma_peak_memory_bytes gauge", f"figma_peak_memory_bytes {report['peak_memory_bytes']}"]
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    
+    def summary_line(self) -> str:
+        """One-line "phase: seconds" digest, slowest phase first."""
+        phases = sorted(self.phases.items(), key=lambda item: -item[1]["wall_seconds"])
+        return ", ".join(f"{name} {stats['wall_seconds']:.2f}s" for name, stats in phases)
+
+
+class ProgressBar:
+    """Single-line download progress on a terminal, in place of per-file log lines.
+    
+    Counts accumulate from the start; the bar itself is drawn only between
+    show() and close(), and redrawn at most ten times a second. write()
+    prints a message above the bar.
+    """
+    
+    def __init__(self, stream=None, width: int = 30):
+        self.stream = stream or sys.stderr
+        self.enabled = self.stream.isatty()
+        self.width = width
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self._visible = False
+        self._last_draw = 0.0
+        self._lock = threading.Lock()
+    
+    def add_total(self, count: int = 1) -> None:
+        with self._lock:
+            self.total += count
+        self._draw()
+    
+    def advance(self, size: int = 0, failed: bool = False) -> None:
+        with self._lock:
+            self.done += 1
+            self.failed += int(failed)
+            self.bytes += size
+        self._draw()
+    
+    def show(self) -> None:
+        self._visible = self.enabled
+        self._draw(force=True)
+    
+    def _line(self) -> str:
+        total = max(self.total, self.done, 1)
+        filled = int(self.width * self.done / total)
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        failed = f", {self.failed} failed" if self.failed else ""
+        return (f"\r[{'#' * filled}{'.' * (self.width - filled)}] {self.done}/{self.total} assets"
+                f"{failed}  {self.bytes / (1 << 20) / elapsed:.1f} MB/s\x1b[K")
+    
+    def _draw(self, force: bool = False) -> None:
+        if not self._visible:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            if not force and now - self._last_draw < 0.1 and self.done < self.total:
+                return
+            self._last_draw = now
+            self.stream.write(self._line())
+            self.stream.flush()
+    
+    def write(self, message: str) -> None:
+        """Print message on its own line without garbling the bar."""
+        if not self._visible:
+            print(message)
+            return
+        with self._lock:
+            self.stream.write("\r\x1b[K")
+            self.stream.flush()
+            print(message, flush=True)
+            self.stream.write(self._line())
+            self.stream.flush()
+    
+    def close(self) -> None:
+        if self._visible:
+            self._draw(force=True)
+            self.stream.write("\n")
+            self.stream.flush()
+        self._visible = False
+
+
+def _optimize_image_file(source: str, output_base: str, formats: Tuple[str, ...],
+                         widths: Tuple[int, ...], quality: int) -> List[str]:
+    """Write the optimized variants of one image; runs inside an optimizer worker process.
+    
+    output_base is the destination path without extension. Produces a
+    recompressed copy of the original, each format at full size, and each
+    format at every width narrower than the source ("<base>-<width>w.<ext>").
+    """
+    Path(output_base).parent.mkdir(parents=True, exist_ok=True)
+    written = []
+    
+    def save(image, path: str, fmt: str) -> None:
+        temp_path = f"{path}.tmp"
+        if fmt == "jpeg":
+            image.convert("RGB").save(temp_path, "JPEG", quality=quality, optimize=True, progressive=True)
+        elif fmt == "png":
+            image.save(temp_path, "PNG", optimize=True)
+        elif fmt == "webp":
+            image.save(temp_path, "WEBP", quality=quality, method=6)
+        elif fmt == "avif":
+            image.save(temp_path, "AVIF", quality=quality)
+        os.replace(temp_path, path)
+        written.append(path)
+    
+    with Image.open(source) as image:
+        image.load()
+        suffix = Path(source).suffix.lower()
+        original_format = "jpeg" if suffix in (".jpg", ".jpeg") else "png"
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "P") else "RGB")
+        
+        save(image, f"{output_base}{suffix}", original_format)
+        for fmt in formats:
+            save(image, f"{output_base}.{fmt}", fmt)
+        
+        for width in widths:
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+            for fmt in formats:
+                save(resized, f"{output_base}-{width}w.{fmt}", fmt)
+    
+    return written
+
+
+class ImageOptimizer:
+    """Post-download image optimization, run in a process pool (requires Pillow).
+    
+    For every PNG/JPEG under a directory, writes into <dir>/optimized/
+    (mirroring subfolders) a recompressed original plus WebP (and optionally
+    AVIF) variants at full size and at each responsive width. Sources are
+    never modified. Per-file SHA-256 hashes and settings are kept in
+    optimized/.optimize_state.json so unchanged sources are skipped.
+    """
+    
+    SOURCE_SUFFIXES = (".png", ".jpg", ".jpeg")
+    OUTPUT_DIR_NAME = "optimized"
+    STATE_NAME = ".optimize_state.json"
+    
+    def __init__(self, formats: Tuple[str, ...] = ("webp",), widths: Tuple[int, ...] = (640, 1280, 1920),
+                 quality: int = 80, workers: Optional[int] = None):
+        if Image is None:
+            raise RuntimeError("Image optimization requires Pillow (pip install Pillow)")
+        supported = []
+        for fmt in formats:
+            if fmt == "avif" and not pil_features.check("avif"):
+                print("⚠️  This Pillow build has no AVIF support; skipping AVIF variants")
+                continue
+            supported.append(fmt)
+        self.formats = tuple(supported)
+        self.widths = tuple(sorted(set(widths)))
+        self.quality = quality
+        self.workers = workers
+    
+    def _settings(self) -> Dict:
+        return {"formats": list(self.formats), "widths": list(self.widths), "quality": self.quality}
+    
+    def optimize_directory(self, directory: str) -> Dict[str, int]:
+        """Optimize every changed image under directory. Returns optimized/skipped/failed counts."""
+        root = Path(directory)
+        output_root = root / self.OUTPUT_DIR_NAME
+        state_path = output_root / self.STATE_NAME
+        state: Dict[str, Dict] = {}
+        if state_path.exists():
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+        
+        settings = self._settings()
+        tasks = {}
+        counts = {"optimized": 0, "skipped": 0, "failed": 0}
+        for source in sorted(root.rglob("*")):
+            relative = source.relative_to(root)
+            if (source.suffix.lower() not in self.SOURCE_SUFFIXES or not source.is_file()
+                    or relative.parts[0] == self.OUTPUT_DIR_NAME
+                    or any(part.startswith(".") for part in relative.parts)):
+                continue
+            digest = AssetCache._hash_file(source)
+            previous = state.get(relative.as_posix())
+            if (previous and previous.get("sha256") == digest and previous.get("settings") == settings
+                    and all(Path(output).exists() for output in previous.get("outputs", []))):
+                counts["skipped"] += 1
+                continue
+            tasks[relative.as_posix()] = (str(source), digest)
+        
+        if tasks:
+            print(f"\n🗜️  Optimizing {len(tasks)} image(s) in {root} ({counts['skipped']} unchanged)...")
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {
+                    executor.submit(_optimize_image_file, source, str((output_root / relative).with_suffix("")),
+                                    self.formats, self.widths, self.quality): (relative, digest)
+                    for relative, (source, digest) in tasks.items()
+                }
+                for future in as_completed(futures):
+                    relative, digest = futures[future]
+                    try:
+                        outputs = future.result()
+                    except Exception as e:
+                        print(f"  ✗ Failed to optimize {relative}: {e}")
+                        counts["failed"] += 1
+                        continue
+                    state[relative] = {"sha256": digest, "settings": settings, "outputs": outputs}
+                    counts["optimized"] += 1
+            
+            output_root.mkdir(parents=True, exist_ok=True)
+            temp_path = state_path.with_name(state_path.name + ".tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+            os.replace(temp_path, state_path)
+        
+        print(f"✅ Optimized {counts['optimized']} image(s), {counts['skipped']} unchanged, "
+              f"{counts['failed']} failed → {output_root}")
+        return counts
 
 
 class FigmaAssetDownloader:
     """Downloads assets from a Figma design file."""
     
-    def __init__(self, token: str):
+    def __init__(self, token: str, concurrency: int = 8, max_per_host: Optional[int] = None,
+                 connect_timeout: float = 10.0, read_timeout: float = 60.0, http2: bool = False,
+                 max_retries: int = 5, rate_limits: Optional[Dict[str, Optional[Tuple[float, float]]]] = None,
+                 queue_size: Optional[int] = None, base_url: str = "https://api.figma.com/v1",
+                 verbose: bool = False, max_batch_cost: Optional[float] = None):
         self.token = token
-        self.base_url = "https://api.figma.com/v1"
+        # Overridable so benchmarks can point the client at a local mock API
+        self.base_url = base_url.rstrip("/")
         self.headers = {
             "X-Figma-Token": token
         }
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        
+        # Size of the download worker pool, and the cap on simultaneous
+        # downloads against any single host (defaults to the pool size)
+        self.concurrency = max(1, concurrency)
+        self.max_per_host = max(1, max_per_host or self.concurrency)
+        
+        # All API calls and image fetches share one pooled transport. The
+        # token is only sent to the API, never to the image CDN.
+        self.transport = HTTPTransport(
+            pool_maxsize=self.max_per_host,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            http2=http2,
+            max_retries=max_retries,
+            rate_limits=rate_limits,
+        )
+        self.session = self.transport.session
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._host_slots_lock = threading.Lock()
+        
+        # Bounded download queue: submitting blocks once this many downloads
+        # are queued or running. The blocked caller stops taking resolved
+        # batches from iter_variant_urls, which then stops requesting more
+        self.queue_size = max(1, queue_size or self.concurrency * 4)
+        self._queue_slots = threading.BoundedSemaphore(self.queue_size)
+        
+        # Estimated render cost allowed per /images request (see plan_render_batches)
+        self.max_batch_cost = max_batch_cost or self.MAX_BATCH_COST
+        
+        # Output names handed out during the current run, so concurrent
+        # downloads never pick the same filename
+        self._names = NameRegistry()
+        
+        # Serialises progress lines printed from download workers. Per-file
+        # lines are only printed when verbose; otherwise a progress bar is shown
+        self._print_lock = threading.Lock()
+        self.verbose = verbose
+        self.progress: Optional[ProgressBar] = None
+        # Where this downloader's output goes (None for sys.stdout); each
+        # file of a bulk sync logs to its own (see FigmaBulkSync)
+        self.log_stream = None
+        
+        # Instrumentation for the current run (see RunMetrics)
+        self.metrics = RunMetrics()
+        self.transport.observer = self.metrics.observe_request
+        
+        # Content-addressed asset cache, download journal and duplicate index
+        # for the current run (see download_assets)
+        self.cache: Optional[AssetCache] = None
+        self.journal: Optional[DownloadJournal] = None
+        self.dedup: Optional[DuplicateIndex] = None
+        # Render signature -> (output path, download future or None) of the
+        # render every identical node is linked to
+        self._render_sources: Dict[Tuple, Optional[Tuple[Path, Optional[Future]]]] = {}
+        self.renders_skipped = 0
+        self._run_futures: List[Future] = []
+        self.file_name: Optional[str] = None
+        # Version of the file being downloaded, which scopes render cache keys
+        # when there is no render cache to key by subtree hash
+        self._file_version: Optional[str] = None
+        # Slot namespace and the slots planned in the current run
+        self._slot_prefix = ""
+        self._active_slots: set = set()
+        # Parsed documents, per cache directory (see DocumentCache), and the
+        # last tree indexed for the find_* helpers
+        self._document_caches: Dict[Path, DocumentCache] = {}
+        self._helper_indexed: Optional[Tuple[Dict, NodeIndex]] = None
+        # Formats and scales renders are exported at, and the sink outputs
+        # stream into when it isn't the local directory (see download_assets)
+        self.export_plan = ExportPlan()
+        self.sink: Optional[OutputSink] = None
+        # Packs small icons into a sprite/atlas instead of single renders
+        self.atlas: Optional[IconAtlas] = None
+        # Manifest of the current run's outputs, and the node details its
+        # entries carry, per slot (see AssetManifest)
+        self.manifest: Optional[AssetManifest] = None
+        self._asset_meta: Dict[str, Dict] = {}
+        # Set on forks (see fork), whose metrics belong to the parent's run
+        self._shared_run = False
+    
+    def fork(self) -> "FigmaAssetDownloader":
+        """A downloader for another file that shares this one's transport, host slots and queue.
+        
+        Connection pools, per-endpoint rate limits, per-host download limits
+        and the bounded download queue are shared, as are the metrics; the
+        per-run state (cache, journal, duplicate index, output names, manifest)
+        is not.
+        """
+        clone = copy.copy(self)
+        clone._names = NameRegistry()
+        clone.manifest = None
+        clone._asset_meta = {}
+        clone.progress = None
+        clone.cache = None
+        clone.journal = None
+        clone.dedup = None
+        clone._render_sources = {}
+        clone.renders_skipped = 0
+        clone._run_futures = []
+        clone.file_name = None
+        clone._file_version = None
+        clone._active_slots = set()
+        clone._shared_run = True
+        return clone
     
     def extract_file_id(self, file_input: str) -> str:
         """Extract file ID from Figma URL or return as-is if it's already an ID."""
@@ -48,38 +2534,248 @@ class FigmaAssetDownloader:
         # Request full file data - don't set depth limit to get all nodes
         # The API will return all nodes by default, but we can request specific data
         params = {}
-        response = self.session.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
+        with self.metrics.phase("fetch_file"), \
+                self.transport.get(url, params=params, headers=self.headers, endpoint="files") as response:
+            response.raise_for_status()
+            body = response.content
+        self.metrics.count("file_json_bytes", len(body))
         
+        with self.metrics.phase("decode_json"):
+            data = json.loads(body)
         return data
     
-    def get_image_urls(self, file_id: str, node_ids: List[str]) -> Dict[str, str]:
-        """Get image URLs for given node IDs."""
-        # Figma API allows up to 100 node IDs per request
-        url = f"{self.base_url}/images/{file_id}"
-        all_image_urls = {}
-        
-        # Process in batches of 100
-        for i in range(0, len(node_ids), 100):
-            batch = node_ids[i:i+100]
-            params = {
-                "ids": ",".join(batch),
-                "format": "png",
-                "scale": 2  # 2x resolution for better quality
-            }
-            response = self.session.get(url, params=params)
+    def get_file_version(self, file_id: str) -> Dict:
+        """Fetch just the file's name, version, lastModified and pages (a depth-limited request)."""
+        url = f"{self.base_url}/files/{file_id}"
+        with self.metrics.phase("check_version"), \
+                self.transport.get(url, params={"depth": 1}, headers=self.headers, endpoint="files") as response:
             response.raise_for_status()
             data = response.json()
-            all_image_urls.update(data.get("images", {}))
+        info = {key: data.get(key) for key in ("name", "version", "lastModified")}
+        info["pages"] = [{"id": page.get("id"), "name": page.get("name", "")}
+                         for page in (data.get("document") or {}).get("children", [])]
+        return info
+    
+    def get_file_nodes(self, file_id: str, node_ids: List[str]) -> Dict:
+        """Fetch the subtrees under node_ids with /files/:id/nodes (in URL-sized chunks)."""
+        url = f"{self.base_url}/files/{file_id}/nodes"
+        data: Dict = {"nodes": {}}
+        with self.metrics.phase("fetch_file"):
+            for start in range(0, len(node_ids), self.MAX_BATCH_IDS):
+                chunk = node_ids[start:start + self.MAX_BATCH_IDS]
+                with self.transport.get(url, params={"ids": ",".join(chunk)}, headers=self.headers,
+                                        endpoint="files") as response:
+                    response.raise_for_status()
+                    body = response.content
+                self.metrics.count("file_json_bytes", len(body))
+                part = json.loads(body)
+                data["nodes"].update(part.pop("nodes", None) or {})
+                data.update(part)
+        return data
+    
+    def get_selected_document(self, file_id: str, selector: NodeSelector, pages: List[Dict]) -> Dict:
+        """Fetch only the pages or nodes selector asks for, assembled into one document.
+        
+        Explicitly selected nodes are gathered under a "Selected nodes" page.
+        """
+        if selector.node_ids:
+            ids = selector.node_ids
+        else:
+            ids = [page["id"] for page in pages if selector.matches_page(page["name"])]
+        if not ids:
+            self._print("  ⚠️  No page matches the selection")
+        else:
+            self._print(f"  Fetching {len(ids)} of {len(pages)} page(s)" if not selector.node_ids
+                  else f"  Fetching {len(ids)} selected node(s)")
+        data = self.get_file_nodes(file_id, ids) if ids else {}
+        roots = [entry["document"] for entry in (data.pop("nodes", None) or {}).values()
+                 if entry and entry.get("document")]
+        if selector.node_ids:
+            roots = [{"id": "selected", "name": "Selected nodes", "type": "CANVAS", "children": roots}]
+        data["document"] = {"id": "0:0", "name": "Document", "type": "DOCUMENT", "children": roots}
+        return data
+    
+    # Render batching limits for /v1/images requests
+    MAX_BATCH_IDS = 400          # Keeps the request URL well under server limits
+    MAX_BATCH_COST = 200.0       # Per-batch render cost: ~35 1440x900 frames at 2x (see estimate_render_cost)
+    RENDER_CONCURRENCY = 4       # Batches resolved in parallel (still paced by the images bucket)
+    
+    def estimate_render_cost(self, record: Optional[Dict], subtree_size: int = 1, scale: float = 2) -> float:
+        """Rough render cost of a node: output megapixels plus a per-descendant term."""
+        box = (record or {}).get("absoluteBoundingBox") or {}
+        width = box.get("width") or 0
+        height = box.get("height") or 0
+        megapixels = (width * scale) * (height * scale) / 1e6 if width and height else 1.0
+        return megapixels + 0.002 * subtree_size
+    
+    def render_costs(self, index: NodeIndex, node_ids: List[str], scale: float = 2) -> Dict[str, float]:
+        """Estimated render cost for each node id, from the node index."""
+        return {
+            node_id: self.estimate_render_cost(index.records.get(node_id), index.subtree_size(node_id), scale)
+            for node_id in node_ids
+        }
+    
+    def plan_render_batches(self, node_ids: List[str], costs: Optional[Dict[str, float]] = None) -> List[List[str]]:
+        """Group node ids into cost-balanced batches for /v1/images.
+        
+        Without costs this is the plain fixed-size split. With costs, nodes are
+        placed heaviest first into the first batch with room for them
+        (first-fit decreasing), so a heavy frame gets a batch of its own while
+        hundreds of light icons share one request.
+        """
+        if not costs:
+            return [node_ids[i:i + 100] for i in range(0, len(node_ids), 100)]
+        
+        ordered = sorted(node_ids, key=lambda node_id: costs.get(node_id, 1.0), reverse=True)
+        batches: List[List[str]] = []
+        batch_costs: List[float] = []
+        for node_id in ordered:
+            cost = costs.get(node_id, 1.0)
+            for i, batch in enumerate(batches):
+                if len(batch) < self.MAX_BATCH_IDS and batch_costs[i] + cost <= self.max_batch_cost:
+                    batch.append(node_id)
+                    batch_costs[i] += cost
+                    break
+            else:
+                batches.append([node_id])
+                batch_costs.append(cost)
+        return batches
+    
+    def _request_image_batch(self, file_id: str, batch: List[str], scale: float = 2,
+                             fmt: str = "png") -> Optional[Dict[str, Optional[str]]]:
+        """Request renders for one batch. Returns None if the render failed as a whole."""
+        url = f"{self.base_url}/images/{file_id}"
+        params = {
+            "ids": ",".join(batch),
+            "format": fmt,
+            "scale": scale
+        }
+        self.metrics.count("render_batches")
+        # A server error on a batch is usually a render timeout, which splitting
+        # fixes and retrying doesn't; only a lone node gets the usual retries.
+        # Throttling says nothing about the ids, so the transport sends the
+        # same batch again after the wait either way
+        retry_statuses = None if len(batch) == 1 else ()
+        with self.transport.get(url, params=params, headers=self.headers, endpoint="images",
+                                retry_statuses=retry_statuses) as response:
+            # Bad token / missing file can't be fixed by splitting the batch,
+            # and neither can throttling that outlasted the retries
+            if response.status_code in (401, 403, 404) or self.transport.is_throttled(response):
+                response.raise_for_status()
+            if response.status_code >= 400:
+                return None
+            data = response.json()
+        if data.get("err"):
+            return None
+        return data.get("images", {})
+    
+    def _resolve_image_batch(self, file_id: str, batch: List[str], scale: float = 2,
+                             fmt: str = "png") -> Dict[str, Optional[str]]:
+        """Resolve a batch, bisecting it whenever it fails or leaves null URLs.
+        
+        A batch still throttled after every retry is left unresolved whole;
+        smaller requests would only be throttled as well.
+        """
+        resolved: Dict[str, Optional[str]] = {}
+        pending = [batch]
+        while pending:
+            current = pending.pop()
+            try:
+                images = self._request_image_batch(file_id, current, scale, fmt)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or not self.transport.is_throttled(e.response):
+                    raise
+                self._log(f"  ⚠️  Still rate limited after {self.transport.max_retries} retries; "
+                          f"{len(current)} render(s) left unresolved")
+                resolved.update(dict.fromkeys(current))
+                continue
+            if images is None:
+                if len(current) == 1:
+                    self._log(f"  ⚠️  Render failed for node {current[0]}")
+                    resolved[current[0]] = None
+                    continue
+                retry = current
+            else:
+                resolved.update(images)
+                retry = [node_id for node_id in current if not images.get(node_id)]
+                if not retry or len(current) == 1:
+                    # Still null when rendered alone: an empty render, not a timeout
+                    for node_id in retry:
+                        resolved[node_id] = None
+                    continue
+            if len(retry) == 1:
+                pending.append(retry)
+            else:
+                middle = len(retry) // 2
+                pending.extend([retry[:middle], retry[middle:]])
+        return resolved
+    
+    def iter_image_urls(self, file_id: str, node_ids: List[str],
+                        costs: Optional[Dict[str, float]] = None,
+                        scale: float = 2, fmt: str = "png") -> Iterator[Dict[str, Optional[str]]]:
+        """Yield image URLs for given node IDs one resolved batch at a time.
+        
+        Batches are cost-balanced when costs are given (see render_costs),
+        resolved concurrently, and bisected automatically when a render
+        fails or returns null URLs. Each batch is yielded as soon as it
+        completes, so callers can start downloading before the rest resolve.
+        """
+        for _variant, batch_urls in self.iter_variant_urls(file_id, {(fmt, scale): (node_ids, costs)}):
+            yield batch_urls
+    
+    def iter_variant_urls(self, file_id: str,
+                          groups: Dict[Tuple[str, float], Tuple[List[str], Optional[Dict[str, float]]]]
+                          ) -> Iterator[Tuple[Tuple[str, float], Dict[str, Optional[str]]]]:
+        """Like iter_image_urls for several (format, scale) groups of node ids at once.
+        
+        /v1/images takes one format and scale per request, so each group is
+        batched separately, but all batches share one resolver pool. Yields
+        ((format, scale), urls) per batch. At most RENDER_CONCURRENCY batches
+        are in flight: the next one is only requested once the caller takes a
+        result, so a caller that stops to wait for downloads pauses resolution.
+        """
+        jobs = [(variant, batch) for variant, (node_ids, costs) in groups.items()
+                for batch in self.plan_render_batches(node_ids, costs)]
+        if not jobs:
+            return
         
+        remaining = iter(jobs)
+        with ThreadPoolExecutor(max_workers=min(self.RENDER_CONCURRENCY, len(jobs))) as executor:
+            def submit_next() -> None:
+                job = next(remaining, None)
+                if job is not None:
+                    variant, batch = job
+                    futures[executor.submit(self._resolve_image_batch, file_id, batch,
+                                            variant[1], variant[0])] = variant
+            
+            futures: Dict[Future, Tuple[str, float]] = {}
+            for _ in range(self.RENDER_CONCURRENCY):
+                submit_next()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield futures.pop(future), future.result()
+                    submit_next()
+    
+    def get_image_urls(self, file_id: str, node_ids: List[str],
+                       costs: Optional[Dict[str, float]] = None, scale: float = 2) -> Dict[str, str]:
+        """Get image URLs for given node IDs."""
+        all_image_urls = {}
+        for batch_urls in self.iter_image_urls(file_id, node_ids, costs, scale):
+            all_image_urls.update(batch_urls)
         return all_image_urls
     
-    def find_image_fills(self, node: Dict, image_assets: List[Dict]) -> None:
-        """Recursively find all nodes with image fills (individual image assets)."""
+    def node_image_fills(self, node: Dict) -> List[Dict]:
+        """Return the image assets referenced directly by a single node (children excluded)."""
         node_type = node.get("type", "")
+        fills = node.get("fills")
+        background_fills = node.get("background")
+        # Called for every node, and most have nothing to look at
+        if not fills and not background_fills and node_type != "IMAGE":
+            return []
         node_id = node.get("id")
         node_name = node.get("name", "unnamed")
+        image_assets = []
         
         # Check if this is an IMAGE node type (some images are stored as separate nodes)
         if node_type == "IMAGE":
@@ -94,7 +2790,6 @@ class FigmaAssetDownloader:
                 })
         
         # Check for image fills in fills array
-        fills = node.get("fills", [])
         if fills:
             for fill in fills:
                 if fill.get("type") == "IMAGE":
@@ -109,7 +2804,6 @@ class FigmaAssetDownloader:
                         })
         
         # Check for background fills (some frames have image backgrounds)
-        background_fills = node.get("background", [])
         if background_fills:
             for fill in background_fills:
                 if isinstance(fill, dict) and fill.get("type") == "IMAGE":
@@ -130,104 +2824,848 @@ class FigmaAssetDownloader:
                     # Some effects might reference images, though rare
                     pass
         
-        # Recursively process children (always traverse, even for containers)
-        children = node.get("children", [])
-        for child in children:
-            # Always traverse children, even if this node is a container
-            self.find_image_fills(child, image_assets)
+        return image_assets
+    
+    def find_image_fills(self, node: Dict, image_assets: List[Dict]) -> None:
+        """Find all nodes with image fills (individual image assets) under node."""
+        image_assets.extend(self._helper_index(node).image_assets)
     
-    def get_image_fill_urls(self, file_data: Dict, image_refs: List[str]) -> Dict[str, str]:
-        """Get download URLs for image fills from file data."""
+    def get_file_image_fills(self, file_id: str) -> Dict[str, str]:
+        """Fetch the imageRef -> URL map from the dedicated /files/{id}/images endpoint."""
+        url = f"{self.base_url}/files/{file_id}/images"
+        with self.transport.get(url, headers=self.headers, endpoint="fills") as response:
+            response.raise_for_status()
+            data = response.json()
+        return (data.get("meta") or {}).get("images") or {}
+    
+    def get_image_fill_urls(self, file_data: Dict, image_refs: List[str],
+                            file_id: Optional[str] = None) -> Dict[str, str]:
+        """Get download URLs for image fills from file data.
+        
+        When the file data carries no "images" map and file_id is given, the
+        map is fetched from the /files/{id}/images fill endpoint instead.
+        """
         # Figma stores image URLs in the file data under "images" key
         # The images object maps imageRef (hash) to the actual image URL
         images = file_data.get("images", {})
         
+        if not images and file_id and image_refs:
+            self._print(f"  No 'images' object in file data; fetching fills from /files/{file_id}/images...")
+            images = self.get_file_image_fills(file_id)
+            file_data["images"] = images
+        
         if not images:
-            print("  ⚠️  Warning: No 'images' object found in file data")
-            print(f"     File data keys: {list(file_data.keys())}")
+            self._print("  ⚠️  Warning: No 'images' object found in file data")
+            self._print(f"     File data keys: {list(file_data.keys())}")
         
-        # Filter to only return URLs for the image_refs we're looking for
+        # Filter to only return URLs for the image_refs we're looking for,
+        # falling back to a prefix match (sometimes the ref might be slightly different)
+        ref_index = ImageRefIndex(images)
         result = {}
-        found_count = 0
         for image_ref in image_refs:
-            if image_ref in images:
-                result[image_ref] = images[image_ref]
-                found_count += 1
-            else:
-                # Try partial match (sometimes the ref might be slightly different)
-                for key, url in images.items():
-                    if image_ref in key or key in image_ref:
-                        result[image_ref] = url
-                        found_count += 1
-                        break
+            url = ref_index.lookup(image_ref)
+            if url is not None:
+                result[image_ref] = url
+        found_count = len(result)
         
         if found_count < len(image_refs):
             missing = len(image_refs) - found_count
-            print(f"  ⚠️  Warning: {missing} image reference(s) not found in file data")
-            print(f"     Looking for {len(image_refs)} images, found {found_count}")
+            self._print(f"  ⚠️  Warning: {missing} image reference(s) not found in file data")
+            self._print(f"     Looking for {len(image_refs)} images, found {found_count}")
             if images:
-                print(f"     Available image keys (first 5): {list(images.keys())[:5]}")
-                print(f"     Missing refs (first 5): {[ref for ref in image_refs if ref not in result][:5]}")
+                self._print(f"     Available image keys (first 5): {list(images.keys())[:5]}")
+                self._print(f"     Missing refs (first 5): {[ref for ref in image_refs if ref not in result][:5]}")
         
         return result
     
-    def find_image_nodes(self, node: Dict, image_nodes: List[Dict], export_all: bool = True) -> None:
-        """Recursively find all nodes that can be exported as images."""
+    # Nodes that can be exported as images (called for every node, so sets)
+    EXPORTABLE_TYPES = frozenset((
+        "FRAME", "COMPONENT", "INSTANCE", "GROUP",
+        "VECTOR", "BOOLEAN_OPERATION", "STAR", "LINE",
+        "ELLIPSE", "REGULAR_POLYGON", "RECTANGLE", "TEXT"
+    ))
+    # Exported by default even without export settings
+    CONTAINER_TYPES = frozenset(("FRAME", "COMPONENT", "INSTANCE", "GROUP"))
+    
+    def should_export_node(self, node: Dict, export_all: bool = True) -> bool:
+        """Decide whether a single node should be exported as an image."""
         node_type = node.get("type", "")
         
-        # Skip certain node types that are usually containers
-        skip_types = ["DOCUMENT", "CANVAS", "PAGE"]
+        if node_type not in self.EXPORTABLE_TYPES:
+            return False
+        
+        # If export_all is True, export all frames, components, instances, and groups
+        # Otherwise, only export nodes with explicit export settings
+        if export_all:
+            # Export all frames, components, instances, and groups (but not individual shapes unless they're top-level)
+            # Also export if it has explicit export settings
+            should_export = node_type in self.CONTAINER_TYPES or bool(node.get("exportSettings"))
+        else:
+            # Only export if it has export settings or is a component/instance
+            should_export = bool(node.get("exportSettings")) or node_type in ("COMPONENT", "INSTANCE")
+        
+        # Skip nodes that are likely just containers (no visual content)
+        # Check if node has visible property set to False
+        # (visible defaults to True if not specified)
+        return should_export and node.get("visible", True)
+    
+    def find_image_nodes(self, node: Dict, image_nodes: List[Dict], export_all: bool = True) -> None:
+        """Find all nodes under node that can be exported as images."""
+        image_nodes.extend(self.exportable_nodes(self._helper_index(node), export_all))
+    
+    def _helper_index(self, node: Dict) -> NodeIndex:
+        """Index for find_image_fills/find_image_nodes, reused while they are called on the same tree."""
+        if self._helper_indexed is None or self._helper_indexed[0] is not node:
+            self._helper_indexed = (node, self.build_node_index(node))
+        return self._helper_indexed[1]
+    
+    def _index_filter(self, selector: Optional[NodeSelector] = None) -> Callable[[Dict], bool]:
+        """Which nodes an index keeps records for: any that exportable_nodes could pick.
+        
+        That is independent of export_all, so one index serves both.
+        """
+        if selector is None:
+            return self.should_export_node
+        
+        def keep(node: Dict) -> bool:
+            if selector.types:
+                exportable = node.get("visible", True) and node.get("type") not in ("DOCUMENT", "CANVAS")
+            else:
+                exportable = self.should_export_node(node)
+            return exportable and selector.matches(node)
+        return keep
+    
+    def build_node_index(self, document: Dict, selector: Optional[NodeSelector] = None) -> NodeIndex:
+        """Index an in-memory document, running the image-fill detector on every selected node."""
+        return NodeIndex.from_document(document, self.node_image_fills, self._index_filter(selector), selector)
+    
+    def exportable_nodes(self, index: NodeIndex, export_all: bool = True,
+                         selector: Optional[NodeSelector] = None) -> List[Dict]:
+        """Query the index for nodes that should be exported as images.
+        
+        With a selector, its node types replace the default exportable types.
+        """
+        unselected = index.unselected
+        
+        def wanted(record: Dict) -> bool:
+            if record["id"] in unselected:
+                return False
+            if selector is None:
+                return self.should_export_node(record, export_all)
+            if selector.types:
+                exportable = record.get("visible", True) and record.get("type") not in ("DOCUMENT", "CANVAS")
+            else:
+                exportable = self.should_export_node(record, export_all)
+            return exportable and selector.matches(record)
         
-        # Nodes that can be exported as images
-        exportable_types = [
-            "FRAME", "COMPONENT", "INSTANCE", "GROUP", 
-            "VECTOR", "BOOLEAN_OPERATION", "STAR", "LINE", 
-            "ELLIPSE", "REGULAR_POLYGON", "RECTANGLE", "TEXT"
+        return [
+            {"id": record["id"], "name": record.get("name", "unnamed"), "type": record.get("type", "")}
+            for record in index.find(wanted)
         ]
+    
+    def stream_file_nodes(self, file_id: str, file_meta: Dict
+                          ) -> Iterator[Tuple[Dict, Optional[str], int, List[Dict]]]:
+        """Stream the /files response, yielding (node, parent_id, depth, ancestors) as each node completes.
         
-        if node_type in exportable_types:
-            # If export_all is True, export all frames, components, instances, and groups
-            # Otherwise, only export nodes with explicit export settings
-            should_export = False
+        The JSON is parsed incrementally with ijson, so the document tree is never
+        materialised: each yielded node carries its own properties but no
+        "children", and only the chain of open ancestors is held in memory.
+        ancestors is that chain, outermost first, with the properties parsed
+        so far (Figma sends a node's name before its children); it is only
+        valid until the next node is yielded. Nodes are yielded in post-order
+        (children before their parent). Top-level
+        keys other than "document" (name, version, images, ...) are collected
+        into file_meta as they are parsed.
+        """
+        if ijson is None:
+            raise RuntimeError("Streaming mode requires the 'ijson' package (pip install ijson)")
+        
+        url = f"{self.base_url}/files/{file_id}"
+        with self.transport.get(url, headers=self.headers, stream=True, endpoint="files") as response:
+            response.raise_for_status()
+            events = ijson.basic_parse(_ChunkReader(response.iter_content(chunk_size=1 << 16)),
+                                       use_float=True)
             
-            if export_all:
-                # Export all frames, components, instances, and groups (but not individual shapes unless they're top-level)
-                if node_type in ["FRAME", "COMPONENT", "INSTANCE", "GROUP"]:
-                    should_export = True
-                # Also export if it has explicit export settings
-                elif node.get("exportSettings"):
-                    should_export = True
-            else:
-                # Only export if it has export settings or is a component/instance
-                if node.get("exportSettings") or node_type in ["COMPONENT", "INSTANCE"]:
-                    should_export = True
+            # Properties of the open nodes, outermost first (a node's depth is its position)
+            stack: List[Dict] = []
+            builder = None      # Builds the property value currently being parsed
+            builder_depth = 0
+            target: Dict = file_meta
+            key = None          # Property whose value comes next
             
-            if should_export and node_type not in skip_types:
-                # Skip nodes that are likely just containers (no visual content)
-                # Check if node has visible property set to False
-                if node.get("visible", True):  # Default to True if not specified
-                    image_nodes.append({
-                        "id": node.get("id"),
-                        "name": node.get("name", "unnamed"),
-                        "type": node_type
-                    })
-        
-        # Recursively process children (always traverse, even for containers)
-        children = node.get("children", [])
-        for child in children:
-            # Always traverse children, even if this node is a container
-            self.find_image_nodes(child, image_nodes, export_all)
-    
-    def download_image(self, url: str, filepath: Path) -> None:
-        """Download an image from URL to filepath."""
-        response = requests.get(url, stream=True)
+            next(events)  # start_map of the response object
+            for event, value in events:
+                if builder is not None:
+                    builder.event(event, value)
+                    if event in ("start_map", "start_array"):
+                        builder_depth += 1
+                    elif event in ("end_map", "end_array"):
+                        builder_depth -= 1
+                    if builder_depth == 0:
+                        target[key] = builder.value
+                        builder = None
+                        key = None
+                    continue
+                
+                if key is not None:
+                    # Most values are scalars and need no builder
+                    if event in ("start_map", "start_array"):
+                        builder = ijson.ObjectBuilder()
+                        builder.event(event, value)
+                        builder_depth = 1
+                        continue
+                    target[key] = value
+                    key = None
+                elif event == "map_key":
+                    if stack and value == "children":
+                        continue  # Child nodes follow as start_map events
+                    if not stack and value == "document":
+                        continue  # The root node follows as a start_map event
+                    target = stack[-1] if stack else file_meta
+                    key = value
+                elif event == "start_map":
+                    # Outside a property value, every map is a node
+                    stack.append({})
+                elif event == "end_map" and stack:
+                    node = stack.pop()
+                    parent_id = stack[-1].get("id") if stack else None
+                    yield node, parent_id, len(stack), stack
+                # start_array/end_array here delimit a "children" list
+    
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        """Get the semaphore limiting concurrent downloads from the URL's host."""
+        host = urlparse(url).netloc
+        with self._host_slots_lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_host)
+                self._host_slots[host] = slot
+            return slot
+    
+    @staticmethod
+    def _part_path(filepath: Path) -> Path:
+        """Temporary path an in-progress download is written to."""
+        return filepath.with_name(f".{filepath.name}.part")
+    
+    # Read sizes for download bodies (see _chunk_size)
+    MIN_CHUNK_SIZE = 64 << 10
+    MAX_CHUNK_SIZE = 1 << 20
+    
+    @classmethod
+    def _chunk_size(cls, length: Optional[int]) -> int:
+        """Read size for a body of length bytes: about 16 reads, within the chunk size limits."""
+        if not length:
+            return cls.MIN_CHUNK_SIZE * 4
+        return min(cls.MAX_CHUNK_SIZE, max(cls.MIN_CHUNK_SIZE, 1 << (length // 16).bit_length()))
+    
+    def download_image(self, url: str, filepath: Path, resume_etag: Optional[str] = None,
+                       on_start: Optional[Callable[[Optional[str]], None]] = None) -> ContentDigest:
+        """Download an image from URL to filepath, returning the digest of its contents.
+        
+        The body is written to a temporary ".part" file and atomically renamed
+        into place, so filepath never holds a half-written image. If a partial
+        file exists and resume_etag is given, only the missing bytes are
+        requested (Range + If-Range); a changed asset is sent whole instead.
+        on_start receives the response ETag before any bytes are written.
+        The body is hashed as it is written, and a body shorter or longer
+        than its Content-Length raises IOError (keeping the ".part" file to
+        resume from).
+        """
+        part_path = self._part_path(filepath)
+        offset = part_path.stat().st_size if resume_etag and part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-", "If-Range": resume_etag} if offset else None
+        
+        with self._host_slot(url):
+            response = self.transport.get(url, stream=True, headers=headers, endpoint="cdn")
+            if response.status_code == 416 and offset:
+                # Partial file is unusable (e.g. already complete but never
+                # renamed): drop it and its ETag, and fetch the whole body in
+                # the host slot already held
+                response.close()
+                part_path.unlink(missing_ok=True)
+                if on_start is not None:
+                    on_start(None)
+                offset = 0
+                response = self.transport.get(url, stream=True, endpoint="cdn")
+            with response:
+                content = self._write_body(response, filepath, part_path, offset, on_start)
+        
+        # Renaming over the old file also detaches it from any hard link
+        # into the asset cache
+        os.replace(part_path, filepath)
+        return content
+    
+    def _write_body(self, response, filepath: Path, part_path: Path, offset: int,
+                    on_start: Optional[Callable[[Optional[str]], None]]) -> ContentDigest:
+        """Write a download response to part_path (appending at offset for a 206)."""
         response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        if on_start is not None:
+            on_start(response.headers.get("ETag"))
         
         filepath.parent.mkdir(parents=True, exist_ok=True)
         
-        with open(filepath, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        # requests decodes a Content-Encoding, which changes the length
+        length = response.headers.get("Content-Length")
+        expected = int(length) if length and not response.headers.get("Content-Encoding") else None
+        content = ContentDigest.of_file(part_path) if offset else ContentDigest()
+        with open(part_path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            if expected and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), offset, expected)
+                except OSError:
+                    pass
+            try:
+                for chunk in response.iter_content(chunk_size=self._chunk_size(expected)):
+                    f.write(chunk)
+                    content.update(chunk)
+            finally:
+                # Drop preallocated space the body never reached, so the
+                # part file's size stays the offset to resume from
+                f.truncate()
+        received = content.size - offset
+        self.metrics.count("bytes_downloaded", received)
+        if expected is not None and received != expected:
+            raise IOError(f"incomplete body: received {received} of {expected} bytes")
+        return content
+    
+    def _print(self, *values, **kwargs) -> None:
+        """print() to this downloader's log stream."""
+        print(*values, file=self.log_stream, **kwargs)
+    
+    def _log(self, message: str, detail: bool = False) -> None:
+        """Print a progress line without interleaving output from other workers.
+        
+        detail lines (one per finished file) are only printed in verbose mode.
+        """
+        if detail and not self.verbose:
+            return
+        with self._print_lock:
+            if self.progress is not None:
+                self.progress.write(message)
+            else:
+                self._print(message)
+    
+    def _finish_asset(self, ok: bool, size: int = 0) -> None:
+        """Count one finished (or failed) asset in the metrics and progress bar."""
+        self.metrics.count("assets_downloaded" if ok else "assets_failed")
+        if self.progress is not None:
+            self.progress.advance(size, failed=not ok)
+    
+    def _download_job(self, image_url: str, filepath: Path, label: str,
+                      cache_key: Optional[str] = None, cache_slot: Optional[str] = None) -> bool:
+        """Download one asset inside a worker, reporting success or failure."""
+        if self.sink is not None:
+            return self._sink_download_job(image_url, filepath, label, cache_key, cache_slot)
+        journal = self.journal
+        slot = cache_slot or str(filepath)
+        try:
+            resume_etag = journal.resume_etag(slot, cache_key) if journal is not None else None
+            on_start = None
+            if journal is not None:
+                on_start = lambda etag: journal.record("started", slot, key=cache_key,
+                                                       path=str(filepath), etag=etag)
+            started = time.perf_counter()
+            content = self.download_image(image_url, filepath, resume_etag, on_start)
+            self.metrics.count("download_seconds", time.perf_counter() - started)
+            self._register_output(filepath, cache_key, cache_slot, content=content)
+            size = content.size
+            if journal is not None:
+                journal.record("completed", slot, key=cache_key, path=str(filepath), size=size)
+            self._log(f"  ✓ {label}: saved to {filepath}", detail=True)
+            self._finish_asset(True, size)
+            return True
+        except Exception as e:
+            if journal is not None:
+                journal.record("failed", slot, key=cache_key, path=str(filepath), error=str(e))
+            self._log(f"  ✗ Failed to download {label}: {e}")
+            self._finish_asset(False)
+            return False
+    
+    def _sink_download_job(self, image_url: str, filepath: Path, label: str,
+                           cache_key: Optional[str] = None, cache_slot: Optional[str] = None) -> bool:
+        """_download_job for a streaming sink: the body goes straight into the sink (and the cache, if any)."""
+        name = self.sink.name_for(filepath)
+        try:
+            started = time.perf_counter()
+            with self._host_slot(image_url), \
+                    self.transport.get(image_url, stream=True, endpoint="cdn") as response:
+                response.raise_for_status()
+                length = response.headers.get("Content-Length")
+                # requests decodes a Content-Encoding, which changes the length
+                size = int(length) if length and not response.headers.get("Content-Encoding") else None
+                chunks = response.iter_content(chunk_size=self._chunk_size(size))
+                content = ContentDigest()
+                if self.cache is not None and cache_key:
+                    with self.cache.storing(cache_key, cache_slot, filepath, content) as tee:
+                        written = self.sink.write_stream(name, tee(chunks), size)
+                else:
+                    def observed(chunks: Iterator[bytes]) -> Iterator[bytes]:
+                        for chunk in chunks:
+                            content.update(chunk)
+                            yield chunk
+                    
+                    written = self.sink.write_stream(name, observed(chunks), size)
+                if size is not None and written != size:
+                    raise IOError(f"incomplete body: received {written} of {size} bytes")
+            # The cached blob is a local copy a placeholder can be made from
+            blob = self.cache.blob_for(cache_key) if self.cache is not None and cache_key else None
+            self._record_asset(filepath, cache_slot, content.hexdigest(), written, blob,
+                               header=bytes(content.header))
+            self.metrics.count("bytes_downloaded", written)
+            self.metrics.count("download_seconds", time.perf_counter() - started)
+            self._log(f"  ✓ {label}: saved to {name}", detail=True)
+            self._finish_asset(True, written)
+            return True
+        except Exception as e:
+            self._log(f"  ✗ Failed to download {label}: {e}")
+            self._finish_asset(False)
+            return False
+    
+    def _fetch_icon_job(self, image_url: str, cache_key: str, label: str) -> Optional[bytes]:
+        """Download one icon render into memory (and the cache), or None if it failed."""
+        try:
+            with self._host_slot(image_url), \
+                    self.transport.get(image_url, stream=True, endpoint="cdn") as response:
+                response.raise_for_status()
+                chunks = response.iter_content(chunk_size=self.MIN_CHUNK_SIZE)
+                if self.cache is not None:
+                    with self.cache.storing(cache_key) as tee:
+                        body = b"".join(tee(chunks))
+                else:
+                    body = b"".join(chunks)
+            self.metrics.count("bytes_downloaded", len(body))
+            self._log(f"  ✓ {label}", detail=True)
+            self._finish_asset(True, len(body))
+            return body
+        except Exception as e:
+            self._log(f"  ✗ Failed to download {label}: {e}")
+            self._finish_asset(False)
+            return None
+    
+    def _write_output(self, filepath: Path, data: bytes, slot: Optional[str] = None,
+                      meta: Optional[Dict] = None) -> None:
+        """Write a generated output (to the sink, if any), listing it in the manifest under slot."""
+        if self.sink is not None:
+            self.sink.write_stream(self.sink.name_for(filepath), iter([data]), len(data))
+        else:
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = filepath.with_name(filepath.name + ".tmp")
+            temp_path.write_bytes(data)
+            os.replace(temp_path, filepath)
+        if slot is None:
+            return
+        content = ContentDigest()
+        content.update(data)
+        if meta is not None:
+            self._asset_meta[slot] = meta
+        self._record_asset(filepath, slot, content.hexdigest(), content.size,
+                           filepath if self.sink is None else None, header=bytes(content.header))
+    
+    def _export_icons(self, file_id: str, index: NodeIndex, icons: List[Dict], icons_path: Path,
+                      executor: ThreadPoolExecutor) -> Tuple[int, int, int]:
+        """Fetch every render the atlas needs for icons, then write the sprite, atlas and lookup.
+        
+        All icons of one format go to /images in shared batches, icons with
+        the same subtree hash are rendered once, and renders cached by an
+        earlier run (as icons or as ordinary exports) are reused. Returns
+        (renders downloaded, renders cached, icons failed).
+        """
+        variants = self.atlas.variants()
+        # Renders by cache key, and the node each missing one is requested for
+        renders: Dict[str, bytes] = {}
+        wanted: Dict[str, str] = {}
+        groups: Dict[Tuple[str, float], List[str]] = {}
+        for node in icons:
+            for fmt, scale in variants:
+                cache_key = self._render_cache_key(index, node["id"], fmt, scale)
+                if cache_key in renders or cache_key in wanted:
+                    continue
+                blob = self.cache.blob_for(cache_key) if self.cache is not None else None
+                if blob is not None:
+                    renders[cache_key] = blob.read_bytes()
+                else:
+                    wanted[cache_key] = node["id"]
+                    groups.setdefault((fmt, scale), []).append(node["id"])
+        cached = len(renders)
+        
+        futures: Dict[str, Future] = {}
+        if groups:
+            names = {node["id"]: self.sanitize_filename(node["name"]) for node in icons}
+            with self.metrics.phase("resolve_renders"):
+                requests_by_variant = {variant: (node_ids, self.render_costs(index, node_ids, variant[1]))
+                                       for variant, node_ids in groups.items()}
+                for (fmt, scale), batch_urls in self.iter_variant_urls(file_id, requests_by_variant):
+                    for node_id, image_url in batch_urls.items():
+                        cache_key = self._render_cache_key(index, node_id, fmt, scale)
+                        if not image_url or cache_key in futures or wanted.get(cache_key) != node_id:
+                            continue
+                        futures[cache_key] = self._submit_job(executor, self._fetch_icon_job, image_url, cache_key,
+                                                              f"icon {names[node_id]} ({fmt})")
+        for cache_key, future in futures.items():
+            body = future.result()
+            if body is not None:
+                renders[cache_key] = body
+        
+        entries = []
+        failed = 0
+        for node in icons:
+            bodies = {fmt: renders.get(self._render_cache_key(index, node["id"], fmt, scale))
+                      for fmt, scale in variants}
+            if None in bodies.values():
+                self._log(f"  ⚠️  Leaving {node['name']} out of the icon atlas - no render available")
+                failed += 1
+                continue
+            entries.append((index.records.get(node["id"], node), bodies))
+        if not entries:
+            return len(futures), cached, failed
+        
+        with self.metrics.phase("pack_icons"):
+            files, skipped = self.atlas.build(entries)
+        for node_id, left_out_of in skipped:
+            name = index.records.get(node_id, {}).get("name", node_id)
+            if left_out_of is None:
+                self._log(f"  ⚠️  Leaving {name} out of the icon atlas - its render could not be read")
+                failed += 1
+            else:
+                self._log(f"  ⚠️  Leaving {name} out of {left_out_of} - its PNG render could not be read "
+                          f"(the SVG symbol is kept)")
+        metas = {IconAtlas.SPRITE_NAME: {"name": "Icon sprite", "type": "SPRITE"},
+                 IconAtlas.ATLAS_NAME: {"name": "Icon atlas", "type": "ATLAS", "scale": self.atlas.scale}}
+        for name, data in files.items():
+            # The lookup is data, not an image, so it stays out of the asset manifest
+            slot = self._slot(f"icons/{Path(name).stem}") if name in metas else None
+            self._write_output(icons_path / name, data, slot, metas.get(name))
+        return len(futures), cached, failed
+    
+    def _register_output(self, filepath: Path, cache_key: Optional[str] = None,
+                         cache_slot: Optional[str] = None, store: bool = True,
+                         content: Optional[ContentDigest] = None) -> None:
+        """Record a finished output file in the asset cache, duplicate index and manifest.
+        
+        store=False is for a file just restored from the cache, whose manifest
+        details are looked up (or worked out when the manifest is saved)
+        rather than read here. content is the digest taken while a download
+        was written; without it the file is hashed once for all three.
+        """
+        digest = content.hexdigest() if content is not None else None
+        if self.cache is not None and cache_key:
+            if store:
+                digest = self.cache.store(cache_key, filepath, cache_slot, content)["sha256"]
+            elif digest is None:
+                digest = self.cache.entries.get(cache_key, {}).get("sha256")
+        if digest is None and (self.dedup is not None or self.manifest is not None):
+            digest = AssetCache._hash_file(filepath)
+        if self.dedup is not None:
+            self.dedup.add(filepath, digest)
+        size = content.size if content is not None else filepath.stat().st_size
+        self._record_asset(filepath, cache_slot, digest, size, filepath, compute=store,
+                           header=bytes(content.header) if content is not None else None)
+    
+    def _record_asset(self, filepath: Path, slot: Optional[str], digest: Optional[str],
+                      size: Optional[int], source: Optional[Path], compute: bool = True,
+                      header: Optional[bytes] = None) -> None:
+        """Add an output to the run's manifest, if there is one."""
+        if self.manifest is None:
+            return
+        slot = slot or str(filepath)
+        key = slot[len(self._slot_prefix):] if slot.startswith(self._slot_prefix) else slot
+        path = filepath.relative_to(self.manifest.output_dir).as_posix()
+        self.manifest.add(key, path, source, digest, size, self._asset_meta.get(slot), compute, header)
+    
+    def _submit_download(self, executor: ThreadPoolExecutor, image_url: str,
+                         filepath: Path, label: str, cache_key: Optional[str] = None,
+                         cache_slot: Optional[str] = None) -> Future:
+        """Queue an asset download on the worker pool, blocking while the queue is full."""
+        if self.journal is not None:
+            self.journal.record("planned", cache_slot or str(filepath), key=cache_key, path=str(filepath))
+        return self._submit_job(executor, self._download_job, image_url, filepath, label, cache_key, cache_slot)
+    
+    def _submit_job(self, executor: ThreadPoolExecutor, job: Callable, *args) -> Future:
+        """Run a download job on the worker pool, blocking while the queue is full."""
+        if self.progress is not None:
+            self.progress.add_total()
+        with self.metrics.phase("queue_wait"):
+            self._queue_slots.acquire()
+        try:
+            future = executor.submit(job, *args)
+        except BaseException:
+            self._queue_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._queue_slots.release())
+        self._run_futures.append(future)
+        return future
+    
+    def _pipeline_renders(self, file_id: str, index: NodeIndex, pending: List[Tuple],
+                          executor: ThreadPoolExecutor, futures: List[Future], label: str,
+                          warn_missing: bool = False) -> int:
+        """Resolve render URLs batch by batch, queueing each download as soon as its URL arrives.
+        
+        pending holds (node, safe_name, filepath, cache_key, cache_slot, (format, scale))
+        tuples, and every (format, scale) group is resolved through one pool.
+        Only one render is requested per render signature (see
+        _render_signature); every other node with the same signature, in this
+        step or an earlier one, is linked to that render once it lands.
+        Returns the number of downloads queued.
+        """
+        with self.metrics.phase("resolve_renders"):
+            return self._pipeline_render_batches(file_id, index, pending, executor, futures,
+                                                 label, warn_missing)
+    
+    def _pipeline_render_batches(self, file_id: str, index: NodeIndex, pending: List[Tuple],
+                                 executor: ThreadPoolExecutor, futures: List[Future], label: str,
+                                 warn_missing: bool) -> int:
+        by_key = {}
+        groups: Dict[Tuple[str, float], List[str]] = {}
+        aliases = []
+        for item in pending:
+            node_id, (fmt, scale) = item[0]["id"], item[5]
+            signature = self._render_signature(index, node_id, fmt, scale)
+            if signature in self._render_sources:
+                aliases.append((item, signature))
+            else:
+                self._render_sources[signature] = None
+                by_key[(node_id, fmt, scale)] = (item, signature)
+                groups.setdefault((fmt, scale), []).append(node_id)
+        
+        requests_by_variant = {variant: (node_ids, self.render_costs(index, node_ids, variant[1]))
+                               for variant, node_ids in groups.items()}
+        seen = set()
+        queued = 0
+        for (fmt, scale), batch_urls in self.iter_variant_urls(file_id, requests_by_variant):
+            for node_id, image_url in batch_urls.items():
+                key = (node_id, fmt, scale)
+                entry = by_key.get(key)
+                if entry is None or key in seen:
+                    continue
+                seen.add(key)
+                (node, safe_name, filepath, cache_key, cache_slot, _variant), signature = entry
+                if not image_url:
+                    if warn_missing:
+                        self._log(f"  ⚠️  Skipping {node['name']} - empty image URL")
+                    continue
+                future = self._submit_download(executor, image_url, filepath, f"{label} {safe_name}",
+                                               cache_key, cache_slot)
+                self._render_sources[signature] = (filepath, future)
+                futures.append(future)
+                queued += 1
+        
+        if warn_missing:
+            for key, ((node, *_rest), _signature) in by_key.items():
+                if key not in seen:
+                    self._log(f"  ⚠️  Skipping {node['name']} - no image URL available")
+        
+        for item, signature in aliases:
+            future = self._link_render(item, self._render_sources.get(signature), f"{label} {item[1]}")
+            if future is not None:
+                futures.append(future)
+                self.renders_skipped += 1
+            elif warn_missing:
+                self._log(f"  ⚠️  Skipping {item[0]['name']} - no image URL available")
+        return queued
+    
+    def _link_render(self, item: Tuple, source: Optional[Tuple[Path, Optional[Future]]],
+                     label: str) -> Optional[Future]:
+        """Fill a duplicate render's output from the render it is identical to.
+        
+        Returns a future that resolves (like a download's) once the file is in
+        place, or None if the source render is not available.
+        """
+        if source is None:
+            return None
+        source_path, source_future = source
+        _node, _safe_name, filepath, cache_key, cache_slot, _variant = item
+        result: Future = Future()
+        if self.progress is not None:
+            self.progress.add_total()
+        
+        def link(_=None) -> None:
+            ok = source_future is None or (not source_future.cancelled() and source_future.result())
+            if ok and self.sink is not None:
+                try:
+                    self.sink.link(self.sink.name_for(filepath), self.sink.name_for(source_path))
+                    if self.manifest is not None:
+                        slot = cache_slot or str(filepath)
+                        self.manifest.add_alias(
+                            slot[len(self._slot_prefix):],
+                            filepath.relative_to(self.manifest.output_dir).as_posix(),
+                            source_path.relative_to(self.manifest.output_dir).as_posix(),
+                            self._asset_meta.get(slot))
+                    self._log(f"  ✓ {label}: linked to identical render {source_path.name}", detail=True)
+                except Exception as e:
+                    self._log(f"  ✗ Failed to link {label}: {e}")
+                    ok = False
+            elif ok:
+                try:
+                    AssetCache._link_or_copy(source_path, filepath)
+                    self._register_output(filepath, cache_key, cache_slot)
+                    if self.journal is not None:
+                        self.journal.record("completed", cache_slot or str(filepath), key=cache_key,
+                                            path=str(filepath), size=filepath.stat().st_size)
+                    self._log(f"  ✓ {label}: linked to identical render {source_path.name}", detail=True)
+                except OSError as e:
+                    self._log(f"  ✗ Failed to link {label}: {e}")
+                    ok = False
+            self.metrics.count("renders_linked" if ok else "assets_failed")
+            if self.progress is not None:
+                self.progress.advance(failed=not ok)
+            result.set_result(bool(ok))
+        
+        if source_future is None:
+            link()
+        else:
+            source_future.add_done_callback(link)
+        return result
+    
+    def _render_signature(self, index: NodeIndex, node_id: str, fmt: str = "png", scale: float = 2) -> Tuple:
+        """Key under which two renders are known to produce the same image.
+        
+        An INSTANCE with no overrides renders exactly like its main COMPONENT
+        at the same size (with the same component properties), so instances of
+        one component, and the component itself, share a signature. Any other
+        node shares one with every node whose subtree hash matches (including
+        itself, when exported in both STEP 2 and STEP 3). Without a render
+        cache nothing is hashed, and such a node only shares with itself.
+        """
+        record = index.records.get(node_id, {})
+        node_type = record.get("type")
+        component_id = None
+        if node_type == "COMPONENT":
+            component_id = node_id
+        elif node_type == "INSTANCE" and record.get("componentId") and not record.get("overrides"):
+            component_id = record["componentId"]
+        if component_id is None:
+            if self.cache is None:
+                return ("node", node_id, fmt, scale)
+            return ("subtree", index.subtree_hash(node_id), fmt, scale)
+        
+        box = record.get("absoluteBoundingBox") or {}
+        properties = json.dumps(record.get("componentProperties") or {}, sort_keys=True)
+        return ("component", component_id, round(box.get("width", 0), 2),
+                round(box.get("height", 0), 2), properties, fmt, scale)
+    
+    def _render_cache_key(self, index: NodeIndex, node_id: str, fmt: str = "png", scale: float = 2) -> str:
+        """Cache key for a node render, from its subtree hash.
+        
+        An unchanged subtree keeps its key across file versions, so only
+        nodes that changed (or are new) are sent to /images again. Without a
+        render cache the subtree isn't hashed, and the key (still used by the
+        journal) is the node id within this file version.
+        """
+        if self.cache is None:
+            return f"render:{self._file_version}/{node_id}:{fmt}@{scale:g}x"
+        return f"render:{index.subtree_hash(node_id)}:{fmt}@{scale:g}x"
+    
+    def _plan_renders(self, index: NodeIndex, nodes: List[Dict], directory: Path, name_format: str,
+                      slot_dir: str) -> Tuple[List[Tuple], int]:
+        """Plan every export variant of nodes (see ExportPlan), restoring cached ones.
+        
+        name_format is filled in with the node's safe name and id prefix.
+        Returns (pending renders for _pipeline_renders, number restored).
+        """
+        pending = []
+        cached_count = 0
+        for node in nodes:
+            safe_name = self.sanitize_filename(node["name"])
+            base_name = name_format.format(name=safe_name, id=node["id"][:8])
+            for variant in self.export_plan.variants(index.records.get(node["id"], node)):
+                fmt, scale, suffix = variant
+                cache_key = self._render_cache_key(index, node["id"], fmt, scale)
+                cache_slot = self._slot(ExportPlan.variant_slot(f"{slot_dir}/node:{node['id']}", variant))
+                meta = {"nodeId": node["id"], "name": node["name"], "type": node.get("type"), "scale": scale}
+                filepath, cached = self._plan_output(directory / f"{base_name}{suffix}.{fmt}", cache_key,
+                                                     cache_slot, meta)
+                if cached:
+                    cached_count += 1
+                    self._render_sources.setdefault(self._render_signature(index, node["id"], fmt, scale),
+                                                    (filepath, None))
+                else:
+                    pending.append((node, safe_name, filepath, cache_key, cache_slot, (fmt, scale)))
+        return pending, cached_count
+    
+    def _document_cache(self, cache_dir: Path) -> DocumentCache:
+        """The document cache for cache_dir, kept across runs of this downloader."""
+        documents = self._document_caches.get(cache_dir)
+        if documents is None:
+            documents = self._document_caches[cache_dir] = DocumentCache(cache_dir)
+        return documents
+    
+    @staticmethod
+    def _slot_in_file(index: NodeIndex, slot: str) -> bool:
+        """Whether the node or image fill an output slot was made for is still in the indexed file.
+        
+        Slots not tied to one node (the icon sprite and atlas) always count as present.
+        """
+        name = ExportPlan.base_slot(slot.split("/", 1)[-1])
+        if name.startswith("node:"):
+            return name[len("node:"):] in index.node_ids
+        if name.startswith("fill:"):
+            return name[len("fill:"):] in index.by_image_ref
+        return True
+    
+    def _slot(self, name: str) -> str:
+        """Cache/journal slot for an output of the current file."""
+        return f"{self._slot_prefix}{name}"
+    
+    def _plan_output(self, default_path: Path, cache_key: Optional[str], slot: str,
+                     meta: Optional[Dict] = None) -> Tuple[Path, bool]:
+        """Choose the output path for an asset and restore it from the cache if possible.
+        
+        Returns (filepath, cached). An asset slot keeps the path it was written
+        to last time instead of being renumbered next to its own earlier copy,
+        and an asset completed by an interrupted run counts as cached. Names
+        are only checked against this run's (see NameRegistry), never probed
+        on disk. meta is the node detail listed with the asset in the manifest.
+        """
+        with self.metrics.phase("plan_outputs"):
+            if meta is not None:
+                self._asset_meta[slot] = meta
+            return self._plan_output_path(default_path, cache_key, slot)
+    
+    def _plan_output_path(self, default_path: Path, cache_key: Optional[str], slot: str) -> Tuple[Path, bool]:
+        self._active_slots.add(slot)
+        previous = None
+        if self.cache is not None:
+            # Fall back to the slot's name from before slots were per file
+            previous = (self.cache.previous_path(slot)
+                        or self.cache.previous_path(slot[len(self._slot_prefix):]))
+        if previous is None and self.journal is not None:
+            previous = self.journal.path_for(slot)
+        if previous is not None and previous.parent == default_path.parent:
+            filepath = self._names.claim(previous)
+        else:
+            filepath = self._names.claim(default_path)
+        
+        if self.sink is not None:
+            blob = self.cache.blob_for(cache_key) if self.cache is not None and cache_key else None
+            if blob is None:
+                return filepath, False
+            self.sink.write_file(self.sink.name_for(filepath), blob)
+            self.cache.remember_output(slot, filepath)
+            entry = self.cache.entries.get(cache_key, {})
+            self._record_asset(filepath, slot, entry.get("sha256"), entry.get("size"), blob, compute=False)
+            return filepath, True
+        if self.cache is not None and cache_key and self.cache.restore(cache_key, filepath, slot):
+            self._register_output(filepath, cache_key, slot, store=False)
+            return filepath, True
+        if self.journal is not None and self.journal.is_completed(slot, cache_key, filepath):
+            self._register_output(filepath, cache_key, slot)
+            return filepath, True
+        return filepath, False
+    
+    @staticmethod
+    def _collect_downloads(futures: List[Future]) -> Tuple[int, int]:
+        """Wait for queued downloads and return (downloaded, failed) counts."""
+        downloaded = 0
+        failed = 0
+        for future in futures:
+            if future.result():
+                downloaded += 1
+            else:
+                failed += 1
+        return downloaded, failed
     
     def sanitize_filename(self, filename: str) -> str:
         """Sanitize filename to be filesystem-safe."""
@@ -240,87 +3678,309 @@ class FigmaAssetDownloader:
             filename = filename[:200]
         return filename or "unnamed"
     
-    def download_assets(self, file_id: str, output_dir: str = "assets", export_all: bool = True) -> None:
-        """Main method to download all assets from a Figma file."""
-        print(f"Fetching Figma file data for {file_id}...")
-        file_data = self.get_file_data(file_id, include_images=True)
+    def stream_node_index(self, file_id: str, file_meta: Dict,
+                          selector: Optional[NodeSelector] = None, hashed: bool = True) -> NodeIndex:
+        """Stream the file into a NodeIndex without materialising the document tree.
+        
+        Subtree hashes are only needed for render cache keys, so pass
+        hashed=False when there is no render cache.
+        """
+        return NodeIndex.from_stream(self.stream_file_nodes(file_id, file_meta), self.node_image_fills,
+                                     self._index_filter(selector), selector, hashed)
+    
+    def download_assets(self, file_id: str, output_dir: str = "assets", export_all: bool = True,
+                        stream: bool = False, use_cache: bool = True,
+                        cache_dir: Optional[str] = None, resume: bool = True,
+                        dedupe: bool = True, perceptual: bool = False,
+                        metrics_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+                        trace_memory: bool = False, cache: Optional[AssetCache] = None,
+                        executor: Optional[ThreadPoolExecutor] = None,
+                        file_version: Optional[str] = None,
+                        selector: Optional[NodeSelector] = None,
+                        export_plan: Optional[ExportPlan] = None,
+                        sink: Optional[OutputSink] = None, manifest: bool = True,
+                        placeholders: bool = True, public_path: str = "",
+                        atlas: Optional[IconAtlas] = None) -> int:
+        """Main method to download all assets from a Figma file.
+        
+        With stream=True the file JSON is parsed incrementally and the document
+        tree is never held in memory (requires ijson). With use_cache=True
+        (default) assets already fetched by an earlier run are restored from
+        the content-addressed cache in cache_dir (default: <output>/.figma_cache)
+        instead of being downloaded again. With resume=True (default) a run
+        that was interrupted picks up from its journal in the output directory.
+        With dedupe=True (default) identical renders are requested once and
+        byte-identical files are hard-linked, with the groups listed in
+        duplicates.json; perceptual=True also reports near-identical images.
+        Per-phase timings, throughput and request latencies are written as
+        JSON to metrics_path and/or in Prometheus text format to
+        prometheus_path; trace_memory adds the tracemalloc peak. A NodeSelector
+        limits the run to part of the file; when it names pages, paths or
+        node ids only those subtrees are fetched. An ExportPlan sets the formats
+        and scales renders are exported at (default: each node's export
+        settings, else PNG at 2x); all variants resolve in the same pass. A
+        non-local OutputSink (tar, zip, S3) receives each body as it streams
+        in instead of output_dir, which then only holds the cache. With
+        manifest=True (default) asset-manifest.json and asset-manifest.ts list
+        every output with its size, hash and (placeholders=True, with Pillow)
+        a tiny placeholder image; src paths are prefixed with public_path.
+        An IconAtlas packs small icons into icons/ (a symbol sprite and/or a
+        PNG atlas) instead of rendering each one to frames/.
+        
+        A shared cache and download executor can be passed in when several
+        files are synced at once (see FigmaBulkSync). file_version, if the
+        caller already checked it, saves the version request. Returns the
+        number of failed downloads.
+        """
+        if self._shared_run:
+            return self._download_assets(file_id, output_dir, export_all, stream, use_cache, cache_dir,
+                                         resume, dedupe, perceptual, cache, executor, file_version,
+                                         selector, export_plan, sink, manifest, placeholders, public_path,
+                                         atlas)
+        
+        self.metrics = RunMetrics(trace_memory)
+        self.transport.observer = self.metrics.observe_request
+        retries_before = self.transport.retries
+        try:
+            return self._download_assets(file_id, output_dir, export_all, stream, use_cache, cache_dir,
+                                         resume, dedupe, perceptual, cache, executor, file_version,
+                                         selector, export_plan, sink, manifest, placeholders, public_path,
+                                         atlas)
+        finally:
+            self.metrics.finish(self.transport.retries - retries_before)
+            if metrics_path:
+                self.metrics.write_json(Path(metrics_path))
+                self._print(f"📈 Metrics written to {metrics_path}")
+            if prometheus_path:
+                self.metrics.write_prometheus(Path(prometheus_path))
+    
+    def _download_assets(self, file_id: str, output_dir: str, export_all: bool, stream: bool,
+                         use_cache: bool, cache_dir: Optional[str], resume: bool,
+                         dedupe: bool, perceptual: bool, cache: Optional[AssetCache],
+                         executor: Optional[ThreadPoolExecutor], file_version: Optional[str],
+                         selector: Optional[NodeSelector], export_plan: Optional[ExportPlan],
+                         sink: Optional[OutputSink], manifest: bool, placeholders: bool,
+                         public_path: str, atlas: Optional[IconAtlas]) -> int:
+        output_path = Path(output_dir)
+        self.export_plan = export_plan or ExportPlan()
+        self.atlas = atlas
+        self.sink = sink if sink is not None and not sink.local else None
+        self.cache = None
+        if cache is not None:
+            self.cache = cache
+        elif use_cache:
+            self.cache = AssetCache(Path(cache_dir) if cache_dir else output_path / ".figma_cache")
+        
+        # An unchanged file is loaded from the document cache without
+        # transferring the document at all
+        if selector is not None and not selector.active:
+            selector = None
+        # Part of a file (a selection) is cached apart from the whole file
+        document_key = file_id if selector is None else f"{file_id}@{selector.fingerprint()}"
+        fetch_selected = selector is not None and (selector.narrows_pages or bool(selector.node_ids))
+        file_info = None
+        documents = self._document_cache(self.cache.cache_dir) if self.cache is not None else None
+        cached_document = None
+        if documents is not None:
+            if file_version is None:
+                file_info = self.get_file_version(file_id)
+                file_version = file_info.get("version")
+            with self.metrics.phase("load_cached_document"):
+                cached_document = documents.load(document_key, file_version)
+        
+        if cached_document is not None:
+            file_data, index = cached_document
+            self._print(f"Figma file {file_id} unchanged since last run (version {file_data['version']}); "
+                  f"using the cached document")
+            self.metrics.count("documents_cached")
+        elif fetch_selected:
+            # Pages and nodes outside the selection are never transferred
+            self._print(f"Fetching the selected part of Figma file {file_id}...")
+            if file_info is None:
+                file_info = self.get_file_version(file_id)
+            file_data = self.get_selected_document(file_id, selector, file_info["pages"])
+            for key in ("name", "version", "lastModified"):
+                file_data.setdefault(key, file_info.get(key))
+            document = file_data.pop("document")
+            if selector.node_ids:
+                selector = selector.without_paths()
+            with self.metrics.phase("build_index"):
+                index = self.build_node_index(document, selector)
+        elif stream:
+            self._print(f"Streaming Figma file data for {file_id}...")
+            file_data: Dict = {}
+            with self.metrics.phase("stream_parse"):
+                index = self.stream_node_index(file_id, file_data, selector, hashed=self.cache is not None)
+        else:
+            self._print(f"Fetching Figma file data for {file_id}...")
+            file_data = self.get_file_data(file_id, include_images=True)
+            document = file_data.get("document", {})
+            with self.metrics.phase("build_index"):
+                index = self.build_node_index(document, selector) if document else NodeIndex()
+            # Later steps query the index, which keeps what it needs of the tree
+            file_data.pop("document", None)
+        if cached_document is None and documents is not None:
+            with self.metrics.phase("store_document"):
+                documents.store(document_key, file_data, index)
+        self.metrics.count("nodes", len(index))
+        self._file_version = file_data.get("version")
         
-        document = file_data.get("document", {})
         file_name = file_data.get("name", "figma_design")
+        self.file_name = file_name
         
-        print(f"File: {file_name}")
+        self._print(f"File: {file_name}")
         
         # Debug: Check document structure
-        if not document:
-            print("⚠️  Warning: No 'document' key found in file data")
-            print(f"Available keys: {list(file_data.keys())}")
-            return
+        if not len(index):
+            self._print("⚠️  Warning: No 'document' key found in file data")
+            self._print(f"Available keys: {list(file_data.keys())}")
+            return 0
         
         # Check if document has children
-        doc_children = document.get("children", [])
-        print(f"Document has {len(doc_children)} top-level children")
+        doc_children = index.top_level
+        self._print(f"Document has {len(doc_children)} top-level children")
+        
+        image_assets = index.image_assets
+        with self.metrics.phase("find_exportable"):
+            image_nodes = self.exportable_nodes(index, export_all, selector)
+        if selector is not None:
+            self._print(f"Selection: {len(index) - len(index.unselected)} node(s) in scope, "
+                  f"{len(image_nodes)} to export")
         
         # Create output directories
-        output_path = Path(output_dir)
         frames_path = output_path / "frames"
         images_path = output_path / "images"
-        frames_path.mkdir(parents=True, exist_ok=True)
-        images_path.mkdir(parents=True, exist_ok=True)
+        if self.sink is None:
+            frames_path.mkdir(parents=True, exist_ok=True)
+            images_path.mkdir(parents=True, exist_ok=True)
         
-        # Initialize counters
-        images_downloaded = 0
-        images_failed = 0
-        frames_downloaded = 0
-        frames_failed = 0
+        # A sink is written afresh each run, so there is nothing to resume and
+        # no local files to hard-link (identical renders are still linked by
+        # the sink itself)
+        self.journal = None
+        if self.sink is None:
+            journal_path = output_path / DownloadJournal.FILE_NAME
+            if not resume and journal_path.exists():
+                journal_path.unlink()
+            self.journal = DownloadJournal(journal_path)
+        self.dedup = DuplicateIndex(output_path, perceptual) if dedupe and self.sink is None else None
+        self._render_sources = {}
+        self.renders_skipped = 0
+        if self.dedup is not None and perceptual and Image is None:
+            self._print("⚠️  Perceptual hashing requires Pillow (pip install Pillow); using exact hashes only")
+        if self.journal is not None and len(self.journal):
+            self._print(f"Resuming interrupted run ({len(self.journal)} assets in journal)")
         
-        # ===== STEP 1: Find and download individual image assets =====
-        print("\n" + "="*60)
-        print("STEP 1: Finding individual image assets...")
-        print("="*60)
+        # Downloads from all three steps share one worker pool, so STEP 2 and
+        # STEP 3 URL resolution overlaps with STEP 1 downloads already in flight
+        self._names.clear()
+        self._asset_meta = {}
+        self.manifest = None
+        if manifest:
+            # A partial run leaves the rest of the output (and its entries) in place
+            self.manifest = AssetManifest(output_path, public_path, placeholders, keep_previous=selector is not None)
+        self._run_futures = []
+        self._slot_prefix = f"{file_id}/"
+        self._active_slots = set()
+        # Parallel files would garble one another's bars
+        self.progress = ProgressBar() if not self.verbose and not self._shared_run else None
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        failed = None
+        try:
+            failed = self._download_all_steps(file_id, file_data, index, image_assets, image_nodes,
+                                              images_path, frames_path, executor)
+            if self.cache is not None and selector is None and self.sink is None:
+                # Outputs of nodes (and fills) that are gone from the file. A
+                # partial run can't tell removed nodes from unselected ones.
+                removed = self.cache.prune_outputs(self._slot_prefix, self._active_slots, output_path,
+                                                   lambda slot: self._slot_in_file(index, slot))
+                if removed:
+                    self._print(f"🗑️  Removed {removed} output(s) of nodes or image fills no longer in the file")
+            return failed
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
+            else:
+                wait(self._run_futures)
+            if self.progress is not None:
+                self.progress.close()
+                self.progress = None
+            if self.cache is not None:
+                self.cache.save()
+            # Keep the journal around for the next run unless everything succeeded
+            if self.journal is not None:
+                self.journal.close(clean=failed == 0)
+                self.journal = None
+            if self.dedup is not None:
+                self.dedup.save()
+            if self.manifest is not None and failed is not None:
+                self.manifest.save(self.sink)
+                target = (self.sink.name_for(self.manifest.path) if self.sink is not None
+                          else self.manifest.path)
+                self._print(f"🧾 Asset manifest: {target} ({len(self.manifest.assets)} assets)")
+                self.manifest = None
+    
+    def _download_all_steps(self, file_id: str, file_data: Dict, index: NodeIndex,
+                            image_assets: List[Dict], image_nodes: List[Dict],
+                            images_path: Path, frames_path: Path,
+                            executor: ThreadPoolExecutor) -> int:
+        """Run STEP 1-3, queueing every download on the shared executor.
         
-        image_assets = []
-        self.find_image_fills(document, image_assets)
+        Returns the number of failed downloads.
+        """
+        image_futures: List[Future] = []
+        frame_futures: List[Future] = []
+        images_cached = 0
+        frames_cached = 0
+        
+        # ===== STEP 1: Find and download individual image assets =====
+        self._print("\n" + "="*60)
+        self._print("STEP 1: Finding individual image assets...")
+        self._print("="*60)
         
         if image_assets:
-            print(f"Found {len(image_assets)} nodes with image fills/images")
+            self._print(f"Found {len(image_assets)} nodes with image fills/images")
             
             # Show breakdown by node type
             type_counts = {}
             for asset in image_assets:
                 node_type = asset["nodeType"]
                 type_counts[node_type] = type_counts.get(node_type, 0) + 1
-            print("Breakdown by node type:")
+            self._print("Breakdown by node type:")
             for node_type, count in sorted(type_counts.items()):
-                print(f"  - {node_type}: {count}")
+                self._print(f"  - {node_type}: {count}")
             
             # Get unique image references
             unique_image_refs = list(set([asset["imageRef"] for asset in image_assets if asset["imageRef"]]))
-            print(f"\nFound {len(unique_image_refs)} unique image references")
+            self._print(f"\nFound {len(unique_image_refs)} unique image references")
             
             if not unique_image_refs:
-                print("  ⚠️  No image references found. Checking file data structure...")
+                self._print("  ⚠️  No image references found. Checking file data structure...")
                 # Debug: show what's in file_data
                 if "images" in file_data:
-                    print(f"  File data contains 'images' key with {len(file_data['images'])} entries")
+                    self._print(f"  File data contains 'images' key with {len(file_data['images'])} entries")
                 else:
-                    print("  File data does not contain 'images' key")
-                    print(f"  Available keys: {list(file_data.keys())}")
+                    self._print("  File data does not contain 'images' key")
+                    self._print(f"  Available keys: {list(file_data.keys())}")
             
             # Get image URLs from file data
-            print("\nExtracting image URLs from file data...")
-            image_urls = self.get_image_fill_urls(file_data, unique_image_refs)
+            self._print("\nExtracting image URLs from file data...")
+            with self.metrics.phase("resolve_fills"):
+                image_urls = self.get_image_fill_urls(file_data, unique_image_refs, file_id)
             
             if image_urls:
-                print(f"\nDownloading {len(image_urls)} individual images to {images_path}...")
+                queued_before = len(image_futures)
                 
                 for image_ref, image_url in image_urls.items():
                     if not image_url:
                         continue
                     
                     # Find the first node that uses this image for naming
-                    asset_info = next((a for a in image_assets if a["imageRef"] == image_ref), None)
-                    if asset_info:
-                        safe_name = self.sanitize_filename(asset_info["nodeName"])
+                    node_ids = index.by_image_ref.get(image_ref)
+                    if node_ids:
+                        safe_name = self.sanitize_filename(index.records[node_ids[0]].get("name", "unnamed"))
                     else:
                         safe_name = "image"
                     
@@ -332,36 +3992,33 @@ class FigmaAssetDownloader:
                         file_ext = "svg"
                     
                     filename = f"{safe_name}_{image_ref[:8]}.{file_ext}"
-                    filepath = images_path / filename
-                    
-                    # Avoid duplicates
-                    if filepath.exists():
-                        counter = 1
-                        base_name = filepath.stem
-                        while filepath.exists():
-                            filename = f"{base_name}_{counter}.{file_ext}"
-                            filepath = images_path / filename
-                            counter += 1
+                    # Avoid duplicates (or reuse this image's path from an earlier run)
+                    cache_key = f"fill:{image_ref}"
+                    cache_slot = self._slot(f"images/{cache_key}")
+                    meta = {"imageRef": image_ref, "nodeId": node_ids[0] if node_ids else None,
+                            "name": index.records[node_ids[0]].get("name") if node_ids else None}
+                    filepath, cached = self._plan_output(images_path / filename, cache_key, cache_slot, meta)
+                    if cached:
+                        images_cached += 1
+                        continue
                     
-                    try:
-                        print(f"  📥 Downloading image: {safe_name}...")
-                        self.download_image(image_url, filepath)
-                        images_downloaded += 1
-                        print(f"     ✓ Saved to {filepath}")
-                    except Exception as e:
-                        print(f"     ✗ Failed to download {safe_name}: {e}")
-                        images_failed += 1
+                    image_futures.append(
+                        self._submit_download(executor, image_url, filepath, f"image {safe_name}",
+                                              cache_key, cache_slot)
+                    )
                 
-                print(f"\n✅ Individual images: {images_downloaded} downloaded, {images_failed} failed")
+                if images_cached:
+                    self._print(f"Reusing {images_cached} cached image(s)")
+                self._print(f"\nQueued {len(image_futures) - queued_before} individual images for download to {images_path}")
             else:
-                print("No image URLs returned from Figma API for image fills.")
+                self._print("No image URLs returned from Figma API for image fills.")
         else:
-            print("No individual image assets found.")
+            self._print("No individual image assets found.")
         
         # ===== STEP 2: Export individual nodes with images as separate assets =====
-        print("\n" + "="*60)
-        print("STEP 2: Exporting individual nodes with images...")
-        print("="*60)
+        self._print("\n" + "="*60)
+        self._print("STEP 2: Exporting individual nodes with images...")
+        self._print("="*60)
         
         # Find nodes that contain images and export them individually
         nodes_with_images = []
@@ -380,113 +4037,76 @@ class FigmaAssetDownloader:
             seen_ids = set()
             unique_nodes = []
             for node in nodes_with_images:
-                if node["id"] not in seen_ids:
-                    seen_ids.add(node["id"])
-                    unique_nodes.append(node)
-            
-            print(f"Found {len(unique_nodes)} individual nodes with images to export")
-            
-            # Get image URLs for these nodes
-            node_ids = [node["id"] for node in unique_nodes]
-            print("Fetching image URLs for individual nodes...")
-            individual_image_urls = self.get_image_urls(file_id, node_ids)
-            
-            if individual_image_urls:
-                print(f"\nDownloading {len(individual_image_urls)} individual node images to {images_path}...")
-                
-                for node in unique_nodes:
-                    node_id = node["id"]
-                    if node_id not in individual_image_urls:
-                        continue
-                    
-                    image_url = individual_image_urls[node_id]
-                    if not image_url:
-                        continue
-                    
-                    safe_name = self.sanitize_filename(node["name"])
-                    filename = f"{safe_name}_node_{node_id[:8]}.png"
-                    filepath = images_path / filename
-                    
-                    # Avoid duplicates
-                    if filepath.exists():
-                        counter = 1
-                        base_name = filepath.stem
-                        while filepath.exists():
-                            filename = f"{base_name}_{counter}.png"
-                            filepath = images_path / filename
-                            counter += 1
-                    
-                    try:
-                        print(f"  📥 Downloading node image: {safe_name}...")
-                        self.download_image(image_url, filepath)
-                        images_downloaded += 1
-                        print(f"     ✓ Saved to {filepath}")
-                    except Exception as e:
-                        print(f"     ✗ Failed to download {safe_name}: {e}")
-                        images_failed += 1
+                if node["id"] not in seen_ids:
+                    seen_ids.add(node["id"])
+                    unique_nodes.append(node)
+            
+            self._print(f"Found {len(unique_nodes)} individual nodes with images to export")
+            
+            # Restore renders cached by an earlier run of this file version
+            # (new paths avoid existing files; a render keeps its earlier path)
+            pending, cached = self._plan_renders(index, unique_nodes, images_path, "{name}_node_{id}", "images")
+            images_cached += cached
+            if cached:
+                self._print(f"Reusing {cached} cached node image(s)")
+            
+            # Resolve image URLs for these nodes, downloading each batch as it arrives
+            if pending:
+                self._print("Fetching image URLs for individual nodes (downloads start as batches resolve)...")
+                queued = self._pipeline_renders(file_id, index, pending, executor, image_futures, "node image")
+                if queued:
+                    self._print(f"\nQueued {queued} individual node images for download to {images_path}")
+                else:
+                    self._print("No image URLs returned for individual nodes.")
             else:
-                print("No image URLs returned for individual nodes.")
+                self._print("All individual node images are up to date.")
         else:
-            print("No individual nodes with images found to export separately.")
+            self._print("No individual nodes with images found to export separately.")
         
         # ===== STEP 3: Find and download frame screenshots =====
-        print("\n" + "="*60)
-        print("STEP 3: Finding frames and components to export...")
-        print("="*60)
-        
-        image_nodes = []
-        self.find_image_nodes(document, image_nodes, export_all)
+        self._print("\n" + "="*60)
+        self._print("STEP 3: Finding frames and components to export...")
+        self._print("="*60)
         
         if not image_nodes:
-            print("No exportable frames/components found in the design.")
-            print("\nDebug: Analyzing document structure...")
+            self._print("No exportable frames/components found in the design.")
+            self._print("\nDebug: Analyzing document structure...")
             # Debug: show full structure
-            def debug_nodes(node, depth=0, max_depth=5, max_children=10):
-                if depth > max_depth:
-                    return
-                node_type = node.get("type", "UNKNOWN")
-                node_name = node.get("name", "unnamed")
-                node_id = node.get("id", "no-id")
-                indent = "  " * depth
-                print(f"{indent}- {node_type}: {node_name} (id: {node_id[:8]})")
-                
-                children = node.get("children", [])
-                if children:
-                    print(f"{indent}  [has {len(children)} children]")
-                    for i, child in enumerate(children[:max_children]):
-                        debug_nodes(child, depth + 1, max_depth, max_children)
-                    if len(children) > max_children:
-                        print(f"{indent}  ... and {len(children) - max_children} more children")
-            
-            print("Full document structure:")
-            debug_nodes(document, max_depth=4, max_children=20)
+            def debug_nodes(node, max_depth=5, max_children=10):
+                # Iterative walk over the tree, printing nodes in tree order
+                stack = [(node, 0)]
+                while stack:
+                    node, depth = stack.pop()
+                    if depth > max_depth:
+                        continue
+                    indent = "  " * depth
+                    self._print(f"{indent}- {node.get('type', 'UNKNOWN')}: {node.get('name', 'unnamed')} (id: {node.get('id', 'no-id')[:8]})")
+                    
+                    children = node.get("children", [])
+                    if children:
+                        self._print(f"{indent}  [has {len(children)} children]")
+                        if len(children) > max_children and depth + 1 <= max_depth:
+                            self._print(f"{indent}  ... showing first {max_children} of {len(children)} children")
+                        stack.extend((child, depth + 1) for child in reversed(children[:max_children]))
             
-            # Also try to find ANY nodes regardless of type
-            all_nodes = []
-            def collect_all_nodes(node, node_list):
-                node_list.append({
-                    "type": node.get("type", "UNKNOWN"),
-                    "name": node.get("name", "unnamed"),
-                    "id": node.get("id", "no-id")
-                })
-                for child in node.get("children", []):
-                    collect_all_nodes(child, node_list)
+            root = index.node(index.root_id)
+            if root is None:
+                self._print("Full document structure: not kept for streamed or cached documents")
+            else:
+                self._print("Full document structure:")
+                debug_nodes(root, max_depth=4, max_children=20)
             
-            collect_all_nodes(document, all_nodes)
-            print(f"\nTotal nodes found in document: {len(all_nodes)}")
-            if all_nodes:
-                print("Node types found:")
-                type_counts = {}
-                for node in all_nodes:
-                    node_type = node["type"]
-                    type_counts[node_type] = type_counts.get(node_type, 0) + 1
-                for node_type, count in sorted(type_counts.items(), key=lambda x: -x[1]):
-                    print(f"  - {node_type}: {count}")
+            # Also report ANY nodes regardless of type
+            self._print(f"\nTotal nodes found in document: {len(index)}")
+            if len(index):
+                self._print("Node types found:")
+                for node_type, count in sorted(index.type_counts().items(), key=lambda x: -x[1]):
+                    self._print(f"  - {node_type}: {count}")
             
             if not image_assets:
-                return
+                return 0
         
-        print(f"Found {len(image_nodes)} exportable frames/components")
+        self._print(f"Found {len(image_nodes)} exportable frames/components")
         
         # Show breakdown by type
         type_counts = {}
@@ -494,60 +4114,365 @@ class FigmaAssetDownloader:
             node_type = node["type"]
             type_counts[node_type] = type_counts.get(node_type, 0) + 1
         
-        print("Breakdown by type:")
+        self._print("Breakdown by type:")
         for node_type, count in sorted(type_counts.items()):
-            print(f"  - {node_type}: {count}")
+            self._print(f"  - {node_type}: {count}")
         
-        # Get node IDs
-        node_ids = [node["id"] for node in image_nodes]
+        if self.export_plan.defaults != [ExportPlan.LEGACY_VARIANT] or not self.export_plan.use_export_settings:
+            self._print(f"Export plan: {self.export_plan.describe()}"
+                  + (" (or each node's export settings)" if self.export_plan.use_export_settings else ""))
         
-        print("\nFetching frame screenshot URLs from Figma...")
-        image_urls = self.get_image_urls(file_id, node_ids)
+        # Small icons go into the sprite/atlas instead of frames/
+        icons = []
+        if self.atlas is not None and self.atlas.variants():
+            icons = [node for node in image_nodes if self.atlas.wants(index.records.get(node["id"], node))]
+            icon_ids = {node["id"] for node in icons}
+            image_nodes = [node for node in image_nodes if node["id"] not in icon_ids]
         
-        if not image_urls:
-            print("No image URLs returned from Figma API for frames.")
+        # Restore frames cached by an earlier run of this file version
+        # (frames overwrite earlier runs, but two frames in this run must
+        # never share a file)
+        pending, frames_cached = self._plan_renders(index, image_nodes, frames_path, "{name}_{id}", "frames")
+        if frames_cached:
+            self._print(f"Reusing {frames_cached} cached frame screenshot(s)")
+        
+        # Resolve screenshot URLs, downloading each batch as it arrives
+        if pending:
+            self._print("\nFetching frame screenshot URLs from Figma (downloads start as batches resolve)...")
+            queued = self._pipeline_renders(file_id, index, pending, executor, frame_futures, "frame",
+                                            warn_missing=True)
+            if queued:
+                self._print(f"\nQueued {queued} frame screenshots for download to {frames_path}")
+            else:
+                self._print("No image URLs returned from Figma API for frames.")
         else:
-            print(f"\nDownloading {len(image_urls)} frame screenshots to {frames_path}...")
-            
-            for node in image_nodes:
-                node_id = node["id"]
-                if node_id not in image_urls:
-                    print(f"  ⚠️  Skipping {node['name']} - no image URL available")
-                    continue
-                
-                image_url = image_urls[node_id]
-                if not image_url:
-                    print(f"  ⚠️  Skipping {node['name']} - empty image URL")
-                    continue
-                
-                # Create filename
-                safe_name = self.sanitize_filename(node["name"])
-                filename = f"{safe_name}_{node_id[:8]}.png"
-                filepath = frames_path / filename
-                
-                try:
-                    print(f"  📥 Downloading frame: {safe_name}...")
-                    self.download_image(image_url, filepath)
-                    frames_downloaded += 1
-                    print(f"     ✓ Saved to {filepath}")
-                except Exception as e:
-                    print(f"     ✗ Failed to download {safe_name}: {e}")
-                    frames_failed += 1
-            
-            print(f"\n✅ Frame screenshots: {frames_downloaded} downloaded, {frames_failed} failed")
+            self._print("All frame screenshots are up to date.")
+        
+        icons_downloaded = icons_cached = icons_failed = 0
+        if icons:
+            icons_path = frames_path.parent / "icons"
+            self._print(f"\nPacking {len(icons)} small icon(s) into {icons_path} ({self.atlas.mode})...")
+            icons_downloaded, icons_cached, icons_failed = self._export_icons(file_id, index, icons, icons_path,
+                                                                              executor)
+        
+        # ===== Wait for all queued downloads =====
+        self._print(f"\nWaiting for downloads to finish ({self.concurrency} workers)...")
+        if self.progress is not None:
+            self.progress.show()
+        with self.metrics.phase("drain_downloads"):
+            images_downloaded, images_failed = self._collect_downloads(image_futures)
+            frames_downloaded, frames_failed = self._collect_downloads(frame_futures)
+        if self.progress is not None:
+            self.progress.close()
+        if image_futures or images_cached:
+            self._print(f"\n✅ Individual images: {images_downloaded} downloaded, {images_cached} cached, {images_failed} failed")
+        if frame_futures or frames_cached:
+            self._print(f"✅ Frame screenshots: {frames_downloaded} downloaded, {frames_cached} cached, {frames_failed} failed")
+        if icons:
+            self._print(f"✅ Icons: {len(icons) - icons_failed} packed ({icons_downloaded} renders downloaded, "
+                  f"{icons_cached} cached), {icons_failed} failed")
         
         # ===== SUMMARY =====
-        print("\n" + "="*60)
-        print("📊 SUMMARY")
-        print("="*60)
+        self._print("\n" + "="*60)
+        self._print("📊 SUMMARY")
+        self._print("="*60)
         total_downloaded = images_downloaded + frames_downloaded
-        total_failed = images_failed + frames_failed
-        print(f"✅ Total assets downloaded: {total_downloaded}")
+        total_failed = images_failed + frames_failed + icons_failed
+        self._print(f"✅ Total assets downloaded: {total_downloaded}")
+        if images_cached or frames_cached:
+            self._print(f"♻️  Reused from cache: {images_cached + frames_cached}")
+        if self.renders_skipped:
+            self._print(f"🔗 Identical renders not re-requested: {self.renders_skipped}")
+        if self.dedup is not None and self.dedup.linked:
+            self._print(f"🔗 Duplicate files linked: {self.dedup.linked} "
+                  f"({self.dedup.bytes_saved / (1 << 20):.1f} MB saved, see {self.dedup.path})")
         if total_failed > 0:
-            print(f"⚠️  Failed downloads: {total_failed}")
-        print(f"\n📁 Assets organized in:")
-        print(f"   - Frames: {frames_path}")
-        print(f"   - Individual images: {images_path}")
+            self._print(f"⚠️  Failed downloads: {total_failed}")
+        self.metrics.count("assets_cached", images_cached + frames_cached)
+        self._print(f"⏱️  Phases: {self.metrics.summary_line()}")
+        if self.sink is not None:
+            self._print(f"\n📦 Assets written to {self.sink.describe()} (frames/ and images/)")
+            return total_failed
+        self._print(f"\n📁 Assets organized in:")
+        self._print(f"   - Frames: {frames_path}")
+        self._print(f"   - Individual images: {images_path}")
+        return total_failed
+
+
+class FigmaBulkSync:
+    """Syncs many Figma files at once through one shared scheduler.
+    
+    Each file runs on a fork of one downloader (see FigmaAssetDownloader.fork),
+    so all files share its connection pools, per-endpoint rate limits and
+    bounded download queue, plus one download worker pool and one asset
+    cache. Up to parallel_files files are processed at a time, so total sync
+    time is bounded by the API budgets rather than by running the files one
+    after another. Each file's log goes to <output>/<file id>/sync.log.
+    """
+    
+    LOG_NAME = "sync.log"
+    
+    def __init__(self, downloader: FigmaAssetDownloader, parallel_files: int = 4):
+        self.downloader = downloader
+        self.parallel_files = max(1, parallel_files)
+    
+    def _get_json(self, path: str) -> Dict:
+        url = f"{self.downloader.base_url}/{path}"
+        with self.downloader.transport.get(url, headers=self.downloader.headers, endpoint="files") as response:
+            response.raise_for_status()
+            return response.json()
+    
+    def list_project_files(self, project_id: str) -> List[Dict]:
+        """Files in a project, as {"key", "name", ...} dicts."""
+        return self._get_json(f"projects/{project_id}/files").get("files", [])
+    
+    def list_team_files(self, team_id: str) -> List[Dict]:
+        """Files in every project of a team."""
+        files = []
+        for project in self._get_json(f"teams/{team_id}/projects").get("projects", []):
+            files.extend(self.list_project_files(str(project["id"])))
+        return files
+    
+    def _sync_file(self, file_id: str, output_path: Path, options: Dict) -> Tuple[Optional[str], int]:
+        """Download one file on a fork that logs to the file's sync.log; returns (file name, failed downloads)."""
+        worker = self.downloader.fork()
+        file_output = output_path / file_id
+        file_output.mkdir(parents=True, exist_ok=True)
+        with open(file_output / self.LOG_NAME, "w", encoding="utf-8") as log:
+            worker.log_stream = log
+            failed = worker.download_assets(file_id, str(file_output), **options)
+        return worker.file_name, failed
+    
+    def sync(self, file_ids: List[str], output_dir: str = "assets", use_cache: bool = True,
+             cache_dir: Optional[str] = None, metrics_path: Optional[str] = None,
+             prometheus_path: Optional[str] = None, trace_memory: bool = False,
+             **options) -> Dict[str, Optional[str]]:
+        """Sync every file into <output_dir>/<file id>/.
+        
+        options are passed on to download_assets. Returns a map of file id to
+        an error message, or None for files that synced without failures.
+        """
+        downloader = self.downloader
+        output_path = Path(output_dir)
+        output_path.mkdir(parents=True, exist_ok=True)
+        file_ids = list(dict.fromkeys(file_ids))
+        
+        downloader.metrics = RunMetrics(trace_memory)
+        downloader.transport.observer = downloader.metrics.observe_request
+        retries_before = downloader.transport.retries
+        cache = None
+        if use_cache:
+            cache = AssetCache(Path(cache_dir) if cache_dir else output_path / ".figma_cache")
+        options = dict(options, use_cache=use_cache, cache=cache)
+        
+        print(f"Syncing {len(file_ids)} file(s), {self.parallel_files} at a time, "
+              f"with {downloader.concurrency} shared download workers...")
+        results: Dict[str, Optional[str]] = {}
+        download_executor = ThreadPoolExecutor(max_workers=downloader.concurrency)
+        try:
+            options["executor"] = download_executor
+            with ThreadPoolExecutor(max_workers=self.parallel_files) as file_executor:
+                futures = {file_executor.submit(self._sync_file, file_id, output_path, options): file_id
+                           for file_id in file_ids}
+                for done, future in enumerate(as_completed(futures), 1):
+                    file_id = futures[future]
+                    try:
+                        file_name, failed = future.result()
+                    except Exception as e:
+                        results[file_id] = str(e)
+                        downloader._log(f"❌ [{done}/{len(file_ids)}] {file_id}: {e}")
+                        continue
+                    results[file_id] = f"{failed} failed download(s)" if failed else None
+                    status = f"⚠️  {failed} failed" if failed else "✅ done"
+                    downloader._log(f"{status} [{done}/{len(file_ids)}] {file_name or file_id} "
+                                    f"→ {output_path / file_id}")
+        finally:
+            download_executor.shutdown(wait=True)
+            if cache is not None:
+                cache.save()
+            downloader.metrics.finish(downloader.transport.retries - retries_before)
+            if metrics_path:
+                downloader.metrics.write_json(Path(metrics_path))
+            if prometheus_path:
+                downloader.metrics.write_prometheus(Path(prometheus_path))
+        
+        synced = sum(1 for error in results.values() if error is None)
+        report = downloader.metrics.report()
+        print(f"\n📊 Synced {synced}/{len(file_ids)} file(s) in {report['wall_seconds']:.1f}s "
+              f"({int(report['counters'].get('assets_downloaded', 0))} assets downloaded, "
+              f"{int(report['counters'].get('assets_cached', 0))} cached, {report['retries']} retries)")
+        for file_id, error in results.items():
+            if error:
+                print(f"   ⚠️  {file_id}: {error} (see {output_path / file_id / self.LOG_NAME})")
+        return results
+
+
+class FigmaWatcher:
+    """Long-running sync: re-syncs files as soon as they change.
+    
+    Every interval seconds each file's version is checked with a cheap
+    depth-limited request; a POST to the optional webhook endpoint (Figma's
+    FILE_UPDATE / FILE_VERSION_UPDATE webhooks, or anything sending
+    {"file_key": ...}) triggers a check right away. Changed files are synced
+    with the same downloader, asset cache and worker pool every time, so
+    connections, the cache manifest and parsed node indexes stay warm in
+    memory, and only changed subtrees are rendered again.
+    
+    The webhook listens on loopback unless given webhook_host, and only
+    listens elsewhere with a webhook_passcode to check calls against.
+    """
+    
+    WEBHOOK_EVENTS = ("FILE_UPDATE", "FILE_VERSION_UPDATE")
+    # Figma's webhook payloads are a few hundred bytes
+    MAX_WEBHOOK_BODY = 1 << 20
+    
+    def __init__(self, downloader: FigmaAssetDownloader, file_ids: List[str], output_dir: str = "assets",
+                 interval: float = 15.0, webhook_port: Optional[int] = None,
+                 webhook_passcode: Optional[str] = None, debounce: float = 2.0,
+                 use_cache: bool = True, cache_dir: Optional[str] = None,
+                 webhook_host: str = "127.0.0.1", **options):
+        if webhook_port is not None and not webhook_passcode and not self.is_loopback(webhook_host):
+            raise ValueError(f"refusing to accept webhooks on {webhook_host} without a passcode "
+                             f"(set --webhook-passcode, or listen on 127.0.0.1)")
+        self.downloader = downloader
+        self.file_ids = list(dict.fromkeys(file_ids))
+        self.output_path = Path(output_dir)
+        self.interval = interval
+        self.webhook_host = webhook_host
+        self.webhook_port = webhook_port
+        self.webhook_passcode = webhook_passcode
+        self.debounce = debounce
+        self.options = options
+        self.cache = None
+        if use_cache:
+            self.cache = AssetCache(Path(cache_dir) if cache_dir else self.output_path / ".figma_cache")
+        self.versions: Dict[str, Optional[str]] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._notified: set = set()
+        self._notified_lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+    
+    def _output_for(self, file_id: str) -> Path:
+        return self.output_path / file_id if len(self.file_ids) > 1 else self.output_path
+    
+    @staticmethod
+    def is_loopback(host: str) -> bool:
+        """Whether host only accepts connections from this machine."""
+        if host == "localhost":
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+    
+    def notify(self, file_id: Optional[str] = None) -> None:
+        """Ask for an immediate check of file_id (or of every file)."""
+        with self._notified_lock:
+            self._notified.update([file_id] if file_id else self.file_ids)
+        self._wake.set()
+    
+    def sync_file(self, file_id: str) -> bool:
+        """Sync one file if its version changed. Returns True if a sync ran."""
+        version = self.downloader.get_file_version(file_id).get("version")
+        if version is not None and version == self.versions.get(file_id):
+            return False
+        started = time.perf_counter()
+        failed = self.downloader.download_assets(file_id, str(self._output_for(file_id)),
+                                                 use_cache=self.cache is not None, cache=self.cache,
+                                                 executor=self._executor, file_version=version, **self.options)
+        if not failed:
+            # Failed assets are retried on the next check
+            self.versions[file_id] = version
+        if self.cache is not None:
+            self.cache.save()
+        status = f"⚠️  {failed} failed" if failed else "🔄 Synced"
+        print(f"{status} {self.downloader.file_name or file_id} (version {version}) "
+              f"in {time.perf_counter() - started:.1f}s")
+        return True
+    
+    def _handler_class(self):
+        watcher = self
+        
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+            
+            def _reply(self, status: int) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            
+            def do_POST(self) -> None:
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= watcher.MAX_WEBHOOK_BODY:
+                    # The body is left unread, so the connection can't be reused
+                    self.close_connection = True
+                    return self._reply(413 if length > 0 else 400)
+                try:
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    payload = {}
+                if not isinstance(payload, dict):
+                    payload = {}
+                if watcher.webhook_passcode and not hmac.compare_digest(
+                        str(payload.get("passcode", "")).encode(), watcher.webhook_passcode.encode()):
+                    return self._reply(403)
+                file_key = payload.get("file_key")
+                event = payload.get("event_type")
+                if file_key in watcher.file_ids and (event is None or event in watcher.WEBHOOK_EVENTS):
+                    watcher.notify(file_key)
+                self._reply(200)
+        
+        return WebhookHandler
+    
+    def start_webhook(self) -> None:
+        """Listen for webhook POSTs on the configured host and port (any path)."""
+        self._server = ThreadingHTTPServer((self.webhook_host, self.webhook_port), self._handler_class())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"🪝 Listening for webhooks on {self.webhook_host} port {self._server.server_address[1]}")
+    
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+    
+    def run(self) -> None:
+        """Sync everything once, then keep syncing changes until stop()."""
+        self._executor = ThreadPoolExecutor(max_workers=self.downloader.concurrency)
+        if self.webhook_port is not None:
+            self.start_webhook()
+        print(f"👀 Watching {len(self.file_ids)} file(s), checking every {self.interval:g}s. Press Ctrl-C to stop.")
+        pending = list(self.file_ids)
+        try:
+            while not self._stop.is_set():
+                for file_id in pending:
+                    if self._stop.is_set():
+                        break
+                    try:
+                        self.sync_file(file_id)
+                    except Exception as e:
+                        print(f"❌ Sync of {file_id} failed: {e}")
+                
+                notified = self._wake.wait(self.interval)
+                if notified and self.debounce and not self._stop.is_set():
+                    # Let a burst of saves settle into one sync
+                    time.sleep(self.debounce)
+                self._wake.clear()
+                with self._notified_lock:
+                    pending = [file_id for file_id in self.file_ids if file_id in self._notified] if notified \
+                        else list(self.file_ids)
+                    self._notified.clear()
+        finally:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+            self._executor.shutdown(wait=True)
+            if self.cache is not None:
+                self.cache.save()
 
 
 def main():
@@ -559,19 +4484,89 @@ Examples:
   python download_figma_assets.py --token abc123 --file xyz789
   python download_figma_assets.py --token abc123 --file https://www.figma.com/file/xyz789/Design
   python download_figma_assets.py --token abc123 --file xyz789 --output my_assets
+  python download_figma_assets.py --token abc123 --file xyz789 --concurrency 16
+  python download_figma_assets.py --token abc123 --file xyz789 --format png,svg --scale 1,2,3
+  python download_figma_assets.py --token abc123 --file xyz789 --optimize
+  python download_figma_assets.py --optimize-dir public/assets/work --optimize-formats webp,avif
+  python download_figma_assets.py --token abc123 --file xyz789 --file uvw456 --parallel-files 4
+  python download_figma_assets.py --token abc123 --project 12345 --team 67890
+  python download_figma_assets.py --token abc123 --file xyz789 --watch --webhook-port 8787
         """
     )
     
     parser.add_argument(
         "--token",
-        required=True,
         help="Your Figma API token (get it from https://www.figma.com/developers/api#access-tokens)"
     )
     
     parser.add_argument(
         "--file",
-        required=True,
-        help="Figma file ID or full Figma URL"
+        action="append",
+        default=[],
+        help="Figma file ID or full Figma URL. Can be repeated to sync several files at once."
+    )
+    
+    parser.add_argument(
+        "--files-from",
+        metavar="PATH",
+        help="Sync every file ID or URL listed in PATH (one per line, # for comments)"
+    )
+    
+    parser.add_argument(
+        "--project",
+        action="append",
+        default=[],
+        metavar="PROJECT_ID",
+        help="Sync every file in a Figma project. Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--team",
+        action="append",
+        default=[],
+        metavar="TEAM_ID",
+        help="Sync every file in every project of a Figma team. Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--parallel-files",
+        type=int,
+        default=4,
+        help="Files synced at the same time in multi-file mode (default: 4). "
+             "All of them share one connection pool, rate limiter, download pool and cache; "
+             "each goes to OUTPUT/<file id>/"
+    )
+    
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and re-sync whenever the file(s) change"
+    )
+    
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=15.0,
+        help="Seconds between version checks in --watch mode (default: 15)"
+    )
+    
+    parser.add_argument(
+        "--webhook-port",
+        type=int,
+        metavar="PORT",
+        help="In --watch mode, also sync as soon as a Figma FILE_UPDATE webhook is POSTed to this port"
+    )
+    
+    parser.add_argument(
+        "--webhook-host",
+        default="127.0.0.1",
+        metavar="HOST",
+        help="Address the webhook listens on (default: 127.0.0.1; any other address requires --webhook-passcode)"
+    )
+    
+    parser.add_argument(
+        "--webhook-passcode",
+        help="Reject webhook calls whose passcode doesn't match"
     )
     
     parser.add_argument(
@@ -580,6 +4575,23 @@ Examples:
         help="Output directory for downloaded assets (default: assets)"
     )
     
+    parser.add_argument(
+        "--sink",
+        default="dir",
+        metavar="SPEC",
+        help="Where assets are written: dir (the --output directory, default), tar:PATH "
+             "(.tar.gz/.tgz to compress), zip:PATH or s3://BUCKET/PREFIX. Non-dir sinks stream each "
+             "download straight in; --output then only holds the cache."
+    )
+    
+    parser.add_argument(
+        "--s3-endpoint",
+        metavar="URL",
+        help="Endpoint of an S3-compatible store for s3:// sinks, e.g. http://localhost:9000 "
+             "(default: AWS_ENDPOINT_URL, else AWS). Credentials come from AWS_ACCESS_KEY_ID and "
+             "AWS_SECRET_ACCESS_KEY."
+    )
+    
     parser.add_argument(
         "--export-all",
         action="store_true",
@@ -593,15 +4605,436 @@ Examples:
         help="Only export nodes with explicit export settings in Figma"
     )
     
+    parser.add_argument(
+        "--page",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="Only export from pages whose name matches (glob, or re:REGEX); other pages are never "
+             "fetched. Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--path",
+        action="append",
+        default=[],
+        metavar="PAGE/NODE/...",
+        help="Only export the subtrees at this node path, one glob per level "
+             "(e.g. 'Marketing/Hero*'). Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--node-id",
+        action="append",
+        default=[],
+        metavar="ID",
+        help="Only fetch and export the subtrees under these node ids. Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Only export nodes whose name matches (glob, or re:REGEX). Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Skip nodes whose name matches, along with everything inside them. Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--type",
+        action="append",
+        default=[],
+        metavar="NODE_TYPE",
+        help="Only export nodes of this type (e.g. COMPONENT, FRAME). Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=None,
+        help="Don't look deeper than this many levels below the page (top-level frames are 1)"
+    )
+    
+    parser.add_argument(
+        "--min-size",
+        metavar="WxH",
+        help="Skip nodes smaller than WxH pixels (or N for NxN)"
+    )
+    
+    parser.add_argument(
+        "--format",
+        default="png",
+        help="Comma-separated render formats for nodes without export settings: png, jpg, svg, pdf "
+             "(default: png)"
+    )
+    
+    parser.add_argument(
+        "--scale",
+        default="2",
+        help="Comma-separated render scales for nodes without export settings, e.g. 1,2,3 (default: 2)"
+    )
+    
+    parser.add_argument(
+        "--ignore-export-settings",
+        action="store_true",
+        help="Render every node with --format/--scale, even if it has export settings in Figma"
+    )
+    
+    parser.add_argument(
+        "--atlas",
+        choices=IconAtlas.MODES,
+        help="Pack small vector icons with export settings into icons/sprite.svg (svg), a PNG atlas "
+             "icons/atlas.png (png, requires Pillow) or both, with an icons/icons.json lookup"
+    )
+    
+    parser.add_argument(
+        "--atlas-max-size",
+        type=float,
+        default=64,
+        metavar="PX",
+        help="Largest width/height of a node that counts as an icon for --atlas (default: 64)"
+    )
+    
+    parser.add_argument(
+        "--atlas-scale",
+        type=float,
+        default=2,
+        help="Scale icons are rendered at in the PNG atlas (default: 2)"
+    )
+    
+    parser.add_argument(
+        "--no-manifest",
+        action="store_true",
+        help="Don't write asset-manifest.json / asset-manifest.ts"
+    )
+    
+    parser.add_argument(
+        "--no-placeholders",
+        action="store_true",
+        help="Leave the tiny base64 placeholder images out of the asset manifest"
+    )
+    
+    parser.add_argument(
+        "--public-path",
+        default="",
+        metavar="PREFIX",
+        help="URL prefix for the manifest's src fields, e.g. /assets (default: paths relative to --output)"
+    )
+    
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse the file JSON incrementally and keep only exportable nodes, instead of loading "
+             "it whole (requires 'pip install ijson')"
+    )
+    
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Download every asset again instead of reusing ones cached by earlier runs"
+    )
+    
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory for the asset cache and its manifest (default: OUTPUT/.figma_cache)"
+    )
+    
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Ignore the journal of an interrupted run and start over"
+    )
+    
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="After downloading, write WebP/AVIF, responsive-width and recompressed variants "
+             "into OUTPUT/optimized (requires 'pip install Pillow')"
+    )
+    
+    parser.add_argument(
+        "--optimize-dir",
+        action="append",
+        default=[],
+        metavar="DIR",
+        help="Also optimize the images in DIR (e.g. public/assets/work); with no --file, "
+             "only optimize. Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--optimize-formats",
+        default="webp",
+        help="Comma-separated modern formats to emit: webp, avif (default: webp)"
+    )
+    
+    parser.add_argument(
+        "--optimize-widths",
+        default="640,1280,1920",
+        help="Comma-separated responsive widths in pixels (default: 640,1280,1920)"
+    )
+    
+    parser.add_argument(
+        "--optimize-quality",
+        type=int,
+        default=80,
+        help="Encoder quality for lossy formats (default: 80)"
+    )
+    
+    parser.add_argument(
+        "--no-dedupe",
+        action="store_true",
+        help="Request every render and keep byte-identical files as separate copies"
+    )
+    
+    parser.add_argument(
+        "--perceptual-dedupe",
+        action="store_true",
+        help="Also list visually near-identical images in duplicates.json (requires 'pip install Pillow')"
+    )
+    
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print a line per downloaded file instead of a progress bar"
+    )
+    
+    parser.add_argument(
+        "--metrics-json",
+        metavar="PATH",
+        help="Write per-phase timings, throughput, request latency histograms and retries as JSON"
+    )
+    
+    parser.add_argument(
+        "--metrics-prom",
+        metavar="PATH",
+        help="Write the same metrics in Prometheus text format (e.g. for a textfile collector)"
+    )
+    
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Record peak Python memory with tracemalloc (slows the run down)"
+    )
+    
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of assets to download in parallel (default: 8)"
+    )
+    
+    parser.add_argument(
+        "--max-per-host",
+        type=int,
+        default=None,
+        help="Maximum simultaneous downloads from a single host (default: same as --concurrency)"
+    )
+    
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=None,
+        help="Maximum downloads queued ahead of the workers before URL resolution waits "
+             "(default: 4 x --concurrency)"
+    )
+    parser.add_argument(
+        "--render-batch-cost",
+        type=float,
+        default=None,
+        help="Estimated render cost (output megapixels plus a per-node term) allowed per /images request; "
+             f"lower it if large frames time out (default: {FigmaAssetDownloader.MAX_BATCH_COST:g})"
+    )
+    
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait when opening a connection (default: 10)"
+    )
+    
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=60.0,
+        help="Seconds to wait for data on an open connection (default: 60)"
+    )
+    
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="Retries for rate-limited (429), 5xx or dropped requests (default: 5)"
+    )
+    
+    parser.add_argument(
+        "--rate-limit",
+        action="append",
+        default=[],
+        metavar="ENDPOINT=RATE[/BURST]",
+        help="Requests per second allowed for an endpoint (files, images, fills or cdn), "
+             "e.g. images=2/5; use 0 for unlimited. Can be repeated."
+    )
+    
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="Multiplex requests over HTTP/2 (requires 'pip install httpx[http2]')"
+    )
+    
     args = parser.parse_args()
     
+    file_inputs = list(args.file)
+    if args.files_from:
+        with open(args.files_from, "r", encoding="utf-8") as f:
+            file_inputs.extend(line.strip() for line in f if line.strip() and not line.lstrip().startswith("#"))
+    syncing = bool(file_inputs or args.project or args.team)
+    if not syncing and not args.optimize_dir:
+        parser.error("--file is required (or pass --optimize-dir to only optimize images)")
+    if syncing and not args.token:
+        parser.error("--token is required when downloading a file")
+    
+    rate_limits = {}
+    for spec in args.rate_limit:
+        try:
+            endpoint, budget = spec.split("=", 1)
+            rate, _, burst = budget.partition("/")
+            rate_limits[endpoint.strip()] = (float(rate), float(burst or max(1.0, float(rate)))) if float(rate) > 0 else None
+        except ValueError:
+            parser.error(f"invalid --rate-limit '{spec}' (expected ENDPOINT=RATE[/BURST])")
+    
+    min_size = None
+    if args.min_size:
+        try:
+            width, _, height = args.min_size.lower().partition("x")
+            min_size = (float(width), float(height or width))
+        except ValueError:
+            parser.error(f"invalid --min-size '{args.min_size}' (expected WxH or N)")
+    selector = NodeSelector(pages=args.page, paths=args.path, include=args.include, exclude=args.exclude,
+                            types=args.type, max_depth=args.max_depth, min_size=min_size,
+                            node_ids=args.node_id)
+    if not selector.active:
+        selector = None
+    try:
+        export_plan = ExportPlan(
+            formats=tuple(fmt.strip().lower() for fmt in args.format.split(",") if fmt.strip()),
+            scales=tuple(float(scale.strip().rstrip("xX")) for scale in args.scale.split(",") if scale.strip()),
+            use_export_settings=not args.ignore_export_settings,
+        )
+    except ValueError as e:
+        parser.error(f"invalid --format/--scale: {e}")
+    
+    atlas = None
+    if args.atlas:
+        if args.atlas == "png" and Image is None:
+            parser.error("--atlas png requires Pillow (pip install Pillow)")
+        if args.atlas == "both" and Image is None:
+            print("⚠️  The PNG atlas requires Pillow (pip install Pillow); writing the SVG sprite only")
+        atlas = IconAtlas(args.atlas, max_size=args.atlas_max_size, scale=args.atlas_scale)
+    
+    if args.sink not in ("", "dir"):
+        if args.optimize:
+            parser.error("--optimize needs the assets on disk; it can't be combined with --sink")
+        if args.watch and not args.sink.startswith("s3://"):
+            parser.error("--watch can't write to an archive sink")
+    if (args.watch and args.webhook_port is not None and not args.webhook_passcode
+            and not FigmaWatcher.is_loopback(args.webhook_host)):
+        parser.error(f"--webhook-host {args.webhook_host} accepts calls from other machines; "
+                     f"it requires --webhook-passcode")
+    
     # Determine export mode
     export_all = not args.export_only_marked
     
     try:
-        downloader = FigmaAssetDownloader(args.token)
-        file_id = downloader.extract_file_id(args.file)
-        downloader.download_assets(file_id, args.output, export_all)
+        optimize_dirs = list(args.optimize_dir)
+        if syncing and args.optimize:
+            optimize_dirs.insert(0, args.output)
+        if optimize_dirs:
+            optimizer = ImageOptimizer(
+                formats=tuple(fmt.strip().lower() for fmt in args.optimize_formats.split(",") if fmt.strip()),
+                widths=tuple(int(width) for width in args.optimize_widths.split(",") if width.strip()),
+                quality=args.optimize_quality,
+            )
+        
+        if not syncing:
+            for directory in optimize_dirs:
+                optimizer.optimize_directory(directory)
+            return
+        
+        downloader = FigmaAssetDownloader(args.token, concurrency=args.concurrency,
+                                          max_per_host=args.max_per_host,
+                                          queue_size=args.queue_size,
+                                          connect_timeout=args.connect_timeout,
+                                          read_timeout=args.read_timeout,
+                                          http2=args.http2,
+                                          max_retries=args.max_retries,
+                                          verbose=args.verbose,
+                                          rate_limits=rate_limits,
+                                          max_batch_cost=args.render_batch_cost)
+        file_ids = [downloader.extract_file_id(file_input) for file_input in file_inputs]
+        try:
+            sink = OutputSink.from_spec(args.sink, Path(args.output), s3_endpoint=args.s3_endpoint)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            if args.watch:
+                bulk = FigmaBulkSync(downloader)
+                for project_id in args.project:
+                    file_ids.extend(entry["key"] for entry in bulk.list_project_files(project_id))
+                for team_id in args.team:
+                    file_ids.extend(entry["key"] for entry in bulk.list_team_files(team_id))
+                watcher = FigmaWatcher(downloader, file_ids, args.output, interval=args.interval,
+                                       webhook_port=args.webhook_port, webhook_passcode=args.webhook_passcode,
+                                       webhook_host=args.webhook_host,
+                                       use_cache=not args.no_cache, cache_dir=args.cache_dir,
+                                       export_all=export_all, stream=args.stream, resume=not args.no_resume,
+                                       dedupe=not args.no_dedupe, perceptual=args.perceptual_dedupe,
+                                       selector=selector, export_plan=export_plan, sink=sink,
+                                       manifest=not args.no_manifest, placeholders=not args.no_placeholders,
+                                       public_path=args.public_path, atlas=atlas)
+                try:
+                    watcher.run()
+                except KeyboardInterrupt:
+                    print("\n👋 Stopped watching")
+                return
+            if len(file_ids) == 1 and not args.project and not args.team:
+                downloader.download_assets(file_ids[0], args.output, export_all, stream=args.stream,
+                                           use_cache=not args.no_cache, cache_dir=args.cache_dir,
+                                           resume=not args.no_resume, dedupe=not args.no_dedupe,
+                                           perceptual=args.perceptual_dedupe, metrics_path=args.metrics_json,
+                                           prometheus_path=args.metrics_prom, trace_memory=args.trace_memory,
+                                           selector=selector, export_plan=export_plan, sink=sink,
+                                           manifest=not args.no_manifest, placeholders=not args.no_placeholders,
+                                           public_path=args.public_path, atlas=atlas)
+                sync_failed = False
+            else:
+                bulk = FigmaBulkSync(downloader, parallel_files=args.parallel_files)
+                for project_id in args.project:
+                    file_ids.extend(entry["key"] for entry in bulk.list_project_files(project_id))
+                for team_id in args.team:
+                    file_ids.extend(entry["key"] for entry in bulk.list_team_files(team_id))
+                results = bulk.sync(file_ids, args.output, use_cache=not args.no_cache, cache_dir=args.cache_dir,
+                                    metrics_path=args.metrics_json, prometheus_path=args.metrics_prom,
+                                    trace_memory=args.trace_memory, export_all=export_all,
+                                    stream=args.stream, resume=not args.no_resume,
+                                    dedupe=not args.no_dedupe, perceptual=args.perceptual_dedupe,
+                                    selector=selector, export_plan=export_plan, sink=sink,
+                                    manifest=not args.no_manifest, placeholders=not args.no_placeholders,
+                                    public_path=args.public_path, atlas=atlas)
+                sync_failed = any(results.values())
+        finally:
+            sink.close()
+        for directory in optimize_dirs:
+            optimizer.optimize_directory(directory)
+        if sync_failed:
+            exit(1)
     except requests.exceptions.HTTPError as e:
         print(f"❌ HTTP Error: {e}")
         if e.response.status_code == 403:
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Tests for HTTPTransport retries and rate limiting, against the benchmark's
+MockFigmaServer with its 429/503 error injection.
+
+Run with: python -m unittest test_figma_transport (or pytest)
+"""
+
+import threading
+import time
+import unittest
+
+import download_figma_assets as figma
+from benchmark_figma_assets import MockFigmaServer, generate_document
+
+
+class HTTPTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockFigmaServer().start()
+        self.server.add_file("F", generate_document(50, base_url=f"{self.server.url}/cdn"))
+        self.file_url = f"{self.server.url}/v1/files/F"
+        self.cdn_url = f"{self.server.url}/cdn/render/F/1-1.png"
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def transport(self, **options) -> figma.HTTPTransport:
+        # Without Retry-After the backoff is negligible, so any wait comes from the server
+        options.setdefault("backoff_base", 0.001)
+        options.setdefault("rate_limits", {endpoint: None for endpoint in figma.HTTPTransport.RATE_LIMITS})
+        transport = figma.HTTPTransport(**options)
+        self.addCleanup(transport.close)
+        return transport
+    
+    def test_retry_after_is_honoured(self):
+        self.server.error_rate = 1.0
+        self.server.retry_after = 0.2
+        transport = self.transport(max_retries=2)
+        started = time.perf_counter()
+        with transport.get(self.file_url, endpoint="files") as response:
+            self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.4)
+        self.assertEqual(transport.retries, 2)
+    
+    def test_max_retries_is_respected(self):
+        self.server.error_rate = 1.0
+        for url, endpoint, status in ((self.file_url, "files", 429), (self.cdn_url, "cdn", 503)):
+            with self.subTest(endpoint=endpoint):
+                transport = self.transport(max_retries=3)
+                requests_before = self.server.requests
+                with transport.get(url, endpoint=endpoint) as response:
+                    self.assertEqual(response.status_code, status)
+                self.assertEqual(self.server.requests - requests_before, 4)
+                self.assertEqual(transport.retries, 3)
+    
+    def test_no_retries_without_errors(self):
+        transport = self.transport()
+        with transport.get(self.file_url, endpoint="files") as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["name"], "Synthetic 50 nodes")
+        self.assertEqual(transport.retries, 0)
+        self.assertEqual(self.server.requests, 1)
+    
+    def test_endpoint_token_bucket_limits_rate(self):
+        # 20 requests/s with no burst: 11 requests need at least 0.5s
+        transport = self.transport(rate_limits={"files": (20, 1), "cdn": None})
+        started = time.perf_counter()
+        for _ in range(11):
+            with transport.get(self.file_url, endpoint="files") as response:
+                self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.45)
+        
+        # Endpoints without a budget aren't held back
+        started = time.perf_counter()
+        for _ in range(11):
+            with transport.get(self.cdn_url, endpoint="cdn") as response:
+                self.assertEqual(response.status_code, 200)
+        self.assertLess(time.perf_counter() - started, 0.45)
+    
+    def test_rate_limited_response_pauses_the_endpoint(self):
+        self.server.error_rate = 1.0
+        self.server.retry_after = 0.3
+        transport = self.transport(max_retries=1, rate_limits={"files": (100, 10)})
+        
+        def rate_limited_request():
+            with transport.get(self.file_url, endpoint="files"):
+                pass
+        
+        worker = threading.Thread(target=rate_limited_request)
+        worker.start()
+        time.sleep(0.05)
+        # Another worker on the same endpoint waits out the Retry-After too
+        self.server.error_rate = 0.0
+        started = time.perf_counter()
+        with transport.get(self.file_url, endpoint="files") as response:
+            self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.2)
+        worker.join()
+
+
+if __name__ == "__main__":
+    unittest.main()